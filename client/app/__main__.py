@@ -1,15 +1,23 @@
 import asyncio
 import os
 
+from dotenv import load_dotenv
+
+from .lib.profiling import StartupProfile
+
 
 def main():
     """A runner function that serves as an entry point for command scripts"""
     os.environ[
         "SDL_VIDEO_X11_WMCLASS"
     ] = "Blak"  # required when using a tiling manager or WM
-    from .lib.kivy_manager import ClientUI
+    load_dotenv()
+    startup = StartupProfile(os.getenv("profile_startup", "false") != "false")
+    with startup.phase("import"):
+        from .lib.kivy_manager import ClientUI
 
-    client = ClientUI()
+    with startup.phase("init"):
+        client = ClientUI(startup=startup)
     try:
         asyncio.run(client.app_func())
     except asyncio.exceptions.CancelledError:
@@ -0,0 +1,79 @@
+import json
+import os
+from pathlib import Path
+
+
+class MessageCache:
+    """The chats of every user that logged in on this device, one file per user_id
+
+    every room is saved with at most max_messages of its latest messages, in the shape
+    user.login.success sends them. The seqs of those are sent with user.login, so the server
+    only sends what is newer.
+    """
+
+    def __init__(self, directory: Path, max_messages: int = 500):
+        self.directory = directory
+        self.max_messages = max_messages
+
+    def user_file(self, user_id: str) -> Path:
+        """File the chats of a user are saved in"""
+        return self.directory / f"{user_id}.json"
+
+    def read_json(self, path: Path) -> dict:
+        """Contents of a cache file, empty if it's missing or damaged"""
+        try:
+            with open(path) as cache_file:
+                return json.load(cache_file)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+
+    def write_json(self, path: Path, data: dict):
+        """Replaces a cache file, a crash never leaves a partial one behind"""
+        self.directory.mkdir(parents=True, exist_ok=True)
+        with open(f"{path}.tmp", "w") as cache_file:
+            json.dump(data, cache_file)
+        os.replace(f"{path}.tmp", path)
+
+    def load(self, username: str) -> dict[str, dict]:
+        """Cached rooms of a user by room_id, the user_id of a username is known after its first login"""
+        if user_id := self.read_json(self.directory / "users.json").get(username):
+            return self.read_json(self.user_file(user_id))
+        return {}
+
+    def save(self, user_id: str, username: str, rooms: dict[str, dict]):
+        """Saves the rooms of a user, only their latest messages are kept"""
+        users = self.read_json(self.directory / "users.json")
+        if users.get(username) != user_id:
+            users[username] = user_id
+            self.write_json(self.directory / "users.json", users)
+        for room in rooms.values():
+            room["messages"] = room["messages"][-self.max_messages :]
+        self.write_json(self.user_file(user_id), rooms)
+
+
+def known_seqs(rooms: dict[str, dict]) -> dict[str, int]:
+    """room_id -> seq of the latest cached message, sent with user.login"""
+    return {
+        room_id: max(message["seq"] for message in room["messages"])
+        for room_id, room in rooms.items()
+        if room["messages"]
+    }
+
+
+def merge_room(room: dict, cached: dict | None) -> dict:
+    """Completes a room of user.login.success with the cached messages the server left out
+
+    cached messages that left the server's hot window or expired are dropped.
+    """
+    if not cached:
+        return room
+    dropped = set(room.get("expired", ())) | {
+        message["message_id"] for message in room["messages"]
+    }
+    kept = [
+        message
+        for message in cached["messages"]
+        if message["seq"] >= room["first_seq"] and message["message_id"] not in dropped
+    ]
+    room["messages"] = sorted(kept + room["messages"], key=lambda m: m["seq"])
+    return room
@@ -1,35 +1,57 @@
+from __future__ import annotations
+
 import asyncio
 import json
 import os
+import random
 import sys
+import time
 import traceback
-from typing import Any, TypedDict
+from collections import OrderedDict, deque
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, TypedDict
 from uuid import UUID
 
 import websockets
 from app import ui
-from dotenv import load_dotenv
 from kivy import Logger
 from kivy.animation import Animation
 from kivy.clock import Clock
 from kivy.core.window import Window
-from kivy.lang.builder import Builder
-from kivy.modules import inspector
 from kivy.properties import BooleanProperty, NumericProperty, StringProperty
-from kivy.uix.screenmanager import ScreenManager
 from kivy.utils import get_random_color, platform
 from kivymd.app import MDApp
-from kivymd.uix.boxlayout import MDBoxLayout
-from kivymd.uix.button import MDFlatButton
-from kivymd.uix.gridlayout import MDGridLayout
-from kivymd.uix.textfield import MDTextField
 
-from ..utils import Colors, app_dir
+from ..utils import Colors
+from .cache import MessageCache, known_seqs, merge_room
+from .profiling import StartupProfile
+from .tracing import MessageTracer
+
+if (
+    TYPE_CHECKING
+):  # kv files get these widgets through the Factory, they are imported when used
+    from kivy.uix.screenmanager import ScreenManager
+    from kivymd.uix.boxlayout import MDBoxLayout
+    from kivymd.uix.gridlayout import MDGridLayout
+    from kivymd.uix.textfield import MDTextField
 
-load_dotenv()
 Window.borderless = True
 Window.custom_titlebar = True
 
+AUTH_TYPES = ("user.login", "user.register")
+# frames that only mean something on the connection they were queued on
+TRANSIENT_TYPES = AUTH_TYPES + ("msg.typing.send", "pong")
+FRAME_BUDGET = 0.008  # secs of a frame spent applying data sent by server
+
+
+def reconnect_delay(attempt: int, base: float, cap: float) -> float:
+    """Secs to wait before a reconnect attempt, exponential backoff with full jitter
+
+    clients that lost the server at once are spread over the whole window instead of
+    reconnecting in lockstep.
+    """
+    return random.uniform(0, min(cap, base * 2**attempt))
+
 
 class KivyIds(TypedDict):
     """Class to track ids defined in kv files"""
@@ -70,26 +92,55 @@ class ClientUI(MDApp):
         defaultvalue="vmi656705.contaboserver.net:8001"
     )
 
-    def __init__(self, **kwargs):
+    def __init__(self, startup: StartupProfile = None, **kwargs):
         self.websocket_host = os.getenv(
             "WEBSOCKET_HOST", ClientUI.websocket_host.defaultvalue
         )
         super().__init__(title="Blak", **kwargs)
+        self.startup = startup or StartupProfile()
+        self.dev_mode = os.getenv("dev_mode", "false") != "false"
         self.ws_handler_task = None
+        self.writer_task = None
+        # every frame goes through the outbox, only send_loop writes to the connection
+        self.outbox: deque[dict] = deque()
+        self.outbox_ready = asyncio.Event()
+        # room_id -> its typing frame in the outbox
+        self.queued_typing: dict[str, dict] = {}
+        # client_message_id -> msg.send frame that was sent but not confirmed by msg.sent yet
+        self.unacked: dict[str, dict] = {}
+        self.authenticated = False  # logged in on the current connection
+        # data sent by server, decoded and waiting to be applied to the UI
+        self.inbox: deque[tuple[dict, float]] = deque()
+        self.apply_trigger = Clock.create_trigger(self.apply_events)
+        self.credentials: dict[str, str] = {}  # to log in again after a reconnect
+        self.reconnect_base = float(os.getenv("reconnect_base", "0.5"))
+        self.reconnect_cap = float(os.getenv("reconnect_cap", "30"))
+        self.reconnect_attempt = 0  # failed attempts since the last healthy connection
+        self.retry_hint = asyncio.Event()  # cuts the wait before the next attempt short
+        self.tracer = MessageTracer(os.getenv("trace_messages", "false") != "false")
+        # chat screens are built when a chat is first opened, until then (and after their
+        # screen is released) the room is kept as user.login.success sent it
+        self.chat_rooms: dict[str, dict] = {}
+        self.open_chats: OrderedDict[str, None] = OrderedDict()  # least recent first
+        self.max_chat_screens = int(os.getenv("max_chat_screens", "8"))
+        self.last_seen_ticker = ui.LastSeenTicker()
+        self.cache = MessageCache(
+            Path(self.user_data_dir) / "message_cache",
+            int(os.getenv("cache_max_messages", "500")),
+        )
+        self.cached_rooms: dict[str, dict] = {}  # of the user logging in
         self.root: MDBoxLayout
 
     def build(self):
         """Main function that is called when window for Kivy is being generated add/load kv files here"""
         root: MDBoxLayout
 
-        for file in (app_dir / "ui/kv_files").glob(
-            "*.kv"
-        ):  # Load all UI files before Loading root
-            if file.stem == "client_ui":
-                continue
-            Builder.load_file(str(file))
-        # load root explicitly
-        root = Builder.load_file(str(app_dir / "ui/kv_files/client_ui.kv"))
+        # the rules of the other kv files are loaded by the widgets that need them first
+        for name in ("title_bar", "login"):
+            with self.startup.phase(f"kv {name}"):
+                ui.load_kv(name)
+        with self.startup.phase("kv client_ui"):
+            root = ui.load_kv("client_ui")
         root.ids["titlebar"]: ui.TitleBar
         if platform in ["win", "linux"]:  # only set title bar on Windows and linux
             if Window.set_custom_titlebar(root.ids["titlebar"]):
@@ -102,7 +153,11 @@ class ClientUI(MDApp):
             root.remove_widget(root.ids["titlebar"])
             Window.borderless = False
             Window.custom_titlebar = False
-        inspector.create_inspector(Window, root)
+        if self.dev_mode:
+            from kivy.modules import inspector
+
+            with self.startup.phase("inspector"):
+                inspector.create_inspector(Window, root)
         return root
 
     def on_start(self):
@@ -121,6 +176,17 @@ class ClientUI(MDApp):
                 lambda dt: self.root.ids["titlebar"].fix_layout()
             )  # needed to make sure custom titlebar renders properly on Windows
         self.root.ids["app_screen_manager"].current = "login"
+        # the login screen is shown with the next frame
+        Clock.schedule_once(lambda dt: self.startup.report())
+
+    def on_resume(self):
+        """Called when the app is back from the background, the network may be back too"""
+        self.retry_now()
+        return True
+
+    def on_stop(self):
+        """Called when the app is closing, the message cache is saved before it does"""
+        self.save_cache(background=False)
 
     def on_motion(self, *args):
         """Triggered every time there is any kind of motion on the window"""
@@ -135,229 +201,482 @@ class ClientUI(MDApp):
 
         run_wrapper starts kivy app and waits for it to finish
         ws_handler_task handles receiving of data from server
+        writer_task sends the queued data to the server
         """
         self.ws_handler_task = asyncio.create_task(self.ws_handler())
+        self.writer_task = asyncio.create_task(self.send_loop())
 
         async def run_wrapper():
             """Function to start kivy"""
             await self.async_run()
             self.ws_handler_task.cancel()
+            self.writer_task.cancel()
 
-        return await asyncio.gather(run_wrapper(), self.ws_handler_task)
+        return await asyncio.gather(
+            run_wrapper(), self.ws_handler_task, self.writer_task
+        )
 
     async def ws_handler(self):
         """Function to handle incoming data from server.
 
-        this function will try to reconnect with the server if connection is lost
+        the connection goes Disconnected -> Connecting -> Connected, a lost or failed one is
+        retried after reconnect_delay, which grows with every failed attempt up to
+        reconnect_cap secs. retry_now skips the wait, e.g. when the network may be back.
         """
-        connection_closed = True
         while True:
-            if self.ws:
+            try:
+                self.connection_status = "Connecting"
                 try:
-                    await self.handle_recv_data(await self.ws.recv())
-                except websockets.ConnectionClosed:
+                    self.ws = await websockets.connect(f"ws://{self.websocket_host}/ws")
+                except (OSError, asyncio.TimeoutError, websockets.InvalidHandshake):
                     await self.connection_lost()
-                    connection_closed = True
-                except asyncio.exceptions.CancelledError:
+                    await self.wait_to_reconnect()
+                    continue
+                await self.connection_established()
+                while True:
+                    try:
+                        self.decode(await self.ws.recv())
+                    except websockets.ConnectionClosed:
+                        break
+                    except Exception:
+                        Logger.warn(
+                            f"ws_handler: Something happened \n{traceback.format_exc()}"
+                        )
+                await self.connection_lost()
+                await self.wait_to_reconnect()
+            except asyncio.exceptions.CancelledError:
+                if self.ws:
                     await self.ws.close()
-                    break
+                break
 
-                except Exception:
-                    Logger.warn(
-                        f"ws_handler: Something happened \n{traceback.format_exc()}"
-                    )
-            if connection_closed:
-                try:
-                    self.ws = await websockets.connect(f"ws://{self.websocket_host}/ws")
-                    await self.connection_established()
-                    connection_closed = False
-                except (OSError, asyncio.exceptions.CancelledError):
-                    await self.connection_lost()
-                    await asyncio.sleep(
-                        5
-                    )  # try after 5 secs todo implement a timeout algo
-                    pass
+    async def wait_to_reconnect(self):
+        """Waits before the next connection attempt, unless retry_now is called meanwhile"""
+        delay = reconnect_delay(
+            self.reconnect_attempt, self.reconnect_base, self.reconnect_cap
+        )
+        self.reconnect_attempt += 1
+        Logger.info(f"WS: reconnecting in {delay:.1f}s")
+        self.retry_hint.clear()
+        try:
+            await asyncio.wait_for(self.retry_hint.wait(), delay)
+        except asyncio.TimeoutError:
+            pass
 
-            await asyncio.sleep(0)
+    def retry_now(self):
+        """Hint that the network may be back, the pending reconnect attempt is made right away"""
+        if self.connection_status == "Disconnected":
+            self.retry_hint.set()
 
-    async def handle_recv_data(self, reply: str):
-        """Handles data sent by server"""
+    def decode(self, frame: str):
+        """Decode stage of the data sent by server, buffers it for apply_events
+
+        parsing is cheap next to updating widgets, which apply_events spreads over frames,
+        pings are answered right away.
+        """
+        arrived = time.perf_counter()
         try:
-            reply = json.loads(reply)
-            Logger.debug(f"hrd: {reply}")
-            chats_screen_manager: ScreenManager
-            chats_screen_manager = self.root.ids["chats_screen_manager"]
-            match reply["type"]:
-                case "msg.typing.recv":
-                    if (
-                        chats_screen_manager.current == reply["room_id"]
-                    ):  # only show typing on the active chat
-                        screen: ui.ChatMessagesScreen
-                        screen = chats_screen_manager.get_screen(reply["room_id"])
-                        screen.ids["typing"].text = reply["data"]
+            reply = json.loads(frame)
+        except json.JSONDecodeError:
+            Logger.warn(f"Wrong Json data {frame}")
+            return
+        Logger.debug(f"hrd: {reply}")
+        # heartbeat, the server reaps sessions that stop answering
+        if reply["type"] == "ping":
+            self.send_data(value={"type": "pong"})
+            return
+        self.inbox.append((reply, arrived))
+        self.apply_trigger()
 
-                case "msg.recv":
-                    if not chats_screen_manager.has_screen(reply["room_id"]):
-                        self.add_chat_screen(
-                            reply["room_id"],
-                            self.get_other_user_id(reply["room_id"]),
-                            reply["sender_username"],
-                        )
+    def apply_events(self, *args):
+        """Applies the buffered data to the UI, once per frame and for FRAME_BUDGET secs at most
 
+        what is left waits for the next frame, so bursts are shown a bit later instead of
+        dropping frames.
+        """
+        deadline = time.perf_counter() + FRAME_BUDGET
+        while self.inbox:
+            reply, arrived = self.inbox.popleft()
+            try:
+                self.handle_recv_data(reply, arrived)
+            except Exception:
+                Logger.warn(
+                    f"apply_events: Something happened \n{traceback.format_exc()}"
+                )
+            if self.inbox and time.perf_counter() >= deadline:
+                self.apply_trigger()
+                break
+
+    def handle_recv_data(self, reply: dict, arrived: float):
+        """Handles data sent by server
+
+        :param arrived time.perf_counter() when the data was received
+        """
+        chats_screen_manager: ScreenManager
+        chats_screen_manager = self.root.ids["chats_screen_manager"]
+        match reply["type"]:
+            case "msg.typing.recv":
+                if (
+                    chats_screen_manager.current == reply["room_id"]
+                ):  # only show typing on the active chat
+                    screen: ui.ChatMessagesScreen
                     screen = chats_screen_manager.get_screen(reply["room_id"])
-                    screen.add_message(
-                        reply["data"],
-                        reply["user_id"],
-                        Colors.text_dark,
-                    )
-                    screen.ids["typing"].text = ""
-                    ui.ChatItem.Items.get(reply["room_id"]).timestamp = float(
-                        reply["timestamp"]
+                    if reply.get("state") == "stopped":
+                        screen.ids["typing"].text = ""
+                        screen.show_seen()
+                    else:
+                        screen.ids["typing"].text = reply["data"]
+
+            case "msg.recv":
+                self.show_received_message(
+                    reply["room_id"],
+                    reply["user_id"],
+                    reply["sender_username"],
+                    reply["data"],
+                    reply["timestamp"],
+                    reply["message_id"],
+                    reply["seq"],
+                )
+                self.tracer.recv(reply, arrived)
+            case "msg.pending":
+                # messages that arrived while offline, the server keeps them until acked
+                acked = {}
+                for message in reply["messages"]:
+                    self.show_received_message(
+                        message["room_id"],
+                        message["sender"],
+                        message["sender_username"],
+                        message["message"],
+                        message["timestamp"],
+                        message["message_id"],
+                        message["seq"],
                     )
-                case "msg.sent":
-                    # add message to self screen only when we get confirmation from server
-                    screen = chats_screen_manager.get_screen(reply["room_id"])
-                    screen.add_message(
-                        "",
-                        self.user_id,
-                        Colors.text_medium,
-                        clear_input=True,
-                        halign="right",
+                    acked[message["room_id"]] = message["seq"]
+                self.send_data(value={"type": "msg.ack", "seqs": acked})
+            case "msg.sent":
+                # add message to self screen only when we get confirmation from server
+                self.show_sent_message(
+                    reply, self.unacked.pop(reply.get("client_message_id"), None)
+                )
+                self.tracer.sent(reply, arrived)
+
+            case "user.login.success":
+                if data := reply["data"]:  # login Successful
+                    # logged in again after a reconnect, the chats are kept as they are
+                    resumed = self.login
+                    self.reconnect_attempt = 0
+                    self.user_id = data["user_id"]
+
+                    self.username = data["username"]
+                    self.rooms = data["rooms"]
+
+                    # add user profile button
+                    if Window.custom_titlebar and not resumed:
+                        self.root.ids["titlebar"].ids["profile_button"].bind(
+                            on_release=ui.Dialog(
+                                title="Profile",
+                                type="custom",
+                                content_cls=ui.ProfileDialogContent(),
+                            ).open
+                        )
+                    self.authenticated = True
+                    self.outbox_ready.set()  # flush what was held while offline
+                    # every room is applied on its own, so a login with many rooms is
+                    # spread over frames like any other burst
+                    events = [
+                        {"type": "login.room", "room": room} for room in self.rooms
+                    ]
+                    events.append(
+                        {
+                            "type": "login.done",
+                            "online_contacts": data.get("online_contacts", []),
+                        }
                     )
-                    screen.disable_chat_input = False
-
-                case "user.login.success":
-                    if data := reply["data"]:  # login Successful
-                        self.user_id = data["user_id"]
-
-                        self.username = data["username"]
-                        self.rooms = data["rooms"]
-
-                        # add user profile button
-                        if Window.custom_titlebar:
-                            self.root.ids["titlebar"].ids["profile_button"].bind(
-                                on_release=ui.Dialog(
-                                    title="Profile",
-                                    type="custom",
-                                    content_cls=ui.ProfileDialogContent(),
-                                ).open
-                            )
-                        for room in self.rooms:
-                            room_id = room["room_id"]
-                            other_username = next(
-                                username
-                                for username in room["usernames"]
-                                if username != self.username
-                            )
-                            other_id = self.get_other_user_id(room_id)
-                            self.add_chat_screen(room_id, str(other_id), other_username)
-                            msg = None
-                            screen: ui.ChatMessagesScreen
-                            screen = chats_screen_manager.get_screen(room_id)
-                            last_msg_timestamp = None
-                            for message in room["messages"]:
-                                if message["sender"] == str(self.user_id):
-                                    msg = screen.add_message(
-                                        message["message"],
-                                        self.user_id,
-                                        Colors.text_medium,
-                                        halign="right",
-                                    )
-                                else:
-                                    msg = screen.add_message(
-                                        message["message"],
-                                        message["sender"],
-                                        Colors.text_dark,
-                                    )
-                                    last_msg_timestamp = message["timestamp"]
-
-                            chat = ui.ChatItem.Items.get(room_id)
-                            if last_msg_timestamp:
-                                chat.timestamp = float(last_msg_timestamp)
-                            Clock.schedule_interval(chat.set_last_seen, 1)
-
-                            if msg:
-                                screen.scroll_to_message(msg)
-
-                        self.login = True
-                case "user.login.rejected":
-                    self.login_helper_text = "Invalid Username or Password"
-                    login_screen: ui.LoginScreen
-                    login_screen = (
-                        self.root.ids["app_screen_manager"]
-                        .get_screen("login")
-                        .children[0]
+                    self.inbox.extendleft(
+                        (event, arrived) for event in reversed(events)
                     )
-                    login_screen.reset_fields()
-                    self.do_logout(close_connection=False)
-                    self.login_data_sent = False
-                case "user.register.success":
-                    self.login_helper_text = "Registration Successful"
-
-                    login_screen: ui.LoginScreen
-                    login_screen = (
-                        self.root.ids["app_screen_manager"]
-                        .get_screen("login")
-                        .children[0]
+            case "login.room":  # queued by user.login.success
+                self.add_login_room(reply["room"])
+            case "login.done":
+                for user_id in reply["online_contacts"]:
+                    self.set_presence(user_id, True)
+                self.login = True
+                self.last_seen_ticker.refresh()
+                self.cached_rooms = {}
+                self.save_cache()
+            case "msg.history":
+                if chats_screen_manager.has_screen(reply["room_id"]):
+                    chats_screen_manager.get_screen(reply["room_id"]).prepend_messages(
+                        reply["messages"]
                     )
-                    login_screen.reset_fields()
-                    login_screen.ids["button_container"].remove_widget(
-                        login_screen.ids["register_button"]
+            case "msg.expired":
+                expired = {}
+                for message in reply["messages"]:
+                    expired.setdefault(message["room_id"], set()).add(
+                        message["message_id"]
                     )
-                    self.login_data_sent = False
+                for room_id, message_ids in expired.items():
+                    if chats_screen_manager.has_screen(room_id):
+                        chats_screen_manager.get_screen(room_id).remove_messages(
+                            message_ids
+                        )
+                    elif room := self.chat_rooms.get(room_id):
+                        room["messages"] = [
+                            message
+                            for message in room["messages"]
+                            if message["message_id"] not in message_ids
+                        ]
+            case "room.read.recv":
+                for receipt in reply["receipts"]:
+                    if chats_screen_manager.has_screen(receipt["room_id"]):
+                        chats_screen_manager.get_screen(
+                            receipt["room_id"]
+                        ).set_other_read_seq(receipt["seq"])
+                    elif room := self.chat_rooms.get(receipt["room_id"]):
+                        room["read_by"][receipt["user_id"]] = receipt["seq"]
+            case "user.presence":
+                self.set_presence(reply["user_id"], reply["online"])
+            case "user.login.rejected":
+                self.login_helper_text = "Invalid Username or Password"
+                login_screen: ui.LoginScreen
+                login_screen = (
+                    self.root.ids["app_screen_manager"].get_screen("login").children[0]
+                )
+                login_screen.reset_fields()
+                self.do_logout(close_connection=False)
+                self.login_data_sent = False
+            case "user.register.success":
+                self.login_helper_text = "Registration Successful"
+
+                login_screen: ui.LoginScreen
+                login_screen = (
+                    self.root.ids["app_screen_manager"].get_screen("login").children[0]
+                )
+                login_screen.reset_fields()
+                login_screen.ids["button_container"].remove_widget(
+                    login_screen.ids["register_button"]
+                )
+                self.login_data_sent = False
 
-                case "user.register.rejected":
-                    login_screen = (
-                        self.root.ids["app_screen_manager"]
-                        .get_screen("login")
-                        .children[0]
-                    )
-                    login_screen.reset_fields()
+            case "user.register.rejected":
+                login_screen = (
+                    self.root.ids["app_screen_manager"].get_screen("login").children[0]
+                )
+                login_screen.reset_fields()
+
+                self.login_helper_text = "User exists try again.."
+                self.login_data_sent = False
+
+            case "room.create.success":
+                room_id: str
+                if room_id := reply["room_id"]:
+                    self.add_chat(room_id, reply["other_username"])
+                    self.open_chat(room_id)
+                    self.dismiss_top_popup()
+
+    def add_login_room(self, room: dict):
+        """Adds a room of user.login.success to the chat list"""
+        room_id = room["room_id"]
+        # the server only sent messages newer than the cached or shown ones, screens only
+        # add what they miss
+        room = merge_room(
+            room, self.cached_rooms.get(room_id) or self.chat_rooms.get(room_id)
+        )
+        other_username = next(
+            username for username in room["usernames"] if username != self.username
+        )
+        # only the chat list entry is built, its screen when opened
+        chat = self.add_chat(room_id, other_username, room)
+        if last_received := next(
+            (
+                message
+                for message in reversed(room["messages"])
+                if message["sender"] != str(self.user_id)
+            ),
+            None,
+        ):
+            chat.timestamp = float(last_received["timestamp"])
+        # the badge comes from the server, no need to count the history
+        chat.msg_count = str(room["unread"])
+
+    def show_received_message(
+        self,
+        room_id: str,
+        sender_id: str,
+        sender_username: str,
+        text: str,
+        timestamp: str,
+        message_id: str,
+        seq: int,
+    ):
+        """Adds a message from the other user to its chat screen, unless it is shown already"""
+        chats_screen_manager: ScreenManager
+        chats_screen_manager = self.root.ids["chats_screen_manager"]
+        chat = self.add_chat(room_id, sender_username)
+        if chats_screen_manager.has_screen(room_id):
+            screen: ui.ChatMessagesScreen
+            screen = chats_screen_manager.get_screen(room_id)
+            screen.add_seq(seq)
+            if message_id in screen.message_ids:
+                return
+            screen.add_message(
+                text,
+                sender_id,
+                Colors.text_dark,
+                message_id=message_id,
+                timestamp=timestamp,
+                seq=seq,
+            )
+            screen.ids["typing"].text = ""
+        else:
+            messages = self.chat_rooms[room_id]["messages"]
+            # redeliveries are rare, the latest messages are checked first
+            if any(
+                message["message_id"] == message_id for message in reversed(messages)
+            ):
+                return
+            messages.append(
+                {
+                    "message_id": message_id,
+                    "sender": sender_id,
+                    "message": text,
+                    "timestamp": timestamp,
+                    "seq": seq,
+                }
+            )
+        chat.timestamp = float(timestamp)
+        if chats_screen_manager.current == room_id:
+            screen.mark_read()
+        else:
+            chat.msg_count = str(int(chat.msg_count) + 1)
 
-                    self.login_helper_text = "User exists try again.."
-                    self.login_data_sent = False
+    def show_sent_message(self, reply: dict, frame: dict | None):
+        """Adds a message the server confirmed to its chat, unless it is shown already
 
-                case "room.create.success":
-                    room_id: str
-                    if room_id := reply["room_id"]:
-                        self.add_chat_screen(
-                            room_id,
-                            self.get_other_user_id(room_id),
-                            reply["other_username"],
-                        ).current = room_id
-                        self.dismiss_top_popup()
+        the text is taken from the msg.send frame, the input may hold another message by now.
 
-        except json.JSONDecodeError:
-            Logger.warn(f"Wrong Json data {reply}")
+        :param reply msg.sent of the server
+        :param frame the msg.send frame, None if it isn't known (anymore)
+        """
+        chats_screen_manager: ScreenManager
+        chats_screen_manager = self.root.ids["chats_screen_manager"]
+        room_id = reply["room_id"]
+        if chats_screen_manager.has_screen(room_id):
+            screen: ui.ChatMessagesScreen
+            screen = chats_screen_manager.get_screen(room_id)
+            screen.disable_chat_input = False
+            if frame is None:
+                return
+            if screen.ids["chat_input"].text == frame["data"]:
+                screen.ids["chat_input"].text = ""
+            # sent again after a reconnect, the login may have brought it already
+            if reply["message_id"] in screen.message_ids:
+                return
+            screen.add_message(
+                frame["data"],
+                self.user_id,
+                Colors.text_medium,
+                halign="right",
+                message_id=reply["message_id"],
+                timestamp=frame["timestamp"],
+                seq=reply.get("seq", -1),
+            )
+            if "seq" in reply:
+                screen.add_seq(reply["seq"], sent=True)
+        elif frame is not None and "seq" in reply and room_id in self.chat_rooms:
+            messages = self.chat_rooms[room_id]["messages"]
+            if any(
+                message["message_id"] == reply["message_id"]
+                for message in reversed(messages)
+            ):
+                return
+            messages.append(
+                {
+                    "message_id": reply["message_id"],
+                    "sender": self.user_id,
+                    "message": frame["data"],
+                    "timestamp": frame["timestamp"],
+                    "seq": reply["seq"],
+                }
+            )
 
-    def send_data(self, instance: Any = None, value: str | int | dict = None) -> None:
-        """Wrapper around  WebSocketClientProtocol.send so that kivy event bindings work normally.
+    def set_presence(self, user_id: str, online: bool):
+        """Shows whether the other user of a chat is online"""
+        for room_id, chat in ui.ChatItem.Items.items():
+            if self.get_other_user_id(room_id) == user_id:
+                chat.online = online
+
+    def send_data(self, instance: Any = None, value: dict = None) -> None:
+        """Queues data for the server, works as a kivy event binding too
+
+        frames are sent in the order they were queued. A typing frame drops the one of the
+        same room that is still queued, only the latest text matters to the other user.
+        Login and register frames go ahead of the rest, which waits until the user is logged in.
 
         :param instance Object that is sending the data
         :param value value that the object represents
         """
-        if value is None:
-            value = "test"
+        if value["type"] == "msg.typing.send":
+            if queued := self.queued_typing.pop(value["room_id"], None):
+                self.outbox.remove(queued)
+            self.queued_typing[value["room_id"]] = value
+        if value["type"] in AUTH_TYPES:
+            self.outbox.appendleft(value)
+        else:
+            self.outbox.append(value)
+        self.outbox_ready.set()
 
-        asyncio.create_task(self.send_data_wrapper(value))
+    async def send_loop(self):
+        """Sends the queued data to the server, the only task writing to the connection
 
-    async def send_data_wrapper(self, data):
-        """Async function that actually sends data to the server"""
-        if self.ws and self.ws.open:
+        frames are held while disconnected and sent in order once the user is logged in on
+        the next connection, a frame whose send failed is sent again. A message is kept until
+        its msg.sent arrives, as the connection can drop before the server got it.
+        """
+        while True:
             try:
-
-                data = json.dumps(data)
-                Logger.debug(f"sdw: {data}")
-            except json.JSONDecodeError:
-                Logger.warn(f"Wrong Data send {type(data)}")
-
-            await self.ws.send(data)
+                await self.outbox_ready.wait()
+            except asyncio.exceptions.CancelledError:
+                break
+            self.outbox_ready.clear()
+            while self.outbox and self.ws and self.ws.open:
+                data = self.outbox[0]
+                if not self.authenticated and data["type"] not in AUTH_TYPES:
+                    break
+                if data["type"] == "msg.typing.send":
+                    # typing after this point is queued as a new frame
+                    self.queued_typing.pop(data["room_id"], None)
+                frame = json.dumps(data)
+                Logger.debug(f"sdw: {frame}")
+                try:
+                    await self.ws.send(frame)
+                except websockets.ConnectionClosed:
+                    break  # kept for the next connection
+                except asyncio.exceptions.CancelledError:
+                    return
+                if data in self.outbox:  # unless connection_lost dropped it meanwhile
+                    self.outbox.remove(data)
+                    if data["type"] == "msg.send":
+                        self.unacked[data["client_message_id"]] = data
 
     async def connection_lost(self):
         """Function called whenever connection with server is lost"""
         try:
+            if self.login and self.connection_status == "Connected":
+                self.save_cache()
             self.login_data_sent = True
             self.connection_status = "Disconnected"
+            self.authenticated = False
+            # sent again after the next login, the server drops the ones it already has
+            held = list(self.unacked.values())
+            held += [
+                data for data in self.outbox if data["type"] not in TRANSIENT_TYPES
+            ]
+            self.unacked.clear()
+            self.outbox.clear()
+            self.outbox.extend(held)
+            self.queued_typing.clear()
+            for chat in ui.ChatItem.Items.values():  # presence is unknown until relogin
+                chat.online = False
             if Window.custom_titlebar:
                 self.root.ids["titlebar"].ids["connection_status_label"].color = [
                     1,
@@ -381,6 +700,21 @@ class ClientUI(MDApp):
         else:
             self.set_window_title()
         self.login_data_sent = False
+        if self.login and self.credentials:
+            self.reauthenticate()
+        else:
+            self.reconnect_attempt = 0  # nothing to resume, the connection is healthy
+        self.outbox_ready.set()
+
+    def reauthenticate(self):
+        """Logs in again after a reconnect, the server only sends what the chats are missing"""
+        self.send_data(
+            value={
+                "type": "user.login",
+                **self.credentials,
+                "known": known_seqs(self.chat_messages()),
+            }
+        )
 
     async def check_user_id(self, user_id: str, dialog: ui.Dialog):
         """Sends request to the server to check if user with user_id exists"""
@@ -402,7 +736,7 @@ class ClientUI(MDApp):
             "other_id": str(user_id),
         }
 
-        await self.send_data_wrapper(request_data)
+        self.send_data(value=request_data)
 
     def on_login(self, instance, value):
         """Sets correct login screen whenever app.login changes"""
@@ -421,19 +755,69 @@ class ClientUI(MDApp):
             }
             if self.ws and self.ws.open:
                 self.login_data_sent = True
-            self.send_data(value=data)
+            if register:
+                self.send_data(value=data)
+            else:
+                self.credentials = {"username": username, "password": password}
+                asyncio.create_task(self.send_login(data))
+
+    async def send_login(self, data: dict):
+        """Sends user.login with the seqs of the cached messages, the server only sends newer ones"""
+        self.cached_rooms = await asyncio.to_thread(self.cache.load, data["username"])
+        data["known"] = known_seqs(self.cached_rooms)
+        self.send_data(value=data)
+
+    def chat_messages(self) -> dict[str, dict]:
+        """room_id -> {"messages": [...]} of every chat, whether its screen is built or not"""
+        chats_screen: ScreenManager
+        chats_screen = self.root.ids["chats_screen_manager"]
+        rooms = {}
+        for room_id in ui.ChatItem.Items:
+            if chats_screen.has_screen(room_id):
+                messages = chats_screen.get_screen(room_id).to_room()["messages"]
+            else:
+                messages = self.chat_rooms[room_id]["messages"]
+            rooms[room_id] = {"messages": messages}
+        return rooms
+
+    def save_cache(self, background: bool = True):
+        """Saves the latest messages of every chat of the user to the message cache"""
+        if not self.user_id:
+            return
+        rooms = {
+            room_id: {"messages": room["messages"][-self.cache.max_messages :]}
+            for room_id, room in self.chat_messages().items()
+        }
+        args = (self.cache.save, str(self.user_id), self.username, rooms)
+        if background:
+            asyncio.create_task(asyncio.to_thread(*args))
+        else:
+            args[0](*args[1:])
 
     def do_logout(self, close_connection: bool = True):
         """Reset User info and go back to log in screen"""
+        self.save_cache()
         self.username = ""
         self.user_id = ""
         self.login = False
+        self.authenticated = False
+        self.credentials = {}
+        self.outbox.clear()  # nothing of this user is sent on behalf of the next one
+        self.unacked.clear()
+        self.inbox.clear()
+        self.queued_typing.clear()
         if close_connection:
             asyncio.create_task(self.ws.close())
 
         # remove all chats and chat messages
+        for screen in self.root.ids["chats_screen_manager"].screens:
+            screen.release()
         self.root.ids["chat_list_container"].clear_widgets()
         self.root.ids["chats_screen_manager"].clear_widgets()
+        ui.ChatItem.Items.clear()
+        self.last_seen_ticker.clear()
+        self.chat_rooms.clear()
+        self.open_chats.clear()
 
     def set_window_title(self):
         """Sets window title when custom_titlebar is not used"""
@@ -443,6 +827,8 @@ class ClientUI(MDApp):
     # callbacks
     def show_add_chat_dialog(self):
         """Shows a dialog to add a new chat"""
+        from kivymd.uix.button import MDFlatButton
+
         dialog = ui.Dialog(
             title="Add new Chat",
             type="custom",
@@ -480,20 +866,60 @@ class ClientUI(MDApp):
         if isinstance(self.root_window.children[0], ui.Dialog):
             self.root_window.children[0].dismiss()
 
-    def add_chat_screen(
-        self, room_id: str, other_user: str, other_username: str
-    ) -> ScreenManager:
-        """Adds chat and its screen to the app"""
-        chats_screen: ScreenManager
-        chats_screen = self.root.ids["chats_screen_manager"]
-        if not chats_screen.has_screen(room_id):
+    def add_chat(
+        self, room_id: str, other_username: str, room: dict = None
+    ) -> ui.ChatItem:
+        """Adds a chat to the chat list, its screen is only built once it is opened
+
+        :param room the room as user.login.success sends it, a new chat has no messages
+        """
+        if room_id not in ui.ChatItem.Items:
             self.root.ids["chat_list_container"].add_widget(
                 ui.ChatItem(username=other_username, custom_id=room_id)
             )
-            chats_screen.add_widget(
-                ui.ChatMessagesScreen(other_user=other_user, name=room_id)
+        chats_screen: ScreenManager
+        chats_screen = self.root.ids["chats_screen_manager"]
+        if chats_screen.has_screen(room_id):
+            if room:  # logged in again
+                chats_screen.get_screen(room_id).load_room(room)
+        elif room or room_id not in self.chat_rooms:
+            self.chat_rooms[room_id] = room or {
+                "messages": [],
+                "read_seq": -1,
+                "read_by": {},
+            }
+        return ui.ChatItem.Items[room_id]
+
+    def open_chat(self, room_id: str) -> ui.ChatMessagesScreen:
+        """Switches to the screen of a chat, building it the first time
+
+        at most max_chat_screens screens are kept, the least recently opened ones are released.
+        """
+        chats_screen: ScreenManager
+        chats_screen = self.root.ids["chats_screen_manager"]
+        if not chats_screen.has_screen(room_id):
+            screen = ui.ChatMessagesScreen(
+                other_user=self.get_other_user_id(room_id), name=room_id
             )
-        return chats_screen
+            chats_screen.add_widget(screen)
+            screen.load_room(self.chat_rooms.pop(room_id))
+        chats_screen.current = room_id
+        self.open_chats[room_id] = None
+        self.open_chats.move_to_end(room_id)
+        while len(self.open_chats) > self.max_chat_screens:
+            self.release_chat(next(iter(self.open_chats)))
+        return chats_screen.get_screen(room_id)
+
+    def release_chat(self, room_id: str):
+        """Drops the screen of a chat, its messages are kept until it is opened again"""
+        self.open_chats.pop(room_id, None)
+        chats_screen: ScreenManager
+        chats_screen = self.root.ids["chats_screen_manager"]
+        if chats_screen.has_screen(room_id):
+            screen: ui.ChatMessagesScreen
+            screen = chats_screen.get_screen(room_id)
+            self.chat_rooms[room_id] = screen.release()
+            chats_screen.remove_widget(screen)
 
     def get_other_user_id(self, room_id: str) -> str:
         """Returns user id of other user in a chat
@@ -542,3 +968,5 @@ class ClientUI(MDApp):
                 self.login_focus_set = True
             else:
                 self.login_focus_set = False
+        if focus:
+            self.retry_now()
@@ -0,0 +1,39 @@
+import time
+from contextlib import contextmanager
+from typing import Iterator
+
+
+class StartupProfile:
+    """Times the phases of the client's startup and logs them once the login screen is shown
+
+    enabled by setting the `profile_startup` environment variable, kivy isn't imported here so
+    importing the app can be timed too.
+    """
+
+    def __init__(self, enabled: bool = False):
+        self.enabled = enabled
+        self.started = time.perf_counter()
+        # (name, secs) in the order they ended
+        self.phases: list[tuple[str, float]] = []
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        """Times the code of the with block as a phase"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            if self.enabled:
+                self.phases.append((name, time.perf_counter() - start))
+
+    def report(self):
+        """Logs every phase and the time since launch"""
+        if not self.enabled:
+            return
+        from kivy import Logger
+
+        for name, secs in self.phases:
+            Logger.info(f"Startup: {name} {secs * 1000:.1f}ms")
+        Logger.info(
+            f"Startup: launch->login screen {(time.perf_counter() - self.started) * 1000:.1f}ms"
+        )
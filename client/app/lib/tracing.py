@@ -0,0 +1,83 @@
+import time
+from datetime import datetime
+from uuid import uuid4
+
+from kivy import Logger
+from kivy.core.window import Window
+
+
+MAX_OPEN_TRACES = 256  # traces waiting for msg.sent, the oldest are dropped
+
+
+class MessageTracer:
+    """Traces messages from keypress to render and logs the per-hop latency breakdown
+
+    enabled by setting the `trace_messages` environment variable
+    """
+
+    def __init__(self, enabled: bool = False):
+        self.enabled = enabled
+        self.keypresses: dict[str, float] = {}  # trace_id -> keypress time
+
+    def new_trace(self) -> str | None:
+        """Returns a new trace id for an outgoing frame, None when tracing is disabled"""
+        if not self.enabled:
+            return None
+        trace_id = uuid4().hex
+        self.keypresses[trace_id] = time.perf_counter()
+        if len(self.keypresses) > MAX_OPEN_TRACES:
+            # never acked, e.g. dropped with a logout
+            del self.keypresses[next(iter(self.keypresses))]
+        return trace_id
+
+    def sent(self, reply: dict, arrived: float):
+        """Reports the latency of a message sent by this client once it's rendered"""
+        if not (trace_id := reply.get("trace_id")):
+            return
+        keypress = self.keypresses.pop(trace_id, None)
+        if keypress is None:
+            return
+        round_trip = (arrived - keypress) * 1000
+        timings = reply.get("timings") or {}
+
+        def report(rendered: float):
+            Logger.info(
+                f"Trace: {trace_id} keypress->msg.sent {round_trip:.2f}ms "
+                f"(server {format_timings(timings)}, "
+                f"network {round_trip - timings.get('total', 0):.2f}ms), "
+                f"render {(rendered - arrived) * 1000:.2f}ms"
+            )
+
+        self.on_rendered(report)
+
+    def recv(self, reply: dict, arrived: float):
+        """Reports the latency of a message received from the other user once it's rendered"""
+        if not (trace_id := reply.get("trace_id")):
+            return
+        timings = reply.get("timings") or {}
+        # wall clocks of two machines are compared here, so this is only an estimate
+        since_keypress = (datetime.now().timestamp() - float(reply["timestamp"])) * 1000
+
+        def report(rendered: float):
+            Logger.info(
+                f"Trace: {trace_id} keypress->msg.recv ~{since_keypress:.2f}ms "
+                f"(server {format_timings(timings)}), "
+                f"render {(rendered - arrived) * 1000:.2f}ms"
+            )
+
+        self.on_rendered(report)
+
+    @staticmethod
+    def on_rendered(callback):
+        """Calls callback with the current time after the next frame is drawn"""
+
+        def flipped(*args):
+            Window.unbind(on_flip=flipped)
+            callback(time.perf_counter())
+
+        Window.bind(on_flip=flipped)
+
+
+def format_timings(timings: dict) -> str:
+    """Formats server side spans as `hop time, ...`"""
+    return ", ".join(f"{hop} {value:.2f}ms" for hop, value in timings.items())
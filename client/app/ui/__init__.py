@@ -1,15 +1,19 @@
 from __future__ import annotations
 
+import math
 import os
+import time
+import uuid
 from datetime import datetime, timedelta
 
-from kivy import Logger
 from kivy.animation import Animation
 from kivy.clock import Clock
 from kivy.core.window import Window
-from kivy.properties import BooleanProperty, StringProperty
-from kivy.uix.screenmanager import ScreenManager
-from kivy.uix.scrollview import ScrollView
+from kivy.lang.builder import Builder
+from kivy.metrics import dp
+from kivy.properties import BooleanProperty, NumericProperty, StringProperty
+from kivy.uix.recycleview import RecycleView
+from kivy.uix.recycleview.views import RecycleDataViewBehavior
 from kivy.utils import get_hex_from_color
 from kivymd.app import MDApp
 from kivymd.uix.button import BaseButton
@@ -20,7 +24,27 @@ from kivymd.uix.list import OneLineListItem
 from kivymd.uix.screen import MDScreen
 from kivymd.uix.textfield import MDTextField
 
-from ..utils import Colors
+from ..utils import Colors, app_dir
+
+# every row of the message list has the height of a one line item
+MESSAGE_HEIGHT = dp(48)
+HISTORY_PAGE = 50  # older messages requested at once when scrolling up
+TYPING_DEBOUNCE = 0.3  # secs the text has to rest before it is sent to the other user
+TYPING_MAX_INTERVAL = 1.0  # while it keeps changing it is still sent this often
+TYPING_TIMEOUT = 5.0  # secs without changes after which the user stopped typing
+
+
+loaded_kv: set[str] = set()  # names of the kv files loaded so far
+
+
+def load_kv(name: str):
+    """Loads a kv file of ui/kv_files the first time a widget needs its rules
+
+    :returns the root widget of the file, if it has one
+    """
+    if name not in loaded_kv:
+        loaded_kv.add(name)
+        return Builder.load_file(str(app_dir / f"ui/kv_files/{name}.kv"))
 
 
 def days_hours_minutes_seconds(td: timedelta) -> tuple[int, int, int, int]:
@@ -68,26 +92,31 @@ class ChatItem(MDGridLayout):
     custom_id: str = StringProperty()
     last_seen: str = StringProperty(defaultvalue="Never")
     msg_count: str = StringProperty(defaultvalue="0")
+    online: bool = BooleanProperty(False)
+    timestamp: float = NumericProperty(0)  # of the latest message received
 
     def __init__(self, **kwargs):
+        load_kv("chat_item")
         super(ChatItem, self).__init__(**kwargs)
         self.app = MDApp.get_running_app()
-        self.timestamp: float = 0.0
         ChatItem.Items.update({self.custom_id: self})
 
+    def on_timestamp(self, instance, timestamp):
+        """Updates last seen right away when a message arrives"""
+        self.app.last_seen_ticker.update(self)
+
+    def on_online(self, instance, online):
+        """Last seen isn't shown while the other user is online, it is brought up to date after"""
+        if not online:
+            self.app.last_seen_ticker.update(self)
+
     def on_touch_down(self, touch) -> bool:
         """Event Fired everytime mouse is released to tap is released."""
         if self.collide_point(*touch.pos):
             self.animate(md_bg_color=Colors.primary_bg, duration=0.2)
-            screen_manager: ScreenManager
-            screen_manager = MDApp.get_running_app().root.ids["chats_screen_manager"]
-            if screen_manager.has_screen(self.custom_id):
-                # switch to the corresponding chat screen
-                screen_manager.current = self.custom_id
-                return True
-            else:
-                Logger.info(f"{self.custom_id} screen not found")
-            return False
+            # switch to the corresponding chat screen, it is built the first time
+            self.app.open_chat(self.custom_id).mark_read()
+            return True
 
     def on_touch_up(self, touch):
         """Fired everytime window dispatches an `on_touch_up` event"""
@@ -99,20 +128,77 @@ class ChatItem(MDGridLayout):
         anim = Animation(duration=duration, **kwargs)
         anim.start(self)
 
-    def set_last_seen(self, dt):
-        """Updates last seen is called every second by a callback"""
-        days, hours, minutes, secs = days_hours_minutes_seconds(
-            datetime.now() - datetime.fromtimestamp(float(self.timestamp))
-        )
-        if days > 0:
-            last_seen = f"{days}d"
-        elif hours > 0:
-            last_seen = f"{hours}h"
-        elif minutes > 0:
-            last_seen = f"{minutes}m"
+
+def last_seen_text(elapsed: float) -> tuple[str, float]:
+    """Last seen label for secs elapsed since the latest message
+
+    :returns the label and the secs until it changes
+    """
+    for unit, size in (("d", 86400), ("h", 3600), ("m", 60)):
+        if elapsed >= size:
+            count = int(elapsed // size)
+            return f"{count}{unit} ago", (count + 1) * size - elapsed
+    secs = int(max(elapsed, 0))
+    return f"{secs}s ago", secs + 1 - elapsed
+
+
+class LastSeenTicker:
+    """Keeps the last seen labels of the chats in view current with a single Clock event
+
+    every chat is only updated when its label changes, so a chat seen 3h ago is next updated
+    when it turns 4h, and the event fires for the next change of a chat in view only.
+    """
+
+    def __init__(self):
+        self.due: dict[str, float] = {}  # custom_id -> time.time() its label changes at
+        self.event = None
+        self.refresh = Clock.create_trigger(self.tick)  # after scrolling or a resize
+
+    def update(self, chat: ChatItem):
+        """Brings the label of a chat up to date, e.g. when a message arrived"""
+        self.set_label(chat, time.time())
+        self.refresh()
+
+    def set_label(self, chat: ChatItem, now: float):
+        """Sets the label of a chat and when it changes next, unchanged labels aren't dispatched"""
+        if chat.timestamp:
+            text, change_in = last_seen_text(now - chat.timestamp)
         else:
-            last_seen = f"{secs % 60}s"
-        self.last_seen = f"{last_seen} ago"
+            text, change_in = "Never", math.inf
+        if chat.last_seen != text:
+            chat.last_seen = text
+        self.due[chat.custom_id] = now + change_in
+
+    def in_view(self, chat: ChatItem) -> bool:
+        """Checks if a chat is scrolled into the chat list"""
+        root = MDApp.get_running_app().root
+        if root.ids["app_screen_manager"].current != "app" or not chat.parent:
+            return False
+        view = root.ids["chat_list_scroll_view"]
+        chat_y = chat.to_window(*chat.pos)[1]
+        view_y = view.to_window(*view.pos)[1]
+        return chat_y < view_y + view.height and chat_y + chat.height > view_y
+
+    def tick(self, *args):
+        """Updates the chats in view whose label changed and arms the event for the next one"""
+        if self.event:
+            self.event.cancel()
+        now = time.time()
+        next_change = math.inf
+        for custom_id, chat in ChatItem.Items.items():
+            if chat.online or not self.in_view(chat):
+                continue  # brought up to date once they show last seen again
+            if self.due.get(custom_id, 0) <= now:
+                self.set_label(chat, now)
+            next_change = min(next_change, self.due[custom_id])
+        if next_change < math.inf:
+            self.event = Clock.schedule_once(self.tick, next_change - now)
+
+    def clear(self):
+        """Forgets every chat, e.g. on logout"""
+        self.due.clear()
+        if self.event:
+            self.event.cancel()
 
 
 class TitleBar(MDFloatLayout):
@@ -152,31 +238,29 @@ class TitleBar(MDFloatLayout):
                     self.app.root_window.maximize()
 
 
-class OneLineListItemAligned(OneLineListItem):
-    """OneLineListItem that allows horizontal alignment"""
+class ChatMessageRow(RecycleDataViewBehavior, OneLineListItem):
+    """Row of the message list of a chat
 
-    def __init__(
-        self,
-        halign,
-        message_id: str = None,
-        timestamp: float | str = None,
-        user_id: str = None,
-        **kwargs,
-    ):
-        super(OneLineListItemAligned, self).__init__(**kwargs)
-        self.user_id = user_id
-        if message_id:
-            self.message_id: str = message_id
-        if timestamp:
-            if isinstance(timestamp, str) and timestamp.isdigit():
-                timestamp = float(timestamp)
-            self.timestamp: float = timestamp
-        else:
-            self.timestamp = datetime.now().timestamp()
+    only the rows in view exist, the RecycleView reuses them for other messages as it
+    scrolls, so everything a row shows must come from its data dict.
+    """
 
+    halign: str = StringProperty("left")
+    message_id: str = StringProperty()
+    user_id: str = StringProperty()
+    timestamp: float = NumericProperty()
+    seq: int = NumericProperty(-1)
+
+    def __init__(self, **kwargs):
+        super(ChatMessageRow, self).__init__(**kwargs)
+        self.received_bg_color = list(self.md_bg_color)
+
+    def on_halign(self, instance, halign):
+        """Aligns the text, sent messages are aligned right and highlighted"""
         self.ids._lbl_primary.halign = halign
-        if halign == "right":
-            self.md_bg_color = Colors.primary_bg_text
+        self.md_bg_color = (
+            Colors.primary_bg_text if halign == "right" else self.received_bg_color
+        )
 
 
 def get_focus(text_input_field: MDTextField):
@@ -191,21 +275,105 @@ def get_focus(text_input_field: MDTextField):
     Clock.schedule_once(get_focus_wrapper)
 
 
+class TypingEmitter:
+    """Shows the other user of a chat what is being typed, without a frame per key press
+
+    only changes of the text are sent, once it rested for TYPING_DEBOUNCE secs or at least every
+    TYPING_MAX_INTERVAL secs while it keeps changing. A stopped frame follows when the input is
+    cleared, the message is sent or the text wasn't touched for TYPING_TIMEOUT secs.
+    """
+
+    def __init__(self, screen: ChatMessagesScreen):
+        self.screen = screen
+        self.text = ""  # of the chat input
+        self.sent_text = ""
+        self.typing = False  # whether the other user was told so
+        self.first_change: float | None = (
+            None  # time.monotonic() of the oldest unsent one
+        )
+        self.flush_event = Clock.create_trigger(self.flush, TYPING_DEBOUNCE)
+        self.stop_event = Clock.create_trigger(self.stop, TYPING_TIMEOUT)
+
+    def changed(self, text: str):
+        """Called with the text of the chat input whenever it changes"""
+        if text == self.text:
+            return
+        self.text = text
+        if not text:
+            self.stop()
+            return
+        now = time.monotonic()
+        if self.first_change is None:
+            self.first_change = now
+        # cancelled triggers are armed again with their full timeout
+        self.flush_event.cancel()
+        self.stop_event.cancel()
+        self.stop_event()
+        if now - self.first_change >= TYPING_MAX_INTERVAL:
+            self.flush()
+        else:
+            self.flush_event()
+
+    def flush(self, *args):
+        """Sends the text unless the other user has it already"""
+        self.flush_event.cancel()
+        self.first_change = None
+        if self.text and self.text != self.sent_text:
+            self.send("typing", self.text)
+            self.sent_text = self.text
+            self.typing = True
+
+    def stop(self, *args):
+        """Tells the other user that the user stopped typing, unsent changes are dropped"""
+        self.flush_event.cancel()
+        self.stop_event.cancel()
+        self.first_change = None
+        if self.typing:
+            self.send("stopped", "")
+            self.sent_text = ""
+            self.typing = False
+
+    def send(self, state: str, text: str):
+        """Queues a msg.typing.send, a queued one of the room is superseded by it"""
+        self.screen.app.send_data(
+            value={
+                "type": "msg.typing.send",
+                "room_id": self.screen.name,
+                "other_id": self.screen.other_user,
+                "state": state,
+                "timestamp": str(time.time()),
+                "data": text,
+            }
+        )
+
+
 class ChatMessagesScreen(MDScreen):
     """Class representing a chat screen."""
 
     disable_chat_input: BooleanProperty(False)
 
     def __init__(self, other_user: str, **kwargs):
+        load_kv("chat_message")
         self.other_user = other_user
+        self.typing_emitter = TypingEmitter(self)
         super(ChatMessagesScreen, self).__init__(**kwargs)
         from ..lib.kivy_manager import ClientUI
 
         self.app: ClientUI = MDApp.get_running_app()
-        self.messages: dict[str, list[OneLineListItemAligned, ...]] = {
+        # data of the rows of every message shown, per sender
+        self.messages: dict[str, list[dict, ...]] = {
             self.app.user_id: [],
             self.other_user: [],
         }
+        # ids of the messages shown, to skip redeliveries
+        self.message_ids: set[str] = set()
+        self.last_seq = -1  # seq of the latest message of the room shown
+        self.first_seq = -1  # seq of the oldest message of the room shown
+        self.loading_history = False
+        self.history_complete = False
+        self.read_seq = -1  # seq up to which the room was marked read
+        self.last_sent_seq = -1
+        self.other_read_seq = -1  # seq up to which the other user read the room
         Window.bind(on_key_down=self._on_keyboard_down)
         self.times_validated = 0
         self.message_sent_spam = 0  # messages sent in spam_time
@@ -225,16 +393,6 @@ class ChatMessagesScreen(MDScreen):
                 else:
                     self.times_validated += 1
 
-            data = {
-                "type": "msg.typing.send",
-                "room_id": self.name,
-                "other_username": self.other_user,
-                "other_id": self.app.get_other_user_id(self.name),
-                "timestamp": str(datetime.now().timestamp()),
-                "data": chat_input.text,
-            }
-            self.app.send_data(value=data)
-
         if not self.allow_single_enter and self.times_validated == 2:
             send_message = True
             self.times_validated = 0
@@ -244,7 +402,9 @@ class ChatMessagesScreen(MDScreen):
             if len(messages) >= self.app.spam_count:
                 secs = days_hours_minutes_seconds(
                     datetime.now()
-                    - datetime.fromtimestamp(messages[-self.app.spam_count].timestamp)
+                    - datetime.fromtimestamp(
+                        messages[-self.app.spam_count]["timestamp"]
+                    )
                 )[-1]
                 if secs % 60 <= self.app.spam_time:
                     if self.message_sent_spam >= self.app.spam_count:
@@ -280,53 +440,220 @@ class ChatMessagesScreen(MDScreen):
                 "data": message,
                 "timestamp": str(datetime.now().timestamp()),
                 "room_id": self.name,
+                # lets the server drop retries of a message it already has
+                "client_message_id": str(uuid.uuid4()),
             }
+            if trace_id := self.app.tracer.new_trace():
+                msg_data["trace_id"] = trace_id
+            self.typing_emitter.stop()
             self.disable_chat_input = True
             get_focus(self.ids.chat_input)
             self.app.send_data(value=msg_data)
 
+    def message_row(
+        self,
+        message: str,
+        user_id: str,
+        text_color: list,
+        halign: str = "left",
+        message_id: str = "",
+        timestamp: str | float = "",
+        seq: int = -1,
+    ) -> dict:
+        """Data of the row showing a message"""
+        try:
+            timestamp = float(timestamp)
+        except ValueError:
+            timestamp = datetime.now().timestamp()
+        return {
+            "text": message,
+            "theme_text_color": "Custom",
+            "text_color": text_color,
+            "halign": halign,
+            "message_id": message_id,
+            "user_id": user_id,
+            "timestamp": timestamp,
+            "seq": seq,
+        }
+
     def add_message(
         self,
         message: str,
         user_id: str,
         text_color: list,
         halign: str = "left",
-        clear_input: bool = False,
         message_id: str = "",
         timestamp: str = "",
-    ) -> OneLineListItemAligned:
+        seq: int = -1,
+    ) -> dict:
         """Adds a received message to the screen."""
-        if clear_input:
-            message = self.ids["chat_input"].text
-            self.ids["chat_input"].text = ""
-
-        chat_message = OneLineListItemAligned(
-            halign,
-            text=message,
-            theme_text_color="Custom",
-            text_color=text_color,
-            message_id=message_id,
-            timestamp=timestamp,
-            user_id=user_id,
+        chat_message = self.message_row(
+            message, user_id, text_color, halign, message_id, timestamp, seq
         )
-        self.ids["chat_list"].add_widget(chat_message)
+        self.ids["chat_list"].data.append(chat_message)
+        if message_id:
+            self.message_ids.add(message_id)
 
         if user_id == self.app.user_id:
             self.messages[self.app.user_id].append(chat_message)
         else:
             self.messages[self.other_user].append(chat_message)
 
-        # increase message count in UI
-        chat = ChatItem.Items.get(self.name)
-        chat.msg_count = str(int(chat.msg_count) + 1)
-
         return chat_message
 
-    def scroll_to_message(self, widget: OneLineListItemAligned):
-        """Scrolls the messages view to the specified message"""
-        list_scroll_view: ScrollView
-        list_scroll_view = self.ids["list_scroll_view"]
-        list_scroll_view.scroll_to(widget)
+    def new_rows(self, messages: list[dict]) -> list[dict]:
+        """Rows of the messages of a room (as the server sends them) that aren't shown yet"""
+        rows = []
+        for message in messages:
+            sent = message["sender"] == str(self.app.user_id)
+            self.add_seq(message["seq"], sent=sent)
+            if message["message_id"] in self.message_ids:
+                continue
+            self.message_ids.add(message["message_id"])
+            rows.append(
+                self.message_row(
+                    message["message"],
+                    message["sender"],
+                    Colors.text_medium if sent else Colors.text_dark,
+                    "right" if sent else "left",
+                    message["message_id"],
+                    message["timestamp"],
+                    message["seq"],
+                )
+            )
+        return rows
+
+    def load_room(self, room: dict):
+        """Shows the messages and read cursors of a room as user.login.success sends it
+
+        after a reconnect only the messages the screen misses are added, the rest stay as they are.
+        """
+        if expired := room.get("expired"):
+            self.remove_messages(set(expired))
+        rows = self.new_rows(room["messages"])
+        # the messages are added to the list at once, so it is laid out once
+        self.ids["chat_list"].data.extend(rows)
+        for row in rows:
+            self.messages[self.sender_of(row)].append(row)
+        self.read_seq = max(self.read_seq, room["read_seq"])
+        for seq in room["read_by"].values():
+            self.set_other_read_seq(seq)
+        if rows:
+            self.scroll_to_end()
+
+    def sender_of(self, row: dict) -> str:
+        """Key of self.messages the row belongs to"""
+        return (
+            self.app.user_id
+            if row["user_id"] == str(self.app.user_id)
+            else self.other_user
+        )
+
+    def release(self) -> dict:
+        """Detaches the screen from the window before it is dropped
+
+        :returns its messages and read cursors, see to_room
+        """
+        Window.unbind(on_key_down=self._on_keyboard_down)
+        self.typing_emitter.stop()
+        return self.to_room()
+
+    def to_room(self) -> dict:
+        """Messages and read cursors of the screen in the shape load_room takes"""
+        return {
+            "messages": [
+                {
+                    "message_id": row["message_id"],
+                    "sender": row["user_id"],
+                    "message": row["text"],
+                    "timestamp": row["timestamp"],
+                    "seq": row["seq"],
+                }
+                for row in self.ids["chat_list"].data
+            ],
+            "read_seq": self.read_seq,
+            "read_by": {self.other_user: self.other_read_seq},
+        }
+
+    def prepend_messages(self, messages: list[dict]):
+        """Adds older messages of msg.history above the ones shown, keeping the scroll position"""
+        self.loading_history = False
+        if not messages:
+            self.history_complete = True
+            return
+        rows = self.new_rows(messages)
+        for user_id in self.messages:
+            self.messages[user_id] = [
+                row for row in rows if self.sender_of(row) == user_id
+            ] + self.messages[user_id]
+        chat_list: RecycleView = self.ids["chat_list"]
+        # the rows are added above the view, so the distance to the bottom stays the same
+        scrollable = max(chat_list.layout_manager.height - chat_list.height, 0)
+        from_bottom = chat_list.scroll_y * scrollable
+        chat_list.data = rows + chat_list.data
+        if scrollable := scrollable + len(rows) * MESSAGE_HEIGHT:
+            chat_list.scroll_y = min(from_bottom / scrollable, 1)
+
+    def on_messages_scroll(self, scroll_y: float):
+        """Requests older messages when the message list is scrolled to the top"""
+        if (
+            scroll_y >= 1
+            and self.first_seq > 0
+            and not self.loading_history
+            and not self.history_complete
+        ):
+            self.loading_history = True
+            self.app.send_data(
+                value={
+                    "type": "msg.history",
+                    "room_id": self.name,
+                    "before": self.first_seq,
+                    "n": HISTORY_PAGE,
+                }
+            )
+
+    def remove_messages(self, message_ids: set[str]):
+        """Removes messages from the screen, e.g. when their ttl ran out"""
+        chat_list: RecycleView = self.ids["chat_list"]
+        chat_list.data = [
+            row for row in chat_list.data if row["message_id"] not in message_ids
+        ]
+        for user_id, messages in self.messages.items():
+            self.messages[user_id] = [
+                row for row in messages if row["message_id"] not in message_ids
+            ]
+
+    def add_seq(self, seq: int, sent: bool = False):
+        """Keeps track of the latest and oldest message of the room"""
+        self.last_seq = max(self.last_seq, seq)
+        self.first_seq = seq if self.first_seq < 0 else min(self.first_seq, seq)
+        if sent:
+            self.last_sent_seq = max(self.last_sent_seq, seq)
+            self.show_seen()
+
+    def mark_read(self):
+        """Tells the server that the user has seen every message of the room"""
+        ChatItem.Items.get(self.name).msg_count = "0"
+        if self.last_seq > self.read_seq:
+            self.read_seq = self.last_seq
+            self.app.send_data(
+                value={"type": "room.read", "room_id": self.name, "seq": self.last_seq}
+            )
+
+    def set_other_read_seq(self, seq: int):
+        """Called when a read receipt of the other user arrives"""
+        self.other_read_seq = max(self.other_read_seq, seq)
+        self.show_seen()
+
+    def show_seen(self):
+        """Shows whether the other user has read the latest message sent"""
+        if not self.ids["typing"].text or self.ids["typing"].text == "Seen":
+            seen = 0 <= self.last_sent_seq <= self.other_read_seq
+            self.ids["typing"].text = "Seen" if seen else ""
+
+    def scroll_to_end(self):
+        """Scrolls the messages view to the latest message"""
+        self.ids["chat_list"].scroll_y = 0
 
     def on_disable_chat_input(self, instance, value):
         """Fired every time disable_chat_input changes value"""
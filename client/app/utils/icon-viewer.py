@@ -1,3 +1,4 @@
+from kivy.clock import Clock
 from kivy.lang import Builder
 from kivy.properties import StringProperty
 from kivy.uix.screenmanager import Screen
@@ -32,7 +33,7 @@ Builder.load_string(
             MDTextField:
                 id: search_field
                 hint_text: 'Search icon'
-                on_text: root.set_list_md_icons(self.text, True)
+                on_text: root.search(self.text)
 
         RecycleView:
             id: rv
@@ -50,6 +51,58 @@ Builder.load_string(
 )
 
 
+GRAM_SIZE = 3  # longest substring of the names that is indexed
+SEARCH_DEBOUNCE = 0.15  # secs the query has to rest before the list is filtered
+
+
+class IconIndex:
+    """N-gram index of the icon names, finds the names containing a query without scanning all
+
+    every substring of up to GRAM_SIZE chars maps to the ascending ids of the names that
+    contain it. Queries of that length are a lookup, longer ones only check the names
+    containing their rarest gram, or the previous result when they extend the previous query.
+    """
+
+    def __init__(self, names: list[str]):
+        self.names = names
+        self.postings: dict[str, list[int]] = {}
+        for name_id, name in enumerate(names):
+            for gram in grams(name, GRAM_SIZE):
+                self.postings.setdefault(gram, []).append(name_id)
+        self.query = ""
+        self.result = list(range(len(names)))  # ids of the names matching query
+
+    def search(self, query: str) -> list[int]:
+        """Ids of the names containing query, in the order of names"""
+        if query == self.query:
+            return self.result
+        if len(query) <= GRAM_SIZE:
+            result = self.postings.get(query, []) if query else range(len(self.names))
+        else:
+            if self.query and self.query in query:
+                candidates = self.result  # the result of an extended query only shrinks
+            else:  # the names containing its rarest gram
+                candidates = min(
+                    (
+                        self.postings.get(query[start : start + GRAM_SIZE], [])
+                        for start in range(len(query) - GRAM_SIZE + 1)
+                    ),
+                    key=len,
+                )
+            result = [name_id for name_id in candidates if query in self.names[name_id]]
+        self.query, self.result = query, list(result)
+        return self.result
+
+
+def grams(text: str, size: int) -> set[str]:
+    """Every substring of text of 1 up to size chars"""
+    return {
+        text[start : start + length]
+        for length in range(1, size + 1)
+        for start in range(len(text) - length + 1)
+    }
+
+
 class CustomOneLineIconListItem(OneLineIconListItem):
     """Item in which icon will be placed."""
 
@@ -59,26 +112,36 @@ class CustomOneLineIconListItem(OneLineIconListItem):
 class PreviousMDIcons(Screen):
     """Screen to Show all icons"""
 
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.index = IconIndex(list(md_icons.keys()))
+        # the rows of every icon are built once and shared by every search result
+        self.rows = [
+            {
+                "viewclass": "CustomOneLineIconListItem",
+                "icon": name_icon,
+                "text": name_icon,
+                "callback": lambda x: x,
+            }
+            for name_icon in self.index.names
+        ]
+        self.query = ""
+        self.search_trigger = Clock.create_trigger(
+            lambda dt: self.set_list_md_icons(self.query, True), SEARCH_DEBOUNCE
+        )
+
+    def search(self, text: str):
+        """Filters the icons once the query stopped changing for SEARCH_DEBOUNCE secs"""
+        self.query = text
+        # cancelled triggers are armed again with their full timeout
+        self.search_trigger.cancel()
+        self.search_trigger()
+
     def set_list_md_icons(self, text="", search=False):
         """Builds a list of icons for the screen MDIcons."""
-
-        def add_icon_item(name_icon):
-            self.ids.rv.data.append(
-                {
-                    "viewclass": "CustomOneLineIconListItem",
-                    "icon": name_icon,
-                    "text": name_icon,
-                    "callback": lambda x: x,
-                }
-            )
-
-        self.ids.rv.data = []
-        for name_icon in md_icons.keys():
-            if search:
-                if text in name_icon:
-                    add_icon_item(name_icon)
-            else:
-                add_icon_item(name_icon)
+        name_ids = self.index.search(text if search else "")
+        # the data is replaced at once, so the list is laid out once
+        self.ids.rv.data = [self.rows[name_id] for name_id in name_ids]
 
 
 class MainApp(MDApp):
@@ -1,15 +1,69 @@
 """This is where the main backend app will go into"""
 
-from fastapi import FastAPI, WebSocket
+import asyncio
+import os
+import secrets
+import time
+import tracemalloc
+
+from fastapi import Depends, FastAPI, HTTPException, Request, WebSocket
 from fastapi.encoders import jsonable_encoder
 from fastapi.responses import JSONResponse
+from loguru import logger
 
 from .managers import ConnectionManager, DbManager
+from .replication import ChangeLog, Standby
+from .tracing import Tracer
+
+if tracemalloc_frames := int(os.getenv("tracemalloc_frames", "0")):
+    tracemalloc.start(tracemalloc_frames)
 
 app = FastAPI()
 
-db = DbManager("server/users.json", "server/rooms.json")
-connections = ConnectionManager(db)
+# empty values disable that limit
+retention_max_count = os.getenv("retention_max_count", "1000")
+retention_max_age = os.getenv("retention_max_age", "")
+db = DbManager(
+    "server/users.json",
+    "server/rooms.json",
+    max_count=int(retention_max_count) if retention_max_count else None,
+    max_age=float(retention_max_age) if retention_max_age else None,
+    dedupe_size=int(os.getenv("msg_dedupe_size", "256")),
+    pending_max=int(os.getenv("pending_max", "1000")),
+)
+tracer = Tracer()
+connections = ConnectionManager(
+    db,
+    tracer,
+    presence_grace=float(os.getenv("presence_grace", "5")),
+    heartbeat_interval=float(os.getenv("heartbeat_interval", "30")),
+    heartbeat_timeout=float(os.getenv("heartbeat_timeout", "90")),
+    auth_timeout=float(os.getenv("auth_timeout", "60")),
+    receipt_delay=float(os.getenv("receipt_delay", "1")),
+    expiry_batch=float(os.getenv("expiry_batch", "1")),
+)
+# a primary ships its changes on replication_socket, a standby follows the one on standby_of
+replication_socket = os.getenv("replication_socket", "")
+standby_of = os.getenv("standby_of", "")
+change_log = ChangeLog(db, replication_socket) if replication_socket else None
+standby = Standby(db, standby_of) if standby_of else None
+# admin endpoints want admin_token as a bearer token, without one only local clients may use them
+admin_token = os.getenv("admin_token", "")
+
+
+def admin_only(request: Request) -> None:
+    """Dependency refusing an admin endpoint to clients without the admin token"""
+    if admin_token:
+        allowed = secrets.compare_digest(
+            request.headers.get("authorization", ""), f"Bearer {admin_token}"
+        )
+    else:
+        allowed = request.client is not None and request.client.host in (
+            "127.0.0.1",
+            "::1",
+        )
+    if not allowed:
+        raise HTTPException(status_code=403, detail="admin only")
 
 
 @app.route("/ws")
@@ -19,12 +73,120 @@ async def hello(*args):
     return JSONResponse(content=jsonable_encoder({"data": "hello"}))
 
 
+@app.get("/metrics")
+async def metrics():
+    """Per-hop latency breakdown of traced frames and session counts"""
+    return JSONResponse(
+        content=jsonable_encoder(
+            {
+                "latency": tracer.summary(),
+                "sessions": {
+                    "active": len(connections.active_sessions),
+                    "reaped": connections.reaped,
+                    "auth_timeouts": connections.auth_timeouts,
+                },
+            }
+        )
+    )
+
+
+@app.get("/debug/memory", dependencies=[Depends(admin_only)])
+async def memory(limit: int = 50):
+    """Session counts and the allocation sites holding the most memory
+
+    allocation sites are only reported when the tracemalloc_frames env variable is set
+    """
+    report = {
+        "sessions": len(connections.active_sessions),
+        "tracing": tracemalloc.is_tracing(),
+    }
+    if tracemalloc.is_tracing():
+        snapshot = tracemalloc.take_snapshot().filter_traces(
+            [tracemalloc.Filter(False, tracemalloc.__file__)]
+        )
+        report["traced_bytes"] = tracemalloc.get_traced_memory()[0]
+        report["sites"] = [
+            {"site": str(stat.traceback), "size": stat.size, "count": stat.count}
+            for stat in snapshot.statistics("lineno")[:limit]
+        ]
+    return JSONResponse(content=jsonable_encoder(report))
+
+
+@app.get("/replication")
+async def replication():
+    """Role of this server and the state of its replication"""
+    report = {"role": "standby" if app.state.following else "primary"}
+    if standby:
+        report["standby"] = standby.status()
+    if change_log:
+        report["standbys"] = len(change_log.standbys)
+        report["shipped"] = change_log.shipped
+        report["position"] = change_log.position
+    return JSONResponse(content=jsonable_encoder(report))
+
+
+@app.post("/replication/promote", dependencies=[Depends(admin_only)])
+async def promote():
+    """Turns a standby into a primary that accepts clients, takes as long regardless of data size"""
+    if not app.state.following:
+        return JSONResponse(content={"promoted": False, "role": "primary"})
+    started = time.perf_counter()
+    app.state.following.cancel()
+    try:
+        await app.state.following
+    except asyncio.CancelledError:
+        pass
+    except Exception:
+        # the store has whatever the standby applied before it stopped following
+        logger.exception("the standby had stopped following the primary")
+    app.state.following = None
+    if change_log:
+        await change_log.start()
+    connections.schedule_expiry()
+    return JSONResponse(
+        content=jsonable_encoder(
+            {
+                "promoted": True,
+                "secs": time.perf_counter() - started,
+                **standby.status(),
+            }
+        )
+    )
+
+
 @app.websocket("/ws")
 async def websocket_endpoint(websocket: WebSocket):
     """Websocket entrypoint"""
+    if app.state.following:
+        # the store of a standby only changes through the primary
+        await websocket.close(code=1013)
+        return
     await connections.create_session(websocket)
 
 
+@app.on_event("startup")
+async def start_reaper():
+    """Starts reaping sessions that stopped answering heartbeats"""
+    app.state.reaper = asyncio.create_task(connections.reap_sessions())
+
+
+@app.on_event("startup")
+async def start_replication():
+    """Follows the primary when this is a standby, else ships changes to standbys"""
+    app.state.following = None
+    if standby:
+        app.state.following = asyncio.create_task(standby.run())
+    elif change_log:
+        await change_log.start()
+
+
+@app.on_event("startup")
+async def start_expiry():
+    """Expires messages whose ttl ran out, a standby leaves that to its primary"""
+    if not app.state.following:
+        connections.schedule_expiry()
+
+
 @app.on_event("shutdown")
 async def close_db():
     """Saves the database"""
@@ -0,0 +1,148 @@
+"""Compressed, immutable on-disk segments of messages that left a room's hot window"""
+
+import gzip
+import json
+import os
+from bisect import bisect_right
+from collections import OrderedDict
+from typing import Dict, Iterable, List, Tuple
+
+from .messages import expire
+
+
+class MessageArchive:
+    """Stores archived messages of every room as gzipped json segments
+
+    segments live in `<directory>/<room_id>/<first_seq>-<last_seq>.json.gz` and are only
+    rewritten to drop the texts of expired messages, decoded segments are kept in a small LRU
+    cache.
+    """
+
+    def __init__(self, directory: str, cache_size: int = 32):
+        self.directory = directory
+        self.cache_size = cache_size
+        self.segments: Dict[
+            str, List[Tuple[int, int]]
+        ] = {}  # room_id -> [(first, last)]
+        self.cache: OrderedDict[str, List[Dict]] = OrderedDict()
+
+    def room_segments(self, room_id: str) -> List[Tuple[int, int]]:
+        """Sorted (first_seq, last_seq) of the segments of a room, none of them overlap"""
+        if room_id not in self.segments:
+            room_dir = os.path.join(self.directory, room_id)
+            found = []
+            if os.path.isdir(room_dir):
+                for name in os.listdir(room_dir):
+                    if name.endswith(".json.gz"):
+                        first, last = name.removesuffix(".json.gz").split("-")
+                        found.append((int(first), int(last)))
+            segments = []
+            for first, last in sorted(found):
+                # left behind by archiving a range twice, the first copy is kept
+                if segments and first <= segments[-1][1]:
+                    continue
+                segments.append((first, last))
+            self.segments[room_id] = segments
+        return self.segments[room_id]
+
+    def discard_from(self, room_id: str, seq: int) -> None:
+        """Deletes the segments of a room starting at or past seq
+
+        those were written after the room was last saved with seq as its first hot message, the
+        saved hot window still has their messages.
+        """
+        segments = self.room_segments(room_id)
+        while segments and segments[-1][0] >= seq:
+            path = self.segment_path(room_id, *segments.pop())
+            self.cache.pop(path, None)
+            os.remove(path)
+
+    def segment_path(self, room_id: str, first: int, last: int) -> str:
+        """Path of a segment"""
+        return os.path.join(
+            self.directory, room_id, f"{first:012d}-{last:012d}.json.gz"
+        )
+
+    def write_segment(self, room_id: str, messages: List[Dict]) -> None:
+        """Writes messages (with consecutive seqs) as a new segment of the room"""
+        segments = self.room_segments(room_id)
+        if segments:  # seqs that are archived already are never archived twice
+            messages = [
+                message for message in messages if message["seq"] > segments[-1][1]
+            ]
+        if not messages:
+            return
+        first, last = messages[0]["seq"], messages[-1]["seq"]
+        path = self.segment_path(room_id, first, last)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        dump_segment(path, messages)
+        segments.append((first, last))
+
+    def read_segment(
+        self, room_id: str, first: int, last: int, cache: bool = True
+    ) -> List[Dict]:
+        """Messages of a segment
+
+        :param cache False for one-off scans that must not evict the segments being served
+        """
+        path = self.segment_path(room_id, first, last)
+        if path in self.cache:
+            self.cache.move_to_end(path)
+            return self.cache[path]
+        with gzip.open(path, "rt") as segment_file:
+            messages = json.load(segment_file)
+        if not cache:
+            return messages
+        self.cache[path] = messages
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return messages
+
+    def get_messages(self, room_id: str, before: int, n: int) -> List[Dict]:
+        """Up to n latest archived messages of a room with seq < before, oldest first"""
+        selected: List[Dict] = []
+        for first, last in reversed(self.room_segments(room_id)):
+            if len(selected) >= n:
+                break
+            if first >= before:
+                continue
+            messages = [
+                message
+                for message in self.read_segment(room_id, first, last)
+                if message["seq"] < before
+            ]
+            selected = messages[-(n - len(selected)) :] + selected
+        return selected
+
+    def expire(self, room_id: str, seqs: Iterable[int]) -> List[Tuple[Dict, str]]:
+        """Drops the texts of archived messages, every segment touched is rewritten once
+
+        :returns the tombstones of the messages that expired now with the texts they had
+        """
+        segments = self.room_segments(room_id)
+        by_segment: Dict[Tuple[int, int], List[int]] = {}
+        for seq in seqs:
+            index = bisect_right(segments, (seq, float("inf"))) - 1
+            if index >= 0 and segments[index][0] <= seq <= segments[index][1]:
+                by_segment.setdefault(segments[index], []).append(seq)
+        expired = []
+        for (first, last), segment_seqs in by_segment.items():
+            # the cached list is changed in place, so the cache stays current
+            messages = self.read_segment(room_id, first, last)
+            texts = [
+                (messages[seq - first], text)
+                for seq in segment_seqs
+                if (text := expire(messages[seq - first])) is not None
+            ]
+            if texts:
+                dump_segment(self.segment_path(room_id, first, last), messages)
+                expired += texts
+        return expired
+
+
+def dump_segment(path: str, messages: List[Dict]) -> None:
+    """Writes messages to a segment file"""
+    # write to a temp file first so a crash never leaves a partial segment behind
+    with gzip.open(path + ".tmp", "wt") as segment_file:
+        json.dump(messages, segment_file)
+    os.replace(path + ".tmp", path)
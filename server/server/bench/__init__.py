@@ -0,0 +1 @@
+"""Benchmarks for the server, run them from the `server` directory e.g. `python -m server.bench.load`"""
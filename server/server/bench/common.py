@@ -0,0 +1,197 @@
+"""Helpers shared by the benchmarks"""
+
+import json
+import os
+import pathlib
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+from datetime import datetime
+from typing import Dict, List
+
+from ..tracing import percentile
+
+PACKAGE_ROOT = pathlib.Path(__file__).parents[2]  # directory containing `server`
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+
+
+def latency_summary(samples: List[float]) -> Dict:
+    """Count and p50/p95/p99/max of latency samples in ms"""
+    ordered = sorted(samples)
+    return {
+        "count": len(ordered),
+        "p50": round(percentile(ordered, 50), 3),
+        "p95": round(percentile(ordered, 95), 3),
+        "p99": round(percentile(ordered, 99), 3),
+        "max": round(ordered[-1], 3) if ordered else 0.0,
+    }
+
+
+def raise_fd_limit() -> int:
+    """Raises the soft open files limit to the hard limit, thousands of sockets need it"""
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    return hard
+
+
+class ProcessStats:
+    """Reads CPU time and RSS of a process from /proc (Linux only)"""
+
+    def __init__(self, pid: int):
+        self.pid = pid
+        self.peak_rss = 0
+
+    def cpu_seconds(self) -> float:
+        """User + system CPU time used by the process"""
+        with open(f"/proc/{self.pid}/stat") as stat_file:
+            # the process name can contain spaces so split after it
+            fields = stat_file.read().rsplit(")", 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / CLOCK_TICKS
+
+    def rss(self) -> int:
+        """Resident set size of the process in bytes"""
+        with open(f"/proc/{self.pid}/status") as status_file:
+            for line in status_file:
+                if line.startswith("VmRSS:"):
+                    rss = int(line.split()[1]) * 1024
+                    self.peak_rss = max(self.peak_rss, rss)
+                    return rss
+        return 0
+
+
+class LocalServer:
+    """Runs `server.app:app` with uvicorn on localhost against an empty database in a temp directory"""
+
+    def __init__(
+        self,
+        port: int = 8765,
+        env: Dict = None,
+        data_dir: str = None,
+        start_timeout: float = 15.0,
+    ):
+        self.port = port
+        self.start_timeout = start_timeout
+        self.env = env or {}
+        self.data_dir = pathlib.Path(data_dir or tempfile.mkdtemp(prefix="blak-bench-"))
+        self.process: subprocess.Popen | None = None
+        self.stats: ProcessStats | None = None
+
+    @property
+    def url(self) -> str:
+        """Websocket url of the server"""
+        return f"ws://127.0.0.1:{self.port}/ws"
+
+    def http(self, path: str, method: str = "GET") -> Dict:
+        """Fetches a json endpoint of the server"""
+        request = urllib.request.Request(
+            f"http://127.0.0.1:{self.port}{path}", method=method
+        )
+        with urllib.request.urlopen(request) as reply:
+            return json.loads(reply.read())
+
+    def __enter__(self) -> "LocalServer":
+        # the app opens its database relative to the working directory
+        (self.data_dir / "server").mkdir(parents=True, exist_ok=True)
+        (self.data_dir / "server/users.json").touch(exist_ok=True)
+        (self.data_dir / "server/rooms.json").touch(exist_ok=True)
+        env = {
+            **os.environ,
+            "PYTHONPATH": os.pathsep.join(
+                filter(None, [str(PACKAGE_ROOT), os.getenv("PYTHONPATH")])
+            ),
+            **self.env,
+        }
+        self.log_file = open(self.data_dir / "server.log", "w")
+        self.process = subprocess.Popen(
+            [
+                sys.executable,
+                "-m",
+                "uvicorn",
+                "server.app:app",
+                "--host",
+                "127.0.0.1",
+                "--port",
+                str(self.port),
+                "--log-level",
+                "warning",
+            ],
+            cwd=self.data_dir,
+            env=env,
+            stdout=self.log_file,
+            stderr=subprocess.STDOUT,
+        )
+        self.stats = ProcessStats(self.process.pid)
+        deadline = time.monotonic() + self.start_timeout
+        while time.monotonic() < deadline:
+            try:
+                self.http("/")
+                return self
+            except OSError:
+                if self.process.poll() is not None:
+                    break
+                time.sleep(0.1)
+        self.__exit__()
+        raise RuntimeError(
+            f"benchmark server did not start, see {self.data_dir / 'server.log'}"
+        )
+
+    def __exit__(self, *args) -> None:
+        if self.process and self.process.poll() is None:
+            self.process.terminate()
+            try:
+                self.process.wait(10)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+        self.log_file.close()
+
+
+def save_results(results: Dict, output: str | None) -> None:
+    """Adds run metadata to results and writes them as json"""
+    results["meta"] = {
+        "date": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+    }
+    if output:
+        with open(output, "w") as output_file:
+            json.dump(results, output_file, indent=2)
+        print(f"results saved to {output}")
+
+
+def compare_results(results: Dict, baseline_file: str) -> None:
+    """Prints every numeric metric next to the same metric of a saved run"""
+    with open(baseline_file) as baseline_fp:
+        baseline = json.load(baseline_fp)
+    print(f"\ncompared to {baseline_file}")
+    for key, value, old in _paired_metrics(results, baseline):
+        change = f"{(value - old) / old * 100:+.1f}%" if old else "n/a"
+        print(f"  {key:<45} {old:>14.3f} -> {value:>14.3f} ({change})")
+
+
+def _paired_metrics(current: Dict, baseline: Dict, prefix: str = ""):
+    for key, value in current.items():
+        if key in ("meta", "config") or key not in baseline:
+            continue
+        name = f"{prefix}{key}"
+        if isinstance(value, dict) and isinstance(baseline[key], dict):
+            yield from _paired_metrics(value, baseline[key], f"{name}.")
+        elif isinstance(value, (int, float)) and isinstance(
+            baseline[key], (int, float)
+        ):
+            yield name, value, baseline[key]
+
+
+def print_results(results: Dict, prefix: str = "") -> None:
+    """Pretty prints nested results"""
+    for key, value in results.items():
+        if isinstance(value, dict):
+            print(f"{prefix}{key}:")
+            print_results(value, prefix + "  ")
+        else:
+            print(f"{prefix}{key}: {value}")
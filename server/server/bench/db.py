@@ -0,0 +1,245 @@
+"""Micro-benchmarks of DbManager operations on synthetic production sized datasets
+
+the dataset (users.json/rooms.json) is generated once into --data-dir and reused by later runs,
+`--scale` shrinks the default 10^5 users, 10^5 rooms and 10^7 messages for quick runs.
+
+usage: python -m server.bench.db --scale 0.1 --output run.json [--baseline old.json]
+"""
+
+import argparse
+import json
+import os
+import pathlib
+import random
+import resource
+import shutil
+import tempfile
+import time
+import tracemalloc
+import uuid
+from typing import Callable, Dict, List
+
+from ..managers import DbManager
+from . import common
+
+
+def generate_dataset(
+    data_dir: pathlib.Path, users: int, rooms: int, messages: int, seed: int
+) -> Dict:
+    """Writes users.json and rooms.json, streaming rooms so the generator itself stays small"""
+    meta_file = data_dir / "dataset.json"
+    meta = {"users": users, "rooms": rooms, "messages": messages, "seed": seed}
+    if meta_file.exists() and json.loads(meta_file.read_text()) == meta:
+        print(f"reusing dataset in {data_dir}")
+        return meta
+
+    print(f"generating dataset in {data_dir}: {meta}")
+    data_dir.mkdir(parents=True, exist_ok=True)
+    rng = random.Random(seed)
+    user_ids = [
+        str(uuid.UUID(int=rng.getrandbits(128), version=4)) for _ in range(users)
+    ]
+    with open(data_dir / "users.json", "w") as users_file:
+        json.dump(
+            {
+                user_id: {
+                    "user_id": user_id,
+                    "username": f"user{i}",
+                    "password": "password",
+                }
+                for i, user_id in enumerate(user_ids)
+            },
+            users_file,
+        )
+
+    now = time.time()
+    with open(data_dir / "rooms.json", "w") as rooms_file:
+        rooms_file.write("{")
+        for room in range(rooms):
+            first, second = rng.sample(range(users), 2)
+            room_id = user_ids[first] + user_ids[second]
+            # spread the messages evenly over rooms
+            count = messages // rooms + (room < messages % rooms)
+            room_messages = [
+                {
+                    "message_id": str(uuid.UUID(int=rng.getrandbits(128), version=4)),
+                    "sender": user_ids[(first, second)[i % 2]],
+                    "message": f"synthetic message number {i} in room {room}",
+                    "timestamp": str(now - (count - i) * 60),
+                }
+                for i in range(count)
+            ]
+            room_data = {
+                "room_id": room_id,
+                "users": [user_ids[first], user_ids[second]],
+                "usernames": [f"user{first}", f"user{second}"],
+                "messages": room_messages,
+            }
+            rooms_file.write(
+                ("," if room else "")
+                + json.dumps(room_id)
+                + ":"
+                + json.dumps(room_data)
+            )
+        rooms_file.write("}")
+    meta_file.write_text(json.dumps(meta))
+    return meta
+
+
+def time_calls(func: Callable, args: List) -> Dict:
+    """Calls func once per argument tuple and summarises the latency (ms) of the calls"""
+    samples = []
+    for call_args in args:
+        start = time.perf_counter()
+        func(*call_args)
+        samples.append((time.perf_counter() - start) * 1000)
+    return common.latency_summary(samples)
+
+
+def measure(name: str, results: Dict, func: Callable, trace_memory: bool):
+    """Times func and optionally records the peak memory it allocated"""
+    if trace_memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    value = func()
+    elapsed = time.perf_counter() - start
+    results[name] = {"seconds": round(elapsed, 3)}
+    if trace_memory:
+        results[name]["peak_traced_mb"] = round(
+            tracemalloc.get_traced_memory()[1] / 2**20, 2
+        )
+        tracemalloc.stop()
+    print(f"{name}: {elapsed:.3f}s")
+    return value
+
+
+def run_benchmark(args) -> Dict:
+    """Loads the dataset into a DbManager and times every operation"""
+    data_dir = pathlib.Path(args.data_dir)
+    dataset = generate_dataset(
+        data_dir,
+        int(args.users * args.scale),
+        int(args.rooms * args.scale),
+        int(args.messages * args.scale),
+        args.seed,
+    )
+    # the DbManager works on a copy, loading archives and indexes next to the data files and
+    # saving writes them too, so the generated dataset stays untouched
+    with tempfile.TemporaryDirectory() as scratch_dir:
+        work_dir = pathlib.Path(scratch_dir)
+        for name in ("users.json", "rooms.json"):
+            shutil.copyfile(data_dir / name, work_dir / name)
+        process = common.ProcessStats(os.getpid())
+        rss_before = process.rss()
+        results: Dict = {"config": vars(args), "dataset": dataset, "operations": {}}
+        operations = results["operations"]
+
+        db: DbManager = measure(
+            "load",
+            operations,
+            lambda: DbManager(
+                str(work_dir / "users.json"), str(work_dir / "rooms.json")
+            ),
+            args.tracemalloc,
+        )
+        results["memory"] = {
+            "rss_after_load_mb": round(process.rss() / 2**20, 2),
+            "rss_load_delta_mb": round((process.rss() - rss_before) / 2**20, 2),
+        }
+
+        rng = random.Random(args.seed)
+        user_ids = list(db.get_user().keys())
+        room_ids = list(db.rooms.keys())
+        calls = args.calls
+        # drawn with replacement, small scales can have fewer users or rooms than calls
+        usernames = [
+            db.get_user(user_id)["username"]
+            for user_id in rng.choices(user_ids, k=calls)
+        ]
+
+        operations["does_username_exist.hit"] = time_calls(
+            db.does_username_exist, [(username,) for username in usernames]
+        )
+        operations["does_username_exist.miss"] = time_calls(
+            db.does_username_exist, [(f"missing{i}",) for i in range(calls)]
+        )
+        operations["get_user_rooms"] = time_calls(
+            db.get_user_rooms,
+            [(user_id,) for user_id in rng.choices(user_ids, k=calls)],
+        )
+        operations["get_latest_messages"] = time_calls(
+            db.get_latest_messages,
+            [(room_id, 20) for room_id in rng.choices(room_ids, k=calls)],
+        )
+        operations["create_room"] = time_calls(
+            db.create_room, [tuple(rng.sample(user_ids, 2)) for _ in range(calls)]
+        )
+        message_rooms = [rng.choice(room_ids) for _ in range(calls * 10)]
+        operations["create_message"] = time_calls(
+            db.create_message,
+            [
+                (
+                    db.rooms[room_id]["users"][0],
+                    "benchmark message",
+                    str(time.time()),
+                    room_id,
+                )
+                for room_id in message_rooms
+            ],
+        )
+
+        measure("save", operations, db.save, args.tracemalloc)
+        results["memory"]["saved_mb"] = round(
+            sum(path.stat().st_size for path in work_dir.rglob("*") if path.is_file())
+            / 2**20,
+            2,
+        )
+
+    # ru_maxrss is in KiB on Linux
+    results["memory"]["peak_rss_mb"] = round(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10, 2
+    )
+    return results
+
+
+def main():
+    """Entrypoint of the DbManager benchmark"""
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--users", type=int, default=10**5)
+    parser.add_argument("--rooms", type=int, default=10**5)
+    parser.add_argument("--messages", type=int, default=10**7)
+    parser.add_argument(
+        "--scale",
+        type=float,
+        default=1.0,
+        help="multiplier for users, rooms and messages",
+    )
+    parser.add_argument(
+        "--calls", type=int, default=100, help="calls timed per operation"
+    )
+    parser.add_argument("--seed", type=int, default=9)
+    parser.add_argument(
+        "--data-dir",
+        default=os.path.join(tempfile.gettempdir(), "blak-bench-db"),
+        help="where the dataset is generated and cached",
+    )
+    parser.add_argument(
+        "--tracemalloc",
+        action="store_true",
+        help="also trace peak memory of load and save",
+    )
+    parser.add_argument("--output", help="file to save the results to as json")
+    parser.add_argument(
+        "--baseline", help="results of an earlier run to compare against"
+    )
+    args = parser.parse_args()
+
+    results = run_benchmark(args)
+    common.print_results(results)
+    common.save_results(results, args.output)
+    if args.baseline:
+        common.compare_results(results, args.baseline)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,171 @@
+"""Failover benchmark of a hot standby against restarting the server, on one machine
+
+a primary is started on a generated store with a standby following it over a unix socket,
+clients chat on the primary, then the primary is killed and the standby promoted. Reports how
+long a cold start of the store takes against how long until the promoted standby logs users in,
+and checks that the standby has every message.
+
+usage: python -m server.bench.failover --scale 0.1 --output failover.json
+"""
+
+import argparse
+import asyncio
+import pathlib
+import tempfile
+import time
+import uuid
+from typing import Dict
+
+from . import common
+from .db import generate_dataset
+from .load import LoadStats, SimClient, chat, create_room, register_and_login
+
+
+def wait_for(server: common.LocalServer, check, timeout: float) -> float:
+    """Polls /replication until check passes, returns the secs it took"""
+    started = time.perf_counter()
+    while time.perf_counter() - started < timeout:
+        if check(server.http("/replication")):
+            return time.perf_counter() - started
+        time.sleep(0.05)
+    raise TimeoutError(f"replication did not get there in {timeout}s")
+
+
+async def chat_on(server: common.LocalServer, pairs: int, messages: int) -> Dict:
+    """Chats on the server, returns room_id -> (username of a member, messages sent)"""
+    run_id = uuid.uuid4().hex[:8]
+    stats = LoadStats()
+    clients = [
+        SimClient(server.url, f"failover-{run_id}-{i}", stats) for i in range(pairs * 2)
+    ]
+    await asyncio.gather(
+        *(register_and_login(client, "failover") for client in clients)
+    )
+    rooms = {}
+    for first, second in zip(clients[::2], clients[1::2]):
+        room_id = await create_room(first, second)
+        await chat(first, second, room_id, messages, 0)
+        rooms[room_id] = (first.username, messages)
+    await asyncio.gather(*(client.close() for client in clients))
+    return rooms
+
+
+async def login(server: common.LocalServer, username: str, password: str) -> SimClient:
+    """Connects and logs in a client"""
+    client = SimClient(server.url, username, LoadStats())
+    await client.connect()
+    await client.request(
+        "login",
+        {"type": "user.login", "username": username, "password": password},
+        "user.login.success",
+    )
+    return client
+
+
+async def first_login(server: common.LocalServer, timeout: float) -> float:
+    """Secs until a generated user can log in to the server"""
+    started = time.perf_counter()
+    while time.perf_counter() - started < timeout:
+        try:
+            client = await login(server, "user0", "password")
+            await client.close()
+            return time.perf_counter() - started
+        except Exception:  # refused while the standby is still following
+            await asyncio.sleep(0.01)
+    raise TimeoutError("nobody could log in to the promoted standby")
+
+
+async def missing_messages(server: common.LocalServer, rooms: Dict) -> int:
+    """Messages sent to the primary that the server does not have"""
+    missing = 0
+    for room_id, (username, sent) in rooms.items():
+        client = await login(server, username, "failover")
+        reply = await client.request(
+            "history",
+            {"type": "msg.history", "room_id": room_id, "n": sent},
+            "msg.history",
+        )
+        missing += sent - len(reply["messages"])
+        await client.close()
+    return missing
+
+
+def run_failover(args, data_dir: pathlib.Path) -> Dict:
+    """Runs the scenario and returns the timings"""
+    generate_dataset(
+        data_dir / "primary/server",
+        int(10**5 * args.scale),
+        int(10**5 * args.scale),
+        int(10**7 * args.scale),
+        args.seed,
+    )
+    socket_path = str(data_dir / "replication.sock")
+    primary = common.LocalServer(
+        args.port,
+        env={"replication_socket": socket_path},
+        data_dir=str(data_dir / "primary"),
+        start_timeout=args.timeout,
+    )
+    standby = common.LocalServer(
+        args.port + 1,
+        env={"standby_of": socket_path},
+        data_dir=str(data_dir / "standby"),
+        start_timeout=args.timeout,
+    )
+    started = time.perf_counter()
+    with primary:
+        cold_start = time.perf_counter() - started
+        with standby:
+            sync = wait_for(standby, lambda r: r["standby"]["synced"], args.timeout)
+            rooms = asyncio.run(chat_on(primary, args.pairs, args.messages))
+            # every change the primary logged has been applied on the standby
+            position = primary.http("/replication")["position"]
+            wait_for(
+                standby, lambda r: r["standby"]["position"] >= position, args.timeout
+            )
+            primary.process.kill()
+            primary.process.wait()
+            killed = time.perf_counter()
+            promotion = standby.http("/replication/promote", method="POST")
+            failover = (
+                time.perf_counter()
+                - killed
+                + asyncio.run(first_login(standby, args.timeout))
+            )
+            missing = asyncio.run(missing_messages(standby, rooms))
+    return {
+        "config": vars(args),
+        "cold_start_secs": round(cold_start, 3),
+        "standby_sync_secs": round(sync, 3),
+        "promotion_secs": round(promotion["secs"], 6),
+        "failover_secs": round(failover, 3),
+        "changes_applied": promotion["applied"],
+        "missing_messages": missing,
+    }
+
+
+def main():
+    """Entrypoint of the failover benchmark"""
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument(
+        "--scale", type=float, default=0.1, help="fraction of 10^7 generated messages"
+    )
+    parser.add_argument("--pairs", type=int, default=10, help="chatting client pairs")
+    parser.add_argument("--messages", type=int, default=20, help="messages per pair")
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--timeout", type=float, default=600.0)
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument(
+        "--data-dir", help="where the stores live, a temp dir by default"
+    )
+    parser.add_argument("--output", help="file to save the results to as json")
+    args = parser.parse_args()
+
+    data_dir = pathlib.Path(args.data_dir or tempfile.mkdtemp(prefix="blak-failover-"))
+    results = run_failover(args, data_dir)
+    common.print_results(results)
+    common.save_results(results, args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,281 @@
+"""Load generator that drives simulated clients through the real websocket protocol
+
+starts `server.app:app` on localhost, then every client registers, logs in, creates a room with
+its partner and sends messages with bursts of typing events in between.
+
+usage: python -m server.bench.load --clients 2000 --messages 20 --output run.json [--baseline old.json]
+"""
+
+import argparse
+import asyncio
+import json
+import time
+import uuid
+from collections import defaultdict
+from typing import Dict, List
+
+import websockets
+
+from . import common
+
+# frames pushed by the server are only counted
+PUSHED_TYPES = {"msg.recv", "msg.typing.recv", "user.presence", "ping"}
+
+
+class SimClient:
+    """A simulated client, replies are queued by their type"""
+
+    timeout = 30  # secs to wait for a reply
+
+    def __init__(self, url: str, username: str, stats: "LoadStats"):
+        self.url = url
+        self.username = username
+        self.stats = stats
+        self.ws: websockets.WebSocketClientProtocol | None = None
+        self.user_id: str | None = None
+        self.replies: Dict[str, asyncio.Queue] = defaultdict(asyncio.Queue)
+        self.reader: asyncio.Task | None = None
+
+    async def connect(self):
+        """Opens the websocket and starts reading replies"""
+        self.ws = await websockets.connect(self.url, max_queue=None)
+        self.reader = asyncio.create_task(self.read())
+
+    async def read(self):
+        """Sorts incoming frames into queues by type"""
+        try:
+            async for frame in self.ws:
+                reply = json.loads(frame)
+                self.stats.frames_received += 1
+                if reply["type"] == "ping":
+                    await self.ws.send(json.dumps({"type": "pong"}))
+                elif reply["type"] not in PUSHED_TYPES:
+                    self.replies[reply["type"]].put_nowait(reply)
+        except websockets.ConnectionClosed:
+            pass
+
+    async def request(self, op: str, frame: Dict, reply_type: str) -> Dict:
+        """Sends a frame and times how long the reply of reply_type takes"""
+        start = time.perf_counter()
+        await self.ws.send(json.dumps(frame))
+        self.stats.frames_sent += 1
+        reply = await asyncio.wait_for(self.replies[reply_type].get(), self.timeout)
+        self.stats.latencies[op].append((time.perf_counter() - start) * 1000)
+        return reply
+
+    async def send(self, frame: Dict):
+        """Sends a frame that has no reply"""
+        await self.ws.send(json.dumps(frame))
+        self.stats.frames_sent += 1
+
+    async def close(self):
+        """Closes the connection"""
+        await self.ws.close()
+        if self.reader:
+            await self.reader
+
+
+class LoadStats:
+    """Latencies and frame counters of a run"""
+
+    def __init__(self):
+        self.latencies: Dict[str, List[float]] = defaultdict(list)
+        self.phases: Dict[str, Dict] = {}
+        self.frames_sent = 0
+        self.frames_received = 0
+
+
+async def run_phase(name: str, stats: LoadStats, coros, concurrency: int) -> None:
+    """Runs the coroutines with bounded concurrency and records the phase throughput"""
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def bounded(coro):
+        async with semaphore:
+            await coro
+
+    start = time.perf_counter()
+    ops_before = sum(len(samples) for samples in stats.latencies.values())
+    await asyncio.gather(*(bounded(coro) for coro in coros))
+    elapsed = time.perf_counter() - start
+    ops = sum(len(samples) for samples in stats.latencies.values()) - ops_before
+    stats.phases[name] = {
+        "seconds": round(elapsed, 3),
+        "ops": ops,
+        "ops_per_sec": round(ops / elapsed, 1) if elapsed else 0.0,
+    }
+    print(f"{name}: {ops} ops in {elapsed:.2f}s")
+
+
+async def register_and_login(client: SimClient, password: str):
+    """Registers the client and logs it in"""
+    await client.connect()
+    credentials = {"username": client.username, "password": password}
+    await client.request(
+        "register",
+        {"type": "user.register", **credentials},
+        "user.register.success",
+    )
+    reply = await client.request(
+        "login", {"type": "user.login", **credentials}, "user.login.success"
+    )
+    client.user_id = reply["data"]["user_id"]
+
+
+async def create_room(client: SimClient, partner: SimClient) -> str:
+    """Creates a room between client and partner"""
+    reply = await client.request(
+        "room.create",
+        {"type": "room.create", "user_id": client.user_id, "other_id": partner.user_id},
+        "room.create.success",
+    )
+    return reply["room_id"]
+
+
+async def chat(
+    client: SimClient, partner: SimClient, room_id: str, messages: int, typing: int
+):
+    """Sends messages to the partner, each preceded by a burst of typing events"""
+    for i in range(messages):
+        text = f"message {i} from {client.username}"
+        for j in range(1, typing + 1):
+            await client.send(
+                {
+                    "type": "msg.typing.send",
+                    "room_id": room_id,
+                    "other_id": partner.user_id,
+                    "timestamp": str(time.time()),
+                    "data": text[: len(text) * j // typing],
+                }
+            )
+        await client.request(
+            "msg.send",
+            {
+                "type": "msg.send",
+                "other_id": partner.user_id,
+                "data": text,
+                "timestamp": str(time.time()),
+                "room_id": room_id,
+            },
+            "msg.sent",
+        )
+
+
+async def sample_server(
+    server: common.LocalServer, samples: List[Dict], interval: float
+):
+    """Samples CPU and RSS of the server process until cancelled"""
+    while True:
+        samples.append(
+            {
+                "time": time.perf_counter(),
+                "cpu": server.stats.cpu_seconds(),
+                "rss": server.stats.rss(),
+            }
+        )
+        await asyncio.sleep(interval)
+
+
+async def run_load(server: common.LocalServer, args) -> Dict:
+    """Runs every phase against the server and returns the results"""
+    stats = LoadStats()
+    run_id = uuid.uuid4().hex[:8]
+    clients = [
+        SimClient(server.url, f"bench-{run_id}-{i}", stats)
+        for i in range(args.clients - args.clients % 2)
+    ]
+    pairs = list(zip(clients[::2], clients[1::2]))
+    samples: List[Dict] = []
+    sampler = asyncio.create_task(sample_server(server, samples, args.sample_interval))
+    start = time.perf_counter()
+
+    await run_phase(
+        "login",
+        stats,
+        [register_and_login(client, "bench") for client in clients],
+        args.concurrency,
+    )
+    rooms = {}
+
+    async def pair_room(client, partner):
+        rooms[client.user_id] = await create_room(client, partner)
+
+    await run_phase(
+        "room.create",
+        stats,
+        [pair_room(client, partner) for client, partner in pairs],
+        args.concurrency,
+    )
+    await run_phase(
+        "chat",
+        stats,
+        [
+            chat(client, partner, rooms[pair[0].user_id], args.messages, args.typing)
+            for pair in pairs
+            for client, partner in (pair, pair[::-1])
+        ],
+        args.concurrency,
+    )
+    elapsed = time.perf_counter() - start
+    sampler.cancel()
+    await asyncio.gather(*(client.close() for client in clients))
+
+    cpu_seconds = samples[-1]["cpu"] - samples[0]["cpu"] if samples else 0.0
+    return {
+        "config": vars(args),
+        "clients": len(clients),
+        "seconds": round(elapsed, 3),
+        "throughput": {
+            "frames_sent_per_sec": round(stats.frames_sent / elapsed, 1),
+            "frames_received_per_sec": round(stats.frames_received / elapsed, 1),
+            "messages_per_sec": round(len(stats.latencies["msg.send"]) / elapsed, 1),
+        },
+        "phases": stats.phases,
+        "latency_ms": {
+            op: common.latency_summary(values) for op, values in stats.latencies.items()
+        },
+        "server": {
+            "cpu_seconds": round(cpu_seconds, 3),
+            "cpu_percent": round(cpu_seconds / elapsed * 100, 1),
+            "rss_peak_mb": round(server.stats.peak_rss / 2**20, 2),
+            "rss_end_mb": round(server.stats.rss() / 2**20, 2),
+        },
+    }
+
+
+def main():
+    """Entrypoint of the load benchmark"""
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--clients", type=int, default=1000, help="simulated clients")
+    parser.add_argument(
+        "--messages", type=int, default=20, help="messages sent per client"
+    )
+    parser.add_argument(
+        "--typing", type=int, default=5, help="typing events before each message"
+    )
+    parser.add_argument(
+        "--concurrency", type=int, default=500, help="clients active at once"
+    )
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument(
+        "--sample-interval",
+        type=float,
+        default=0.5,
+        help="secs between cpu/rss samples",
+    )
+    parser.add_argument("--output", help="file to save the results to as json")
+    parser.add_argument(
+        "--baseline", help="results of an earlier run to compare against"
+    )
+    args = parser.parse_args()
+
+    common.raise_fd_limit()
+    with common.LocalServer(args.port) as server:
+        results = asyncio.run(run_load(server, args))
+    common.print_results(results)
+    common.save_results(results, args.output)
+    if args.baseline:
+        common.compare_results(results, args.baseline)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+"""Memory benchmark of the in-memory message representation, reports bytes per message
+
+compares the plain dicts messages used to be stored as with the compact RoomMessages columns.
+
+usage: python -m server.bench.messages --messages 1000000 --output run.json [--baseline old.json]
+"""
+
+import argparse
+import random
+import sys
+import time
+import uuid
+from typing import Callable, Dict, List, Set
+
+from ..messages import RoomMessages
+from . import common
+
+
+def dict_rooms(rows: List) -> Dict:
+    """Messages as they were stored before, a list of dicts per room"""
+    rooms = {}
+    for room_id, sender, text, timestamp in rows:
+        rooms.setdefault(room_id, []).append(
+            {
+                "message_id": str(uuid.uuid4()),
+                "sender": sender,
+                "message": text,
+                "timestamp": timestamp,
+            }
+        )
+    return rooms
+
+
+def compact_rooms(rows: List) -> Dict:
+    """Messages stored as RoomMessages columns"""
+    rooms = {}
+    for room_id, sender, text, timestamp in rows:
+        if room_id not in rooms:
+            rooms[room_id] = RoomMessages()
+        rooms[room_id].append(str(uuid.uuid4()), sender, text, timestamp)
+    return rooms
+
+
+def deep_size(obj, seen: Set[int]) -> int:
+    """sys.getsizeof of obj and of every object it holds, objects in seen aren't counted again"""
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(
+            deep_size(key, seen) + deep_size(value, seen) for key, value in obj.items()
+        )
+    elif isinstance(obj, (list, tuple)):
+        size += sum(deep_size(item, seen) for item in obj)
+    elif isinstance(obj, RoomMessages):
+        size += sum(deep_size(getattr(obj, name), seen) for name in obj.__slots__)
+    return size
+
+
+def bytes_per_message(build: Callable, rows: List) -> float:
+    """Size of what build makes of the rows, every field object included, per message
+
+    objects shared between messages (e.g. interned senders) count once.
+    """
+    return deep_size(build(rows), set()) / len(rows)
+
+
+def make_rows(messages: int, rooms: int, seed: int) -> List:
+    """Synthetic (room_id, sender, text, timestamp) rows as decoded from rooms.json"""
+    rng = random.Random(seed)
+    users = [
+        str(uuid.UUID(int=rng.getrandbits(128), version=4)) for _ in range(rooms * 2)
+    ]
+    now = time.time()
+    return [
+        (
+            users[room * 2] + users[room * 2 + 1],
+            # decoded json strings are separate objects even for the same sender
+            "".join(users[room * 2 + rng.getrandbits(1)]),
+            f"synthetic message number {i} with some text",
+            str(now - i),
+        )
+        for i, room in ((i, rng.randrange(rooms)) for i in range(messages))
+    ]
+
+
+def main():
+    """Entrypoint of the message memory benchmark"""
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--messages", type=int, default=10**6)
+    parser.add_argument("--rooms", type=int, default=10**4)
+    parser.add_argument("--seed", type=int, default=9)
+    parser.add_argument("--output", help="file to save the results to as json")
+    parser.add_argument(
+        "--baseline", help="results of an earlier run to compare against"
+    )
+    args = parser.parse_args()
+
+    rows = make_rows(args.messages, args.rooms, args.seed)
+    text_bytes = bytes_per_message(
+        lambda copied: [text for _, _, text, _ in copied], rows
+    )
+    before = bytes_per_message(dict_rooms, rows)
+    after = bytes_per_message(compact_rooms, rows)
+    results = {
+        "config": vars(args),
+        "bytes_per_message": {
+            "dicts": round(before, 1),
+            "compact": round(after, 1),
+            # the text itself costs the same in both
+            "text_only": round(text_bytes, 1),
+        },
+        "reduction_percent": round((before - after) / before * 100, 1),
+    }
+    common.print_results(results)
+    common.save_results(results, args.output)
+    if args.baseline:
+        common.compare_results(results, args.baseline)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,213 @@
+"""Memory soak test that cycles connect/login/chat/disconnect against a local server for hours
+
+the server runs with tracemalloc enabled, RSS and the allocation sites reported by `/debug/memory`
+are sampled periodically and sites that keep growing after the warmup are flagged.
+
+usage: python -m server.bench.soak --duration 14400 --clients 50 --output soak.json
+"""
+
+import argparse
+import asyncio
+import random
+import time
+import uuid
+from typing import Dict, List
+
+from . import common
+from .load import LoadStats, SimClient, chat, create_room, register_and_login
+
+
+async def cycle(client: SimClient, partner: SimClient, messages: int, typing: int):
+    """One connect, login, chat and disconnect cycle of a client"""
+    await client.connect()
+    try:
+        reply = await client.request(
+            "login",
+            {"type": "user.login", "username": client.username, "password": "soak"},
+            "user.login.success",
+        )
+        client.user_id = reply["data"]["user_id"]
+        room_id = await create_room(client, partner)
+        await chat(client, partner, room_id, messages, typing)
+    finally:
+        # a failed cycle must not leak its connection, that is what is soaked for
+        await client.close()
+        client.replies.clear()
+
+
+async def client_loop(
+    client: SimClient, partner: SimClient, deadline: float, args, stats: Dict
+):
+    """Cycles a client until the deadline"""
+    while time.monotonic() < deadline:
+        try:
+            await cycle(client, partner, args.messages, args.typing)
+            stats["cycles"] += 1
+        except Exception as e:  # keep soaking, failures are reported at the end
+            stats["errors"] += 1
+            stats["last_error"] = repr(e)
+        await asyncio.sleep(random.uniform(0, args.pause))
+
+
+def sample(server: common.LocalServer, started: float) -> Dict:
+    """RSS, sessions and allocation sites of the server right now"""
+    report = server.http("/debug/memory?limit=1000")
+    return {
+        "elapsed": round(time.monotonic() - started, 1),
+        "rss": server.stats.rss(),
+        "sessions": report["sessions"],
+        "traced_bytes": report.get("traced_bytes", 0),
+        "sites": {site["site"]: site["size"] for site in report.get("sites", [])},
+    }
+
+
+def growing_sites(samples: List[Dict], min_growth: int, min_ratio: float) -> List:
+    """Sites that grew by min_growth bytes and in at least min_ratio of the sample intervals"""
+    flagged = []
+    first, last = samples[0]["sites"], samples[-1]["sites"]
+    for site, size in last.items():
+        growth = size - first.get(site, 0)
+        if growth < min_growth:
+            continue
+        sizes = [sample["sites"].get(site, 0) for sample in samples]
+        increases = sum(after > before for before, after in zip(sizes, sizes[1:]))
+        if increases >= min_ratio * (len(sizes) - 1):
+            flagged.append(
+                {
+                    "site": site,
+                    "growth_bytes": growth,
+                    "size_bytes": size,
+                    "growing_intervals": f"{increases}/{len(sizes) - 1}",
+                }
+            )
+    return sorted(flagged, key=lambda site: site["growth_bytes"], reverse=True)
+
+
+def slope_per_hour(samples: List[Dict], key: str) -> float:
+    """Least squares growth rate of a sampled value per hour"""
+    xs = [sample["elapsed"] for sample in samples]
+    ys = [sample[key] for sample in samples]
+    if len(xs) < 2:
+        return 0.0
+    mean_x, mean_y = sum(xs) / len(xs), sum(ys) / len(ys)
+    variance = sum((x - mean_x) ** 2 for x in xs)
+    if not variance:
+        return 0.0
+    covariance = sum((x - mean_x) * (y - mean_y) for x, y in zip(xs, ys))
+    return covariance / variance * 3600
+
+
+async def run_soak(server: common.LocalServer, args) -> Dict:
+    """Soaks the server and returns the samples and flagged allocation sites"""
+    run_id = uuid.uuid4().hex[:8]
+    load_stats = LoadStats()
+    clients = [
+        SimClient(server.url, f"soak-{run_id}-{i}", load_stats)
+        for i in range(args.clients - args.clients % 2)
+    ]
+    await asyncio.gather(*(register_and_login(client, "soak") for client in clients))
+    await asyncio.gather(*(client.close() for client in clients))
+
+    started = time.monotonic()
+    deadline = started + args.duration
+    stats = {"cycles": 0, "errors": 0, "last_error": None}
+    loops = asyncio.gather(
+        *(
+            client_loop(client, partner, deadline, args, stats)
+            for first, second in zip(clients[::2], clients[1::2])
+            for client, partner in ((first, second), (second, first))
+        )
+    )
+    samples = []
+    while not loops.done():
+        await asyncio.sleep(
+            min(args.sample_interval, max(0.0, deadline - time.monotonic()))
+        )
+        current = await asyncio.to_thread(sample, server, started)
+        if current["elapsed"] >= args.warmup:
+            samples.append(current)
+        print(
+            f"{current['elapsed']:>8}s rss {current['rss'] / 2**20:8.2f}MB "
+            f"traced {current['traced_bytes'] / 2**20:8.2f}MB "
+            f"sessions {current['sessions']:>5} cycles {stats['cycles']}"
+        )
+        if time.monotonic() >= deadline:
+            break
+    await loops
+    # every client disconnected, so nothing should be left in active_sessions
+    await asyncio.sleep(1)
+    final = await asyncio.to_thread(sample, server, started)
+    samples.append(final)
+
+    return {
+        "config": vars(args),
+        **stats,
+        "sessions_left": final["sessions"],
+        "rss_start_mb": round(samples[0]["rss"] / 2**20, 2),
+        "rss_end_mb": round(final["rss"] / 2**20, 2),
+        "rss_mb_per_hour": round(slope_per_hour(samples, "rss") / 2**20, 2),
+        "traced_mb_per_hour": round(
+            slope_per_hour(samples, "traced_bytes") / 2**20, 2
+        ),
+        "growing_sites": growing_sites(samples, args.min_growth, args.min_ratio),
+        "samples": [
+            {key: value for key, value in sample.items() if key != "sites"}
+            for sample in samples
+        ],
+    }
+
+
+def main():
+    """Entrypoint of the soak test"""
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument(
+        "--duration", type=float, default=4 * 3600, help="secs to soak for"
+    )
+    parser.add_argument(
+        "--clients", type=int, default=50, help="clients cycling at once"
+    )
+    parser.add_argument("--messages", type=int, default=10, help="messages per cycle")
+    parser.add_argument(
+        "--typing", type=int, default=5, help="typing events per message"
+    )
+    parser.add_argument(
+        "--pause", type=float, default=1.0, help="max secs between cycles"
+    )
+    parser.add_argument(
+        "--sample-interval", type=float, default=60.0, help="secs between samples"
+    )
+    parser.add_argument(
+        "--warmup", type=float, default=60.0, help="secs before sampling starts"
+    )
+    parser.add_argument(
+        "--frames", type=int, default=1, help="tracemalloc frames per allocation"
+    )
+    parser.add_argument(
+        "--min-growth",
+        type=int,
+        default=2**20,
+        help="bytes a site must grow to be flagged",
+    )
+    parser.add_argument(
+        "--min-ratio",
+        type=float,
+        default=0.75,
+        help="fraction of sample intervals a flagged site must grow in",
+    )
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--output", help="file to save the results to as json")
+    args = parser.parse_args()
+
+    common.raise_fd_limit()
+    with common.LocalServer(
+        args.port, env={"tracemalloc_frames": str(args.frames)}
+    ) as server:
+        results = asyncio.run(run_soak(server, args))
+    common.print_results(
+        {key: value for key, value in results.items() if key != "samples"}
+    )
+    common.save_results(results, args.output)
+
+
+if __name__ == "__main__":
+    main()
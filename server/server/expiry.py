@@ -0,0 +1,55 @@
+"""Expiry queue of messages that have a time to live"""
+
+import heapq
+import json
+import os
+from typing import Dict, Iterator, List, Tuple
+
+
+class ExpiryQueue:
+    """Min-heap of (expires_at, room_id, seq) persisted next to the rest of the store
+
+    only messages with a ttl are queued, so expiring k messages costs O(k log n) and no room
+    is ever scanned for messages that ran out.
+    """
+
+    def __init__(self, queue_file: str):
+        self.queue_file = queue_file
+        self.heap: List[Tuple[float, str, int]] = []
+        try:
+            with open(queue_file) as queue_fp:
+                self.heap = [tuple(entry) for entry in json.load(queue_fp)]
+            heapq.heapify(self.heap)
+        except (FileNotFoundError, json.JSONDecodeError):
+            pass
+
+    def __len__(self) -> int:
+        return len(self.heap)
+
+    def __iter__(self) -> Iterator[Tuple[float, str, int]]:
+        return iter(self.heap)
+
+    def add(self, expires_at: float, room_id: str, seq: int) -> None:
+        """Queues a message to expire at expires_at (unix time)"""
+        heapq.heappush(self.heap, (expires_at, room_id, seq))
+
+    def next_expiry(self) -> float | None:
+        """Unix time the next message expires at, None if none will"""
+        return self.heap[0][0] if self.heap else None
+
+    def pop_due(self, now: float) -> Dict[str, List[int]]:
+        """Removes the messages that expired by now
+
+        :returns room_id -> seqs of its expired messages
+        """
+        due: Dict[str, List[int]] = {}
+        while self.heap and self.heap[0][0] <= now:
+            _, room_id, seq = heapq.heappop(self.heap)
+            due.setdefault(room_id, []).append(seq)
+        return due
+
+    def save(self) -> None:
+        """Writes the queue next to the rest of the store"""
+        with open(self.queue_file + ".tmp", "w") as queue_fp:
+            json.dump(self.heap, queue_fp)
+        os.replace(self.queue_file + ".tmp", self.queue_file)
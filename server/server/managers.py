@@ -1,20 +1,98 @@
 import asyncio
 import json
+import math
+import os
+import time
 import uuid
-from typing import Dict, List
+from bisect import bisect_right
+from collections import OrderedDict, deque
+from typing import Callable, Dict, Iterator, List, Set
 
 from fastapi import WebSocket
 from loguru import logger
 
+from .archive import MessageArchive
+from .expiry import ExpiryQueue
+from .messages import RoomMessages, compact_room_hook, materialize
+from .search import SearchIndex, snippet
+from .tracing import Tracer
+
+
+class SeqGap(ValueError):
+    """A replicated or imported message doesn't follow on from the last seq of its room"""
+
+    def __init__(self, room_id: str, expected: int, seq: int):
+        super().__init__(f"room {room_id} expected seq {expected}, got {seq}")
+        self.room_id = room_id
+
 
 class DbManager:
     """Manages the Database operations"""
 
-    def __init__(self, user_db_file: str, rooms_db_file: str):
+    def __init__(
+        self,
+        user_db_file: str,
+        rooms_db_file: str,
+        archive_dir: str = None,
+        max_count: int | None = 1000,
+        max_age: float | None = None,
+        dedupe_size: int = 256,
+        pending_max: int = 1000,
+    ):
+        """Loads the users and rooms databases
+
+        :param archive_dir where messages past the hot window are archived, next to rooms_db_file by default
+        :param max_count default max number of messages kept in memory per room, None for no limit
+        :param max_age default max age (secs) of messages kept in memory, None for no limit
+        :param dedupe_size number of recent client message ids remembered per user
+        :param pending_max max number of undelivered messages queued per user, oldest are dropped
+        """
         self.user_db_file = user_db_file
         self.rooms_db_file = rooms_db_file
+        self.archive = MessageArchive(
+            archive_dir
+            or os.path.join(os.path.dirname(rooms_db_file) or ".", "archive")
+        )
+        self.retention = {"max_count": max_count, "max_age": max_age}
+        self.search_index = SearchIndex(
+            os.path.join(os.path.dirname(rooms_db_file) or ".", "search_index.json")
+        )
+        self.dedupe_size = dedupe_size
+        # user_id -> client_message_id -> message_id, seq and expires_at of the user's latest messages
+        self.sent_messages: Dict[str, OrderedDict[str, Dict]] = {}
+        # kept across restarts, clients resend what wasn't confirmed before the server went down
+        self.sent_file = os.path.join(
+            os.path.dirname(rooms_db_file) or ".", "sent_messages.json"
+        )
+        try:
+            with open(self.sent_file) as sent_file:
+                for user_id, sent in json.load(sent_file).items():
+                    self.sent_messages[user_id] = OrderedDict(sent)
+        except (FileNotFoundError, json.JSONDecodeError):
+            pass
+        self.pending_file = os.path.join(
+            os.path.dirname(rooms_db_file) or ".", "pending.json"
+        )
+        self.pending_max = pending_max
+        # user_id -> (room_id, seq) of messages the user hasn't acked, in the order they were sent
+        self.pending: Dict[str, deque] = {}
+        try:
+            with open(self.pending_file) as pending_file:
+                for user_id, entries in json.load(pending_file).items():
+                    self.pending[user_id] = deque(
+                        map(tuple, entries), maxlen=pending_max
+                    )
+        except (FileNotFoundError, json.JSONDecodeError):
+            pass
+        self.expiry = ExpiryQueue(
+            os.path.join(os.path.dirname(rooms_db_file) or ".", "expiry.json")
+        )
+        # called with every mutation of the store, see replication.ChangeLog
+        self.on_change: Callable[[Dict], None] | None = None
         self.users = {}
         self.rooms = {}
+        self.user_rooms: Dict[str, List[str]] = {}  # user_id -> room_ids
+        self.contacts: Dict[str, Set[str]] = {}  # user_id -> users sharing a room
         try:
             with open(self.user_db_file) as user_file, open(
                 self.rooms_db_file
@@ -28,11 +106,21 @@ class DbManager:
                         self.users = dict()
                 if len(rooms_data):
                     try:
-                        self.rooms = json.loads(rooms_data)
+                        self.rooms = json.loads(
+                            rooms_data, object_hook=compact_room_hook
+                        )
                     except json.JSONDecodeError:
                         self.rooms = dict()
         except (FileNotFoundError, json.JSONDecodeError) as e:
             print(e)
+        for room_id, room in self.rooms.items():
+            self.add_room_members(room_id, room["users"])
+            # segments archived after the last save, their messages are still in the hot window
+            self.archive.discard_from(room_id, room["messages"].base)
+            # messages saved before the index existed or after its last save get indexed here
+            self.catch_up_search_index(room_id)
+            # histories saved without retention get archived here
+            self.apply_retention(room_id)
 
     def get_user(self, user_id: str = "") -> Dict:
         """Fetches the user data from Database"""
@@ -49,16 +137,70 @@ class DbManager:
                 return True
         return False
 
-    def get_user_rooms(self, user_id: str) -> List:
-        """Fetches the room data for a user from Database"""
+    def get_user_rooms(self, user_id: str, known: Dict[str, int] = None) -> List:
+        """Fetches the room data for a user from Database
+
+        :param known room_id -> seq of the latest message of the room the client has cached,
+            only newer messages are sent for those rooms along with the ids of cached ones
+            that expired
+        """
+        known = known or {}
         selected_rooms = []
-        for i in self.rooms:
-            if user_id in i:
-                selected_rooms.append(self.rooms[i])
+        for room_id in self.user_rooms.get(user_id, []):
+            room = self.rooms[room_id]
+            messages: RoomMessages = room["messages"]
+            read = room.get("read", {})
+            # index of the first message of the hot window the client doesn't have
+            start = min(
+                max(known.get(room_id, -1) + 1 - messages.base, 0), len(messages)
+            )
+            selected_rooms.append(
+                {
+                    **{
+                        key: value
+                        for key, value in room.items()
+                        if key not in ("read", "unread")
+                    },
+                    "first_seq": messages.base,
+                    "messages": [
+                        message
+                        for message in messages.to_dicts(start)
+                        if not message.get("expired")
+                    ],
+                    "expired": [
+                        messages.message(index)["message_id"]
+                        for index in range(start)
+                        if messages.texts[index] is None
+                    ],
+                    "unread": room.get("unread", {}).get(user_id, 0),
+                    "read_seq": read.get(user_id, -1),
+                    # the other users' cursors, the client shows which of its messages were read
+                    "read_by": {
+                        other_id: seq
+                        for other_id, seq in read.items()
+                        if other_id != user_id
+                    },
+                }
+            )
         return selected_rooms
 
-    def create_room(self, sender_id: str, receiver_id: str) -> str:
-        """Creates a new room if it doesn't exist else return the already preset room"""
+    def is_room_member(self, room_id: str, user_id: str) -> bool:
+        """Checks if the user is part of the room"""
+        room = self.rooms.get(room_id)
+        return room is not None and user_id in room["users"]
+
+    def log_change(self, kind: str, **fields) -> None:
+        """Hands a mutation to the change log, in the shape blak-store exports use"""
+        if self.on_change:
+            self.on_change({"kind": kind, **fields})
+
+    def create_room(
+        self, sender_id: str, receiver_id: str, ttl: float | None = None
+    ) -> str:
+        """Creates a new room if it doesn't exist else return the already preset room
+
+        :param ttl secs every message of a new room lives for, None for no limit
+        """
         room_id = sender_id + receiver_id
         if room_id in self.rooms:
             return room_id
@@ -72,10 +214,28 @@ class DbManager:
                     self.get_user(sender_id)["username"],
                     self.get_user(receiver_id)["username"],
                 ],
-                "messages": [],
+                "messages": RoomMessages(),
             }
+            if ttl:
+                self.rooms[room_id]["ttl"] = ttl
+            self.add_room_members(room_id, [sender_id, receiver_id])
+            self.log_change(
+                "room",
+                **{
+                    key: value
+                    for key, value in self.rooms[room_id].items()
+                    if key != "messages"
+                },
+            )
             return room_id
 
+    def add_room_members(self, room_id: str, user_ids: List[str]) -> None:
+        """Adds a room to the membership and contact indexes of its users"""
+        for user_id in user_ids:
+            self.user_rooms.setdefault(user_id, []).append(room_id)
+            contacts = self.contacts.setdefault(user_id, set())
+            contacts.update(other_id for other_id in user_ids if other_id != user_id)
+
     def create_user(self, username: str, password: str) -> str:
         """Creates a new user"""
         user_id = str(uuid.uuid4())
@@ -84,45 +244,523 @@ class DbManager:
             "username": username,
             "password": password,
         }
+        self.log_change("user", **self.users[user_id])
         return user_id
 
-    def get_latest_messages(self, room_id: str, n: int = 20) -> List:
-        """Get latest "n" no of messages"""
+    def get_latest_messages(
+        self, room_id: str, n: int = 20, before: int = None
+    ) -> List:
+        """Get latest "n" no of messages, older than seq `before` if given
+
+        messages that are no longer in memory are read from the archive, expired ones are
+        left out and don't count towards n, so a page is only short at the start of the history
+        """
         req_room = self.rooms[room_id]
-        messages = req_room["messages"]
-        return messages[-n:]
+        messages: RoomMessages = req_room["messages"]
+        if before is None or before > messages.next_seq:
+            before = messages.next_seq
+        selected = []
+        for index in range(before - messages.base - 1, -1, -1):
+            if len(selected) >= n:
+                break
+            if messages.texts[index] is not None:
+                selected.append(messages.message(index))
+        selected.reverse()
+        before = min(before, messages.base)
+        while len(selected) < n and before > 0:
+            older = self.archive.get_messages(room_id, before, n - len(selected))
+            if not older:
+                break
+            before = older[0]["seq"]
+            selected = [
+                message for message in older if not message.get("expired")
+            ] + selected
+        return selected
+
+    def iter_messages(self, room_id: str, stop: int | None = None) -> Iterator[Dict]:
+        """Every message of a room with seq < stop oldest first, archived ones included
+
+        messages are looked up by seq, so the ones a retention trim moves into the archive
+        while the caller awaits between them are neither skipped nor repeated.
+
+        :param stop next_seq of the room by default
+        """
+        messages: RoomMessages = self.rooms[room_id]["messages"]
+        if stop is None:
+            stop = messages.next_seq
+        seq = 0
+        while seq < stop:
+            if seq >= messages.base:
+                yield messages.message(seq - messages.base)
+                seq += 1
+                continue
+            segments = self.archive.room_segments(room_id)
+            index = bisect_right(segments, (seq, math.inf)) - 1
+            if index >= 0 and seq <= segments[index][1]:
+                first, last = segments[index]
+                for message in self.archive.read_segment(
+                    room_id, first, last, cache=False
+                ):
+                    if seq <= message["seq"] < stop:
+                        yield message
+                seq = last + 1
+            else:
+                # never archived, e.g. a history imported from a later seq
+                later = segments[index + 1][0] if index + 1 < len(segments) else stop
+                seq = min(later, messages.base)
+
+    def import_user(self, user: Dict) -> None:
+        """Adds or replaces a user as exported"""
+        self.users[user["user_id"]] = user
+
+    def import_room(self, room: Dict) -> None:
+        """Adds a room as exported, without its messages
+
+        an existing room keeps its messages, everything else (members, read cursors, unread
+        counts, ttl, retention) is replaced by the exported room.
+        """
+        existing = self.rooms.get(room["room_id"])
+        messages = existing["messages"] if existing else RoomMessages()
+        self.rooms[room["room_id"]] = {**room, "messages": messages}
+        self.add_room_members(room["room_id"], room["users"])
+
+    def import_messages(
+        self, room_id: str, batch: List[Dict], index: bool = True
+    ) -> int:
+        """Appends a batch of exported messages of a room
+
+        messages the room already has are skipped, unless they were exported expired, those
+        expire here too.
+
+        messages past the hot window are archived after every batch, so importing a long
+        history needs no more memory than the room's hot window and a batch.
+
+        :param index False leaves the messages out of the search index, the next load of the
+            store indexes them (see catch_up_search_index)
+        :returns number of messages added
+        :raises SeqGap when a message doesn't follow on from the room's last seq, the
+            messages before it are kept
+        """
+        room = self.rooms[room_id]
+        messages: RoomMessages = room["messages"]
+        added = 0
+        expired = []
+        try:
+            for message in batch:
+                if message["seq"] < messages.next_seq:
+                    if message.get("expired"):
+                        expired.append(message["seq"])
+                    continue
+                if messages.next_seq == 0:
+                    # the exported history may start after seq 0, keep the seqs it had
+                    messages.base = message["seq"]
+                elif message["seq"] > messages.next_seq:
+                    # storing it would shift its seq and every later one
+                    raise SeqGap(room_id, messages.next_seq, message["seq"])
+                text = None if message.get("expired") else message["message"]
+                messages.append(
+                    message["message_id"],
+                    message["sender"],
+                    text,
+                    message["timestamp"],
+                )
+                if index and text is not None:
+                    self.search_index.add(
+                        room_id, messages.next_seq - 1, text, messages.timestamps[-1]
+                    )
+                added += 1
+        finally:
+            if expired:
+                # the exported room's unread counts left those messages out already
+                unread = dict(room.get("unread", {}))
+                self.expire_messages(room_id, expired)
+                room["unread"] = unread
+            self.apply_retention(room_id)
+        return added
+
+    def apply_change(self, change: Dict) -> None:
+        """Applies a mutation logged by the primary, changes seen before are no-ops"""
+        match change.pop("kind"):
+            case "user":
+                self.import_user(change)
+            case "room":
+                self.import_room(change)
+            case "message":
+                self.import_messages(change.pop("room_id"), [change])
+            case "msg.create":
+                messages: RoomMessages = self.rooms[change["room_id"]]["messages"]
+                if change["seq"] > messages.next_seq:
+                    raise SeqGap(change["room_id"], messages.next_seq, change["seq"])
+                if change["seq"] == messages.next_seq:
+                    self.create_message(
+                        change["sender"],
+                        change["message"],
+                        change["timestamp"],
+                        change["room_id"],
+                        change["client_message_id"],
+                        change["message_id"],
+                        change["expires_at"],
+                    )
+            case "msg.expire":
+                self.expire_messages(change["room_id"], change["seqs"])
+            case "expiry":
+                self.expiry.add(change["expires_at"], change["room_id"], change["seq"])
+            case "room.ttl":
+                self.set_room_ttl(change["room_id"], change["ttl"])
+            case "room.read":
+                self.mark_read(change["room_id"], change["user_id"], change["seq"])
+            case "room.retention":
+                self.set_room_retention(
+                    change["room_id"], change["max_count"], change["max_age"]
+                )
+            case "pending":
+                self.import_pending(change["user_id"], change["entries"])
+            case "pending.add":
+                self.add_pending(change["user_id"], change["room_id"], change["seq"])
+            case "pending.ack":
+                self.ack_pending(change["user_id"], change["seqs"])
+
+    def set_room_retention(
+        self, room_id: str, max_count: int | None = None, max_age: float | None = None
+    ) -> None:
+        """Overrides the default retention of a room, None keeps the default"""
+        self.rooms[room_id]["retention"] = {"max_count": max_count, "max_age": max_age}
+        self.log_change(
+            "room.retention", room_id=room_id, max_count=max_count, max_age=max_age
+        )
+        self.apply_retention(room_id)
+
+    def set_room_ttl(self, room_id: str, ttl: float | None) -> None:
+        """Sets the secs new messages of a room live for, None for no limit"""
+        if ttl:
+            self.rooms[room_id]["ttl"] = ttl
+        else:
+            self.rooms[room_id].pop("ttl", None)
+        self.log_change("room.ttl", room_id=room_id, ttl=ttl)
+
+    def expires_at(self, room_id: str, ttl: float | None = None) -> float | None:
+        """Unix time a message sent now expires at, the shorter of its own and the room's ttl"""
+        ttls = [value for value in (ttl, self.rooms[room_id].get("ttl")) if value]
+        return time.time() + min(ttls) if ttls else None
+
+    def apply_retention(self, room_id: str) -> None:
+        """Moves messages past the hot window of a room into an archive segment"""
+        room = self.rooms[room_id]
+        messages: RoomMessages = room["messages"]
+        retention = {
+            key: value if value is not None else self.retention[key]
+            for key, value in room.get("retention", self.retention).items()
+        }
+        count = 0
+        if (max_count := retention["max_count"]) is not None:
+            # archive in batches so segments don't end up with a single message each
+            if len(messages) > max_count + max(1, max_count // 4):
+                count = len(messages) - max_count
+        if (max_age := retention["max_age"]) is not None:
+            count = max(count, messages.count_older_than(time.time() - max_age))
+        if count:
+            self.archive.write_segment(room_id, messages.trim(count))
 
     def create_message(
-        self, sender_id: str, message: str, timestamp: int, room_id: str
+        self,
+        sender_id: str,
+        message: str,
+        timestamp: int,
+        room_id: str,
+        client_message_id: str = None,
+        message_id: str = None,
+        expires_at: float | None = None,
     ) -> str:
-        """Adds a message created by the user to Database"""
+        """Adds a message created by the user to Database
+
+        :param client_message_id id the client generated for the message, see sent_message
+        :param message_id id of a message created on the primary, new messages get a new id
+        :param expires_at unix time the message expires at, see expires_at
+        :raises TypeError if message isn't a str, before anything is changed
+        """
+        if not isinstance(message, str):
+            raise TypeError(f"message text must be a str, not {type(message).__name__}")
         req_room = self.rooms[room_id]
-        message_id = str(uuid.uuid4())
-        req_room["messages"].append(
-            {
+        message_id = message_id or str(uuid.uuid4())
+        messages: RoomMessages = req_room["messages"]
+        self.log_change(
+            "msg.create",
+            room_id=room_id,
+            seq=messages.next_seq,
+            message_id=message_id,
+            sender=sender_id,
+            message=message,
+            timestamp=timestamp,
+            client_message_id=client_message_id,
+            expires_at=expires_at,
+        )
+        messages.append(message_id, sender_id, message, timestamp)
+        if expires_at is not None:
+            self.expiry.add(expires_at, room_id, messages.next_seq - 1)
+        self.search_index.add(
+            room_id, messages.next_seq - 1, message, messages.timestamps[-1]
+        )
+        self.apply_retention(room_id)
+        unread = req_room.setdefault("unread", {})
+        for user_id in req_room["users"]:
+            if user_id != sender_id:
+                unread[user_id] = unread.get(user_id, 0) + 1
+        if client_message_id:
+            sent = self.sent_messages.setdefault(sender_id, OrderedDict())
+            sent[client_message_id] = {
                 "message_id": message_id,
-                "sender": sender_id,
-                "message": message,
-                "timestamp": timestamp,
+                "seq": messages.next_seq - 1,
+                "expires_at": expires_at,
             }
-        )
+            if len(sent) > self.dedupe_size:
+                sent.popitem(last=False)
         return message_id
 
+    def sent_message(self, sender_id: str, client_message_id: str) -> Dict | None:
+        """message_id, seq and expires_at of a recent message the user sent with that client id
+
+        clients retry a msg.send when the connection dropped before msg.sent arrived,
+        a retry of a message that was already created must not create it again.
+        """
+        return self.sent_messages.get(sender_id, {}).get(client_message_id)
+
+    def mark_read(self, room_id: str, user_id: str, seq: int) -> int | None:
+        """Moves the read cursor of a user in a room forward to seq
+
+        :returns the new cursor, None if it didn't move
+        """
+        room = self.rooms[room_id]
+        messages: RoomMessages = room["messages"]
+        seq = min(seq, messages.next_seq - 1)
+        read = room.setdefault("read", {})
+        if seq <= read.get(user_id, -1):
+            return None
+        read[user_id] = seq
+        self.log_change("room.read", room_id=room_id, user_id=user_id, seq=seq)
+        # the unread messages are the latest ones, so counting them only walks those
+        unread = 0
+        for index in range(len(messages) - 1, max(seq - messages.base, -1), -1):
+            unread += (
+                messages.senders[index] != user_id and messages.texts[index] is not None
+            )
+        if seq + 1 < messages.base:
+            unread += sum(
+                message["sender"] != user_id and not message.get("expired")
+                for message in self.archive.get_messages(
+                    room_id, messages.base, messages.base - seq - 1
+                )
+            )
+        room.setdefault("unread", {})[user_id] = unread
+        return seq
+
+    def latest_seq(self, room_id: str) -> int:
+        """Seq of the latest message of a room, -1 if it has none"""
+        return self.rooms[room_id]["messages"].next_seq - 1
+
+    def add_pending(self, user_id: str, room_id: str, seq: int) -> None:
+        """Queues a message for a user it could not be delivered to, once"""
+        if user_id not in self.pending:
+            self.pending[user_id] = deque(maxlen=self.pending_max)
+        if (room_id, seq) in self.pending[user_id]:
+            return  # a change a standby got with its snapshot too
+        self.pending[user_id].append((room_id, seq))
+        self.log_change("pending.add", user_id=user_id, room_id=room_id, seq=seq)
+
+    def import_pending(self, user_id: str, entries: List) -> None:
+        """Replaces the queue of a user with an exported one, an empty one drops it"""
+        if entries:
+            self.pending[user_id] = deque(map(tuple, entries), maxlen=self.pending_max)
+        else:
+            self.pending.pop(user_id, None)
+
+    def get_pending(self, user_id: str) -> List[Dict]:
+        """Messages queued for a user, in the order they were sent"""
+        pending = []
+        for room_id, seq in self.pending.get(user_id, ()):
+            if message := self.get_message(room_id, seq):
+                pending.append({**message, "room_id": room_id})
+        return pending
+
+    def ack_pending(self, user_id: str, seqs: Dict[str, int]) -> None:
+        """Drops queued messages the user acked
+
+        :param seqs room_id -> seq of the latest message of that room the client has
+        """
+        self.log_change("pending.ack", user_id=user_id, seqs=seqs)
+        if queue := self.pending.get(user_id):
+            kept = [
+                (room_id, seq) for room_id, seq in queue if seq > seqs.get(room_id, -1)
+            ]
+            if kept:
+                self.pending[user_id] = deque(kept, maxlen=self.pending_max)
+            else:
+                del self.pending[user_id]
+
+    def get_message(self, room_id: str, seq: int) -> Dict | None:
+        """Fetches a single message of a room by its seq, None if it doesn't exist or expired"""
+        messages: RoomMessages = self.rooms[room_id]["messages"]
+        if messages.base <= seq < messages.next_seq:
+            message = messages.message(seq - messages.base)
+        else:
+            archived = self.archive.get_messages(room_id, seq + 1, 1)
+            if not archived or archived[0]["seq"] != seq:
+                return None
+            message = archived[0]
+        return None if message.get("expired") else message
+
+    def expire_due(self, now: float = None) -> Dict[str, List[Dict]]:
+        """Expires the messages whose ttl ran out by now
+
+        :returns room_id -> message_id and seq of its messages that expired
+        """
+        return {
+            room_id: expired
+            for room_id, seqs in self.expiry.pop_due(now or time.time()).items()
+            if room_id in self.rooms
+            and (expired := self.expire_messages(room_id, seqs))
+        }
+
+    def expire_messages(self, room_id: str, seqs: List[int]) -> List[Dict]:
+        """Drops the texts of messages of a room from memory, the archive and the search index
+
+        :returns message_id and seq of the messages that expired now, expired ones are skipped
+        """
+        room = self.rooms[room_id]
+        messages: RoomMessages = room["messages"]
+        expired = []
+        archived = []
+        for seq in seqs:
+            if messages.base <= seq < messages.next_seq:
+                if (text := messages.expire(seq - messages.base)) is not None:
+                    expired.append((messages.message(seq - messages.base), text))
+            else:
+                archived.append(seq)
+        if archived:
+            expired += self.archive.expire(room_id, archived)
+        if not expired:
+            return []
+        self.log_change("msg.expire", room_id=room_id, seqs=seqs)
+        read = room.get("read", {})
+        unread = room.setdefault("unread", {})
+        for message, text in expired:
+            self.search_index.remove(room_id, message["seq"], text)
+            for user_id in room["users"]:
+                # unread counters must not count messages that are gone
+                if user_id != message["sender"] and message["seq"] > read.get(
+                    user_id, -1
+                ):
+                    unread[user_id] = max(0, unread.get(user_id, 0) - 1)
+        return [
+            {"message_id": message["message_id"], "seq": message["seq"]}
+            for message, _ in expired
+        ]
+
+    def search_messages(
+        self, user_id: str, query: str, offset: int = 0, limit: int = 20
+    ) -> Dict:
+        """Searches the messages of the user's rooms, newest first"""
+        total, page = self.search_index.search(
+            query, self.user_rooms.get(user_id, []), offset, limit
+        )
+        results = []
+        for room_id, seq in page:
+            if message := self.get_message(room_id, seq):
+                results.append(
+                    {
+                        **message,
+                        "room_id": room_id,
+                        "snippet": snippet(message["message"], query),
+                    }
+                )
+        return {"total": total, "offset": offset, "results": results}
+
+    def catch_up_search_index(self, room_id: str) -> None:
+        """Indexes messages of a room that are missing from the search index"""
+        messages: RoomMessages = self.rooms[room_id]["messages"]
+        start = self.search_index.next_seq(room_id)
+        if messages.next_seq > start:
+            for message in self.get_latest_messages(room_id, messages.next_seq - start):
+                if message["seq"] < start:
+                    continue  # older than the expired messages that weren't indexed
+                self.search_index.add(
+                    room_id,
+                    message["seq"],
+                    message["message"],
+                    float(message["timestamp"]),
+                )
+
     def save(self) -> None:
-        """Saves the database"""
+        """Saves the database, only the hot window of every room goes to rooms.json"""
+        for room_id, room in self.rooms.items():
+            self.apply_retention(room_id)
+            room["first_seq"] = room["messages"].base
         with open(self.user_db_file, "w") as users_file, open(
             self.rooms_db_file, "w"
         ) as rooms_file:
             json.dump(self.users, users_file)
-            json.dump(self.rooms, rooms_file)
+            json.dump(self.rooms, rooms_file, default=materialize)
+        self.search_index.save()
+        self.expiry.save()
+        with open(self.pending_file + ".tmp", "w") as pending_file:
+            json.dump(
+                {user_id: list(queue) for user_id, queue in self.pending.items()},
+                pending_file,
+            )
+        os.replace(self.pending_file + ".tmp", self.pending_file)
+        with open(self.sent_file + ".tmp", "w") as sent_file:
+            # lists of pairs, json objects don't promise to keep the order of their keys
+            json.dump(
+                {
+                    user_id: list(sent.items())
+                    for user_id, sent in self.sent_messages.items()
+                },
+                sent_file,
+            )
+        os.replace(self.sent_file + ".tmp", self.sent_file)
 
 
 class ConnectionManager:
     """Class which manages the users connections to the server"""
 
-    def __init__(self, db: DbManager):
+    def __init__(
+        self,
+        db: DbManager,
+        tracer: Tracer = None,
+        presence_grace: float = 5.0,
+        heartbeat_interval: float = 30.0,
+        heartbeat_timeout: float = 90.0,
+        auth_timeout: float = 60.0,
+        receipt_delay: float = 1.0,
+        expiry_batch: float = 1.0,
+    ):
+        """Sets up the session indexes
+
+        :param presence_grace secs a user must stay disconnected before contacts see them offline
+        :param heartbeat_interval secs of silence after which a logged-in session gets pinged
+        :param heartbeat_timeout secs of silence after which a session is reaped
+        :param auth_timeout secs a connection gets to log in
+        :param receipt_delay secs read receipts are collected for before they are sent together
+        :param expiry_batch secs expiries are collected for before they are sent together
+        """
         self.db = db
+        self.tracer = tracer or Tracer()
         self.active_sessions = {}
+        self.session_tasks: Dict[str, asyncio.Task] = {}
+        self.heartbeat_interval = heartbeat_interval
+        self.heartbeat_timeout = heartbeat_timeout
+        self.auth_timeout = auth_timeout
+        self.receipt_delay = receipt_delay
+        # user_id -> (room_id, reader_id) -> seq of read receipts waiting to be sent to the user
+        self.pending_receipts: Dict[str, Dict[tuple, int]] = {}
+        self.expiry_batch = expiry_batch
+        self.expiry_timer: asyncio.TimerHandle | None = None
+        self.expiry_at = 0.0  # unix time of the expiry the timer was armed for
+        self.reaped = 0
+        self.auth_timeouts = 0
+        self.user_sessions: Dict[str, Set[str]] = {}  # user_id -> logged-in session_ids
+        # going offline is announced only after presence_grace secs, so reconnects don't flap
+        self.presence_grace = presence_grace
+        self.offline_timers: Dict[str, asyncio.TimerHandle] = {}
 
     async def create_session(self, websocket: WebSocket) -> None:
         """Creates a client handler"""
@@ -131,20 +769,196 @@ class ConnectionManager:
         session_id = str(uuid.uuid4())
         temp_gen = User.create(session_id, websocket, self.db, self)
         self.active_sessions[session_id] = await asyncio.create_task(anext(temp_gen))
+        task = self.session_tasks[session_id] = asyncio.create_task(anext(temp_gen))
         try:
-            await asyncio.create_task(anext(temp_gen))
+            await task
         except StopAsyncIteration:
             logger.debug("Session ended")
+        except asyncio.CancelledError:
+            if session_id in self.active_sessions:  # shutting down, not reaped
+                raise
+            logger.debug("Session reaped")
+        finally:
+            # sessions ending with anything but WebSocketDisconnect must not stay around
+            self.close_session(session_id)
 
     def close_session(self, session_id: str) -> None:
         """Destroys the existing client handler"""
-        self.active_sessions.pop(session_id, None)
+        self.session_tasks.pop(session_id, None)
+        session = self.active_sessions.pop(session_id, None)
+        if session is None or not session.logged_in:
+            return
+        sessions = self.user_sessions.get(session.user_id, set())
+        sessions.discard(session_id)
+        if not sessions:
+            self.user_sessions.pop(session.user_id, None)
+            self.offline_timers[
+                session.user_id
+            ] = asyncio.get_running_loop().call_later(
+                self.presence_grace, self.went_offline, session.user_id
+            )
+
+    async def login_session(self, session_id: str, user_id: str) -> None:
+        """Marks a session as logged in and announces the user to their online contacts"""
+        first_session = user_id not in self.user_sessions
+        self.user_sessions.setdefault(user_id, set()).add(session_id)
+        if not first_session:
+            return
+        if timer := self.offline_timers.pop(user_id, None):
+            # reconnected within the grace period, contacts never saw it go offline
+            timer.cancel()
+        else:
+            await self.broadcast_presence(user_id, True)
+
+    def went_offline(self, user_id: str) -> None:
+        """Announces a user that stayed offline for the grace period"""
+        self.offline_timers.pop(user_id, None)
+        asyncio.create_task(self.broadcast_presence(user_id, False))
+
+    def online_contacts(self, user_id: str) -> List[str]:
+        """Contacts of a user that are online, costs O(min(contacts, online users))"""
+        contacts = self.db.contacts.get(user_id, set())
+        if len(contacts) <= len(self.user_sessions):
+            return [contact for contact in contacts if contact in self.user_sessions]
+        return [online for online in self.user_sessions if online in contacts]
+
+    async def broadcast_presence(self, user_id: str, online: bool) -> None:
+        """Sends a presence change of a user to every session of their online contacts"""
+        data = {
+            "type": "user.presence",
+            "user_id": user_id,
+            "online": online,
+            "timestamp": str(time.time()),
+        }
+        await self.send_to_users(self.online_contacts(user_id), data)
+
+    async def send_to_users(self, user_ids: List[str], data: Dict) -> None:
+        """Sends data to every session of the users that are online"""
+        websockets = [
+            self.active_sessions[session_id].websocket
+            for user_id in user_ids
+            for session_id in self.user_sessions.get(user_id, ())
+        ]
+        results = await asyncio.gather(
+            *(websocket.send_json(data) for websocket in websockets),
+            return_exceptions=True,
+        )
+        if failed := sum(isinstance(result, Exception) for result in results):
+            # those users are disconnecting, their own sessions clean up after them
+            logger.debug(f"{data['type']} not delivered to {failed} sessions")
+
+    async def reap_sessions(self) -> None:
+        """Pings quiet sessions and reaps the ones that stopped answering
+
+        a half-open connection never raises WebSocketDisconnect, its session is only noticed
+        here once it has been silent for heartbeat_timeout secs.
+        """
+        while True:
+            await asyncio.sleep(
+                min(self.heartbeat_interval, self.heartbeat_timeout) / 2
+            )
+            now = time.monotonic()
+            quiet = []
+            for session_id, session in list(self.active_sessions.items()):
+                silent = now - session.last_active
+                if silent > self.heartbeat_timeout:
+                    self.reap_session(session_id)
+                elif silent > self.heartbeat_interval and session.logged_in:
+                    quiet.append(session.websocket)
+            await asyncio.gather(
+                *(
+                    asyncio.wait_for(
+                        websocket.send_json({"type": "ping"}), self.heartbeat_interval
+                    )
+                    for websocket in quiet
+                ),
+                return_exceptions=True,
+            )
+
+    def reap_session(self, session_id: str) -> None:
+        """Ends a session that stopped answering heartbeats"""
+        session = self.active_sessions[session_id]
+        logger.info(f"reaping session {session_id} of {session.username or 'guest'}")
+        self.reaped += 1
+        session.close = True
+        if task := self.session_tasks.get(session_id):
+            task.cancel()
+        # the websocket is closed once the endpoint returns from create_session
+        self.close_session(session_id)
+
+    def queue_read_receipt(self, room_id: str, reader_id: str, seq: int) -> None:
+        """Queues a read receipt for the other online users of a room
+
+        receipts are sent after receipt_delay secs, so a user reading through a chat
+        causes a single frame per recipient instead of one per message.
+        """
+        for user_id in self.db.rooms[room_id]["users"]:
+            if user_id == reader_id or user_id not in self.user_sessions:
+                continue  # offline users get the read cursors with their next login
+            if user_id not in self.pending_receipts:
+                self.pending_receipts[user_id] = {}
+                asyncio.get_running_loop().call_later(
+                    self.receipt_delay,
+                    lambda user_id=user_id: asyncio.create_task(
+                        self.send_read_receipts(user_id)
+                    ),
+                )
+            self.pending_receipts[user_id][room_id, reader_id] = seq
+
+    async def send_read_receipts(self, user_id: str) -> None:
+        """Sends the queued read receipts of a user in one frame"""
+        receipts = self.pending_receipts.pop(user_id, {})
+        data = {
+            "type": "room.read.recv",
+            "receipts": [
+                {"room_id": room_id, "user_id": reader_id, "seq": seq}
+                for (room_id, reader_id), seq in receipts.items()
+            ],
+        }
+        await self.send_to_users([user_id], data)
+
+    def schedule_expiry(self) -> None:
+        """Arms the expiry timer for the next message to expire, unless it's armed for an earlier one
+
+        there is a single timer, whatever the number of rooms or messages with a ttl.
+        """
+        expires_at = self.db.expiry.next_expiry()
+        if expires_at is None or (self.expiry_timer and self.expiry_at <= expires_at):
+            return
+        if self.expiry_timer:
+            self.expiry_timer.cancel()
+        self.expiry_at = expires_at
+        self.expiry_timer = asyncio.get_running_loop().call_later(
+            max(0.0, expires_at - time.time()) + self.expiry_batch,
+            lambda: asyncio.create_task(self.send_expired()),
+        )
+
+    async def send_expired(self) -> None:
+        """Expires the messages whose ttl ran out and tells the online members of their rooms
+
+        every member gets a single msg.expired frame for everything that expired together.
+        """
+        self.expiry_timer = None
+        expired = self.db.expire_due()
+        self.schedule_expiry()
+        per_user: Dict[str, List[Dict]] = {}
+        for room_id, messages in expired.items():
+            for user_id in self.db.rooms[room_id]["users"]:
+                if user_id in self.user_sessions:
+                    per_user.setdefault(user_id, []).extend(
+                        {"room_id": room_id, **message} for message in messages
+                    )
+        await asyncio.gather(
+            *(
+                self.send_to_users(
+                    [user_id], {"type": "msg.expired", "messages": messages}
+                )
+                for user_id, messages in per_user.items()
+            )
+        )
 
     def is_user_online(self, user_id: str) -> WebSocket | None:
         """Checks for roommate is online"""
-        for obj in self.active_sessions.values():
-            if obj.logged_in:
-                if user_id == obj.user_id:
-                    return obj.websocket
-        else:
-            return None
+        for session_id in self.user_sessions.get(user_id, ()):
+            return self.active_sessions[session_id].websocket
+        return None
@@ -0,0 +1,154 @@
+"""Compact in-memory storage of room messages"""
+
+import sys
+import time
+import uuid
+from array import array
+from typing import Dict, Iterable, List
+
+ID_SIZE = 16  # bytes of a binary uuid
+
+
+def parse_timestamp(timestamp: str | float) -> float:
+    """Timestamps are sent as strings by clients, unparsable ones get the server time"""
+    try:
+        return float(timestamp)
+    except (TypeError, ValueError):
+        return time.time()
+
+
+class RoomMessages:
+    """Messages of a room stored column wise
+
+    ids are kept as 16 byte uuids in one bytearray, timestamps as doubles in an array, sender ids
+    are interned so every message of a user shares one string. Messages are materialized to dicts
+    only when they are serialized.
+
+    every message of a room has a sequence number, `base` is the seq of the first message still
+    held here, older ones have been archived. Expired messages keep their seq but lose their
+    text, which is stored as None.
+    """
+
+    __slots__ = ("base", "ids", "senders", "texts", "timestamps")
+
+    def __init__(self, base: int = 0):
+        self.base = base
+        self.ids = bytearray()
+        self.senders: List[str] = []
+        self.texts: List[str | None] = []
+        self.timestamps = array("d")
+
+    def __len__(self) -> int:
+        return len(self.texts)
+
+    @property
+    def next_seq(self) -> int:
+        """Sequence number the next message will get"""
+        return self.base + len(self)
+
+    def append(
+        self, message_id: str, sender: str, text: str | None, timestamp: str | float
+    ) -> None:
+        """Adds a message to the end of the room"""
+        self.ids += uuid.UUID(message_id).bytes
+        self.senders.append(sys.intern(sender))
+        self.texts.append(text)
+        self.timestamps.append(parse_timestamp(timestamp))
+
+    def message(self, index: int) -> Dict:
+        """Materializes a single message"""
+        offset = index * ID_SIZE
+        message = {
+            "message_id": str(
+                uuid.UUID(bytes=bytes(self.ids[offset : offset + ID_SIZE]))
+            ),
+            "sender": self.senders[index],
+            "message": self.texts[index],
+            "timestamp": str(self.timestamps[index]),
+            "seq": self.base + index,
+        }
+        if message["message"] is None:
+            expire(message)
+        return message
+
+    def expire(self, index: int) -> str | None:
+        """Drops the text of a message
+
+        :returns the text it had, None if it had expired already
+        """
+        text, self.texts[index] = self.texts[index], None
+        return text
+
+    def to_dicts(self, start: int = None, stop: int = None) -> List[Dict]:
+        """Materializes the messages in [start:stop] as dicts"""
+        return [
+            self.message(index)
+            for index in range(*slice(start, stop).indices(len(self)))
+        ]
+
+    def count_older_than(self, cutoff: float) -> int:
+        """Number of leading messages with a timestamp before cutoff"""
+        count = 0
+        for timestamp in self.timestamps:
+            if timestamp >= cutoff:
+                break
+            count += 1
+        return count
+
+    def trim(self, count: int) -> List[Dict]:
+        """Removes the oldest count messages and returns them materialized"""
+        removed = self.to_dicts(0, count)
+        del self.ids[: count * ID_SIZE]
+        del self.senders[:count]
+        del self.texts[:count]
+        del self.timestamps[:count]
+        self.base += len(removed)
+        return removed
+
+    @classmethod
+    def from_dicts(cls, messages: Iterable[Dict], base: int = 0) -> "RoomMessages":
+        """Builds the compact form from message dicts as stored in rooms.json"""
+        room_messages = cls(base)
+        for message in messages:
+            room_messages.append(
+                message["message_id"],
+                message["sender"],
+                None if message.get("expired") else message["message"],
+                message["timestamp"],
+            )
+        return room_messages
+
+
+def expire(message: Dict) -> str | None:
+    """Turns a message dict into the tombstone of an expired message
+
+    tombstones keep the id, sender, timestamp and seq, so seqs stay consecutive.
+
+    :returns the text it had, None if it had expired already
+    """
+    if message.get("expired"):
+        return None
+    text = message["message"]
+    message["message"] = ""
+    message["expired"] = True
+    return text
+
+
+def compact_room_hook(obj: Dict) -> Dict:
+    """Object hook for json that converts the messages of every room while rooms.json is parsed
+
+    the message dicts of a room are freed as soon as the room is converted, so they never
+    all exist at once.
+    """
+    if "room_id" in obj and isinstance(obj.get("messages"), list):
+        obj["messages"] = RoomMessages.from_dicts(
+            obj["messages"], obj.get("first_seq", 0)
+        )
+    return obj
+
+
+def materialize(obj):
+    """Default hook for json that serializes RoomMessages as a list of message dicts"""
+    if isinstance(obj, RoomMessages):
+        return obj.to_dicts()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
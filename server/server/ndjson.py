@@ -0,0 +1,198 @@
+"""Streaming NDJSON export and import of the chat store
+
+every line is one json object with a `kind` of "user", "room", "message", "expiry" or
+"pending". Users come first, then every room followed by its messages oldest first, so an
+import never has to look back. The expiry times of messages with a ttl come next, the queues of
+undelivered messages last.
+
+usage:
+    blak-store export backup.ndjson
+    blak-store import backup.ndjson --batch 10000
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+from typing import Dict, Iterator, TextIO
+
+from .managers import DbManager, SeqGap
+
+ROOM_SKIPPED_KEYS = ("messages", "first_seq")
+
+
+class Throughput:
+    """Counts exported or imported lines and reports the rate"""
+
+    def __init__(self, stream: TextIO = sys.stderr, every: float = 5.0):
+        self.stream = stream
+        self.every = every
+        self.counts = {"user": 0, "room": 0, "message": 0, "expiry": 0, "pending": 0}
+        self.bytes = 0
+        self.started = time.perf_counter()
+        self.reported = self.started
+
+    def add(self, kind: str, size: int) -> None:
+        """Counts a line, reports progress every `every` secs"""
+        self.counts[kind] += 1
+        self.bytes += size
+        if (now := time.perf_counter()) - self.reported >= self.every:
+            self.reported = now
+            self.report("progress")
+
+    def summary(self) -> Dict:
+        """Totals and rates so far"""
+        elapsed = max(time.perf_counter() - self.started, 1e-9)
+        return {
+            **self.counts,
+            "secs": round(elapsed, 2),
+            "messages_per_sec": round(self.counts["message"] / elapsed),
+            "mb_per_sec": round(self.bytes / elapsed / 2**20, 2),
+        }
+
+    def report(self, label: str, **extra) -> None:
+        """Prints the summary"""
+        print(f"{label}: {json.dumps({**self.summary(), **extra})}", file=self.stream)
+
+
+def export_objects(db: DbManager) -> Iterator[Dict]:
+    """Every user, room, message, expiry and pending queue of the store in export order
+
+    the users, rooms, the seq range of every room, the expiry and pending queues are taken when the first
+    object is requested, so the store can change while a consumer awaits between objects
+    (see replication.ChangeLog.serve). Changes made after that aren't exported.
+    """
+    users = list(db.get_user().values())
+    stops = {room_id: room["messages"].next_seq for room_id, room in db.rooms.items()}
+    expiry = list(db.expiry)
+    pending = {user_id: list(queue) for user_id, queue in db.pending.items()}
+    for user in users:
+        yield {"kind": "user", **user}
+    for room_id, stop in stops.items():
+        room = db.rooms[room_id]
+        yield {
+            "kind": "room",
+            **{
+                key: value
+                for key, value in room.items()
+                if key not in ROOM_SKIPPED_KEYS
+            },
+        }
+        for message in db.iter_messages(room_id, stop):
+            yield {"kind": "message", "room_id": room_id, **message}
+    for expires_at, room_id, seq in expiry:
+        yield {
+            "kind": "expiry",
+            "room_id": room_id,
+            "seq": seq,
+            "expires_at": expires_at,
+        }
+    for user_id, entries in pending.items():
+        yield {"kind": "pending", "user_id": user_id, "entries": entries}
+
+
+def export_store(db: DbManager, out: TextIO) -> Dict:
+    """Streams every user, room and message of the store to out"""
+    stats = Throughput()
+    for obj in export_objects(db):
+        line = json.dumps(obj) + "\n"
+        out.write(line)
+        stats.add(obj["kind"], len(line))
+    stats.report("exported")
+    return stats.summary()
+
+
+def import_store(db: DbManager, lines: TextIO, batch_size: int) -> Dict:
+    """Reads exported lines into the store, messages are written in batches"""
+    stats = Throughput()
+    room_id = None
+    batch = []
+    added = 0
+
+    def flush():
+        nonlocal added
+        if batch:
+            try:
+                # the search index grows with every message, the server builds it on its next start
+                added += db.import_messages(room_id, batch, index=False)
+            except SeqGap as e:
+                raise SystemExit(f"{e}, the export is missing messages")
+            batch.clear()
+
+    for number, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        try:
+            obj = json.loads(line)
+            kind = obj.pop("kind")
+        except (json.JSONDecodeError, KeyError, TypeError, AttributeError):
+            raise SystemExit(f"line {number} is not an exported object")
+        if kind == "user":
+            db.import_user(obj)
+        elif kind == "room":
+            flush()
+            room_id = obj["room_id"]
+            db.import_room(obj)
+        elif kind == "message":
+            if obj.pop("room_id") != room_id:
+                raise SystemExit(f"line {number}: message outside of its room")
+            batch.append(obj)
+            if len(batch) >= batch_size:
+                flush()
+        elif kind == "expiry":
+            flush()
+            db.expiry.add(obj["expires_at"], obj["room_id"], obj["seq"])
+        elif kind == "pending":
+            db.import_pending(obj["user_id"], obj["entries"])
+        else:
+            raise SystemExit(f"line {number}: unknown kind {kind!r}")
+        stats.add(kind, len(line))
+    flush()
+    db.save()
+    stats.report("imported", messages_added=added)
+    return {**stats.summary(), "messages_added": added}
+
+
+def main():
+    """Entrypoint of the store export/import tool"""
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--users", default="server/users.json")
+    parser.add_argument("--rooms", default="server/rooms.json")
+    commands = parser.add_subparsers(dest="command", required=True)
+    export_parser = commands.add_parser("export", help="write the store as NDJSON")
+    export_parser.add_argument("file", help="file to write, - for stdout")
+    import_parser = commands.add_parser(
+        "import", help="add NDJSON exported before to the store"
+    )
+    import_parser.add_argument("file", help="file to read, - for stdin")
+    import_parser.add_argument(
+        "--batch", type=int, default=10000, help="messages written at once"
+    )
+    args = parser.parse_args()
+
+    # the same hot window as the server, so an import archives like the server would
+    max_count = os.getenv("retention_max_count", "1000")
+    max_age = os.getenv("retention_max_age", "")
+    db = DbManager(
+        args.users,
+        args.rooms,
+        max_count=int(max_count) if max_count else None,
+        max_age=float(max_age) if max_age else None,
+    )
+    if args.command == "export":
+        if args.file == "-":
+            export_store(db, sys.stdout)
+        else:
+            with open(args.file, "w") as out:
+                export_store(db, out)
+    else:
+        if args.file == "-":
+            import_store(db, sys.stdin, args.batch)
+        else:
+            with open(args.file) as lines:
+                import_store(db, lines, args.batch)
+
+
+if __name__ == "__main__":
+    main()
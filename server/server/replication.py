@@ -0,0 +1,194 @@
+"""Hot standby replication by shipping the change log of the store over a unix socket
+
+the primary sends a standby a snapshot of the store (the lines `blak-store export` writes)
+followed by every mutation as it happens. The standby applies both to its own DbManager, so
+promoting it only means accepting clients, however big the store is.
+"""
+
+import asyncio
+import json
+import os
+import time
+from typing import Dict, List
+
+from loguru import logger
+
+from .managers import DbManager, SeqGap
+from .ndjson import export_objects
+
+SNAPSHOT_DONE = {"kind": "snapshot.done"}
+HIGH_WATER = 2**20  # bytes buffered for a standby before the snapshot waits for it
+
+
+class ChangeLog:
+    """Primary side, streams a snapshot and then every change to each connected standby"""
+
+    def __init__(self, db: DbManager, socket_path: str):
+        self.db = db
+        self.socket_path = socket_path
+        self.standbys: List[asyncio.Queue] = []
+        self.server: asyncio.AbstractServer | None = None
+        self.shipped = 0
+        self.position = (
+            0  # changes logged, a standby that applied up to it has them all
+        )
+
+    async def start(self) -> None:
+        """Starts listening for standbys and logging changes of the store"""
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)  # left behind by a primary that died
+        self.db.on_change = self.publish
+        self.server = await asyncio.start_unix_server(self.serve, self.socket_path)
+        logger.info(f"shipping changes to standbys on {self.socket_path}")
+
+    def publish(self, change: Dict) -> None:
+        """Queues a change for every standby"""
+        self.position += 1
+        line = (json.dumps({**change, "position": self.position}) + "\n").encode()
+        for queue in self.standbys:
+            queue.put_nowait(line)
+
+    async def serve(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        """Feeds one standby until it disconnects"""
+        # changes made while the snapshot is sent are queued and follow it, applying a change
+        # the snapshot already contains is a no-op on the standby
+        queue: asyncio.Queue = asyncio.Queue()
+        self.standbys.append(queue)
+        position = self.position  # the snapshot has every change up to here at least
+        logger.info("standby connected, sending snapshot")
+        try:
+            for obj in export_objects(self.db):
+                writer.write((json.dumps(obj) + "\n").encode())
+                if writer.transport.get_write_buffer_size() > HIGH_WATER:
+                    await writer.drain()
+            done = {**SNAPSHOT_DONE, "position": position}
+            writer.write((json.dumps(done) + "\n").encode())
+            while True:
+                writer.write(await queue.get())
+                self.shipped += 1
+                if queue.empty():
+                    await writer.drain()
+        except ConnectionError:
+            logger.warning("standby disconnected")
+        except Exception:
+            # a standby that stops being fed must reconnect instead of waiting forever
+            logger.exception("shipping to the standby failed")
+        finally:
+            self.standbys.remove(queue)
+            writer.close()
+
+    async def stop(self) -> None:
+        """Stops shipping changes"""
+        self.db.on_change = None
+        if self.server:
+            self.server.close()
+            await self.server.wait_closed()
+
+
+class Standby:
+    """Standby side, applies the snapshot and changes of a primary to the local store"""
+
+    def __init__(self, db: DbManager, socket_path: str, batch_size: int = 10000):
+        self.db = db
+        self.socket_path = socket_path
+        self.batch_size = batch_size
+        self.connected = False
+        self.synced = False  # the snapshot has been applied
+        self.applied = 0
+        self.position = 0  # of the last change of the primary's change log applied
+        self.last_change: float | None = None
+
+    async def run(self) -> None:
+        """Follows the primary, reconnecting until cancelled by a promotion"""
+        while True:
+            try:
+                reader, writer = await asyncio.open_unix_connection(
+                    self.socket_path, limit=2**24
+                )
+            except (FileNotFoundError, ConnectionError):
+                await asyncio.sleep(0.5)
+                continue
+            self.connected = True
+            logger.info(f"following the primary on {self.socket_path}")
+            try:
+                await self.follow(reader)
+            except (ConnectionError, asyncio.IncompleteReadError):
+                pass
+            except SeqGap as e:
+                # a new snapshot fills the room in from the last seq it has
+                logger.error(f"{e}, resyncing from the primary")
+            except Exception:
+                # a standby that stops following is never promoted with what it missed
+                logger.exception("following the primary failed, resyncing")
+                await asyncio.sleep(0.5)
+            finally:
+                self.connected = False
+                self.synced = False
+                writer.close()
+            logger.warning("lost the primary, reconnecting")
+
+    async def follow(self, reader: asyncio.StreamReader) -> None:
+        """Applies lines until the primary goes away"""
+        # snapshot messages come room by room, they are imported in batches
+        room_id, batch = None, []
+        pending_users = set()  # with a queue in the snapshot
+        while line := await reader.readline():
+            change = json.loads(line)
+            if batch and (change["kind"] != "message" or change["room_id"] != room_id):
+                self.import_batch(room_id, batch)
+            if change["kind"] == "message":
+                room_id = change.pop("room_id")
+                del change["kind"]
+                batch.append(change)
+                if len(batch) >= self.batch_size:
+                    self.import_batch(room_id, batch)
+            elif change["kind"] == "snapshot.done":
+                # queues the primary no longer has were acked while the standby was away
+                for user_id in set(self.db.pending) - pending_users:
+                    self.db.import_pending(user_id, [])
+                self.synced = True
+                self.position = change["position"]
+                logger.info(f"snapshot applied, {self.applied} changes")
+            else:
+                # snapshot objects other than messages have no position
+                self.position = change.pop("position", self.position)
+                if change["kind"] == "pending":
+                    pending_users.add(change["user_id"])
+                try:
+                    self.db.apply_change(change)
+                except SeqGap:
+                    raise
+                except Exception:
+                    # one bad change must not stop the ones after it from being applied
+                    logger.exception(f"skipped the change {change}")
+                else:
+                    self.applied += 1
+            self.last_change = time.time()
+        if batch:
+            self.import_batch(room_id, batch)
+
+    def import_batch(self, room_id: str, batch: List[Dict]) -> None:
+        """Imports and clears a batch of snapshot messages of a room"""
+        try:
+            self.db.import_messages(room_id, batch)
+            self.applied += len(batch)
+        except SeqGap:
+            raise
+        except Exception:
+            logger.exception(
+                f"skipped {len(batch)} snapshot messages of room {room_id}"
+            )
+        finally:
+            batch.clear()
+
+    def status(self) -> Dict:
+        """Replication state for the status endpoint"""
+        return {
+            "connected": self.connected,
+            "synced": self.synced,
+            "applied": self.applied,
+            "position": self.position,
+            "last_change": self.last_change,
+        }
@@ -0,0 +1,188 @@
+"""Incrementally maintained inverted index for searching messages"""
+
+import base64
+import heapq
+import json
+import os
+import re
+from array import array
+from bisect import bisect_left
+from typing import Dict, Iterable, List, Tuple
+
+TOKEN_RE = re.compile(r"\w+")
+MAX_TOKEN_LENGTH = 32
+INDEX_VERSION = 2
+
+
+def tokenize(text: str) -> List[str]:
+    """Unique lowercase words of a text"""
+    return list(
+        dict.fromkeys(
+            token[:MAX_TOKEN_LENGTH] for token in TOKEN_RE.findall(text.lower())
+        )
+    )
+
+
+class RoomIndex:
+    """Postings (token -> ascending seqs) and timestamps of a room's messages"""
+
+    __slots__ = ("postings", "timestamps")
+
+    def __init__(self):
+        self.postings: Dict[str, array] = {}
+        self.timestamps = array("d")  # indexed by seq
+
+    @property
+    def next_seq(self) -> int:
+        """Seq of the next message to index"""
+        return len(self.timestamps)
+
+    def add(self, seq: int, text: str, timestamp: float) -> None:
+        """Indexes a message"""
+        # seqs that were never indexed (e.g. missing in an old store) are padded
+        while len(self.timestamps) < seq:
+            self.timestamps.append(0.0)
+        self.timestamps.append(timestamp)
+        for token in tokenize(text):
+            if token not in self.postings:
+                self.postings[token] = array("I")
+            self.postings[token].append(seq)
+
+    def match(self, tokens: List[str]) -> List[int]:
+        """Seqs of messages containing every token, newest first"""
+        postings = []
+        for token in tokens:
+            if token not in self.postings:
+                return []
+            postings.append(self.postings[token])
+        postings.sort(key=len)
+        matched = postings[0]
+        for posting in postings[1:]:
+            # walk the shortest list and binary search the longer ones
+            matched = [seq for seq in matched if contains(posting, seq)]
+            if not matched:
+                return []
+        return list(reversed(matched))
+
+
+def contains(posting: array, seq: int) -> bool:
+    """Checks if an ascending posting list contains seq"""
+    index = bisect_left(posting, seq)
+    return index < len(posting) and posting[index] == seq
+
+
+class SearchIndex:
+    """Inverted index of every room, partitioned by room so searches only touch the user's rooms"""
+
+    def __init__(self, index_file: str):
+        self.index_file = index_file
+        self.rooms: Dict[str, RoomIndex] = {}
+        try:
+            with open(index_file) as index_fp:
+                if json.loads(index_fp.readline()).get("version") != INDEX_VERSION:
+                    return  # indexes of other versions are rebuilt from the messages
+                for line in index_fp:
+                    room_id, timestamps, postings = json.loads(line)
+                    room_index = self.rooms[room_id] = RoomIndex()
+                    room_index.timestamps = unpack("d", timestamps)
+                    room_index.postings = {
+                        token: unpack("I", seqs) for token, seqs in postings.items()
+                    }
+        except (FileNotFoundError, json.JSONDecodeError, ValueError):
+            self.rooms = {}
+
+    def next_seq(self, room_id: str) -> int:
+        """Seq of the next message of a room that needs indexing"""
+        room_index = self.rooms.get(room_id)
+        return room_index.next_seq if room_index else 0
+
+    def add(self, room_id: str, seq: int, text: str, timestamp: float) -> None:
+        """Indexes a message of a room"""
+        if room_id not in self.rooms:
+            self.rooms[room_id] = RoomIndex()
+        self.rooms[room_id].add(seq, text, timestamp)
+
+    def remove(self, room_id: str, seq: int, text: str) -> None:
+        """Drops a message with that text from the index, e.g. once it expired"""
+        if not (room_index := self.rooms.get(room_id)):
+            return
+        for token in tokenize(text):
+            if posting := room_index.postings.get(token):
+                index = bisect_left(posting, seq)
+                if index < len(posting) and posting[index] == seq:
+                    del posting[index]
+                    if not posting:
+                        del room_index.postings[token]
+
+    def search(
+        self, query: str, room_ids: Iterable[str], offset: int = 0, limit: int = 20
+    ) -> Tuple[int, List[Tuple[str, int]]]:
+        """Finds messages containing every word of the query in the given rooms
+
+        :returns total number of hits and the (room_id, seq) of the requested page, newest first
+        """
+        tokens = tokenize(query)
+        if not tokens:
+            return 0, []
+        per_room = []
+        total = 0
+        for room_id in room_ids:
+            if room_index := self.rooms.get(room_id):
+                if seqs := room_index.match(tokens):
+                    total += len(seqs)
+                    per_room.append(ranked(room_id, room_index, seqs))
+        page = []
+        for index, (_, room_id, seq) in enumerate(heapq.merge(*per_room)):
+            if index >= offset + limit:
+                break
+            if index >= offset:
+                page.append((room_id, seq))
+        return total, page
+
+    def save(self) -> None:
+        """Writes the index next to the rest of the store
+
+        a header line is followed by one line per room, arrays are stored as base64 of their
+        bytes so neither saving nor loading ever turns them into lists of python ints.
+        """
+        with open(self.index_file + ".tmp", "w") as index_fp:
+            index_fp.write(json.dumps({"version": INDEX_VERSION}) + "\n")
+            for room_id, room_index in self.rooms.items():
+                postings = {
+                    token: pack(seqs) for token, seqs in room_index.postings.items()
+                }
+                index_fp.write(
+                    json.dumps([room_id, pack(room_index.timestamps), postings]) + "\n"
+                )
+        os.replace(self.index_file + ".tmp", self.index_file)
+
+
+def pack(values: array) -> str:
+    """Array as base64 text"""
+    return base64.b64encode(values.tobytes()).decode()
+
+
+def unpack(typecode: str, text: str) -> array:
+    """Array from base64 text written by pack"""
+    values = array(typecode)
+    values.frombytes(base64.b64decode(text))
+    return values
+
+
+def ranked(room_id: str, room_index: RoomIndex, seqs: List[int]):
+    """Yields (-timestamp, room_id, seq) of hits so that merging them orders newest first"""
+    for seq in seqs:
+        yield -room_index.timestamps[seq], room_id, seq
+
+
+def snippet(text: str, query: str, width: int = 40) -> str:
+    """Part of the text around the first word of the query that it contains"""
+    lowered = text.lower()
+    positions = [
+        position for token in tokenize(query) if (position := lowered.find(token)) != -1
+    ]
+    if not positions or len(text) <= width * 2:
+        return text[: width * 2]
+    start = max(0, min(positions) - width)
+    end = min(len(text), start + width * 2)
+    return ("…" if start else "") + text[start:end] + ("…" if end < len(text) else "")
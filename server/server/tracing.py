@@ -0,0 +1,115 @@
+"""Latency tracing for protocol frames that carry a ``trace_id``"""
+
+import time
+from collections import deque
+from contextlib import contextmanager, nullcontext
+from typing import Dict, Optional
+
+from loguru import logger
+
+
+class Tracer:
+    """Collects per-hop latencies of traced frames and summarises them"""
+
+    def __init__(self, max_samples: int = 10000):
+        self.max_samples = max_samples
+        self.hops: Dict[str, deque] = {}
+
+    def start(self, trace_id: Optional[str], received: float) -> "Trace":
+        """Starts a trace for a frame, frames without a trace_id get a no-op trace"""
+        if trace_id:
+            return Trace(str(trace_id), received, self)
+        return NULL_TRACE
+
+    def record(self, hop: str, duration: float) -> None:
+        """Records the duration (ms) of a single hop"""
+        if hop not in self.hops:
+            self.hops[hop] = deque(maxlen=self.max_samples)
+        self.hops[hop].append(duration)
+
+    def summary(self) -> Dict:
+        """Returns count and p50/p95/p99/max latencies (ms) of every hop"""
+        summary = {}
+        for hop, samples in self.hops.items():
+            ordered = sorted(samples)
+            summary[hop] = {
+                "count": len(ordered),
+                "p50": percentile(ordered, 50),
+                "p95": percentile(ordered, 95),
+                "p99": percentile(ordered, 99),
+                "max": ordered[-1],
+            }
+        return summary
+
+
+class Trace:
+    """Timing spans recorded while a single traced frame is handled"""
+
+    def __init__(self, trace_id: str, received: float, tracer: Tracer):
+        self.trace_id = trace_id
+        self.received = received
+        self.tracer = tracer
+        self.spans: Dict[str, float] = {}
+
+    @contextmanager
+    def span(self, name: str):
+        """Times the enclosed block as the hop `name`"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, start)
+
+    def add(self, name: str, start: float) -> None:
+        """Adds a span that started at `start` and ends now"""
+        duration = (time.perf_counter() - start) * 1000
+        self.spans[name] = self.spans.get(name, 0.0) + duration
+
+    def timings(self) -> Dict:
+        """Spans recorded so far including the running total"""
+        return {
+            **{name: round(value, 3) for name, value in self.spans.items()},
+            "total": round((time.perf_counter() - self.received) * 1000, 3),
+        }
+
+    def fields(self) -> Dict:
+        """Trace fields added to the frames sent back to clients"""
+        return {"trace_id": self.trace_id, "timings": self.timings()}
+
+    def finish(self) -> None:
+        """Stores the spans of this trace in the tracer"""
+        timings = self.timings()
+        for name, value in timings.items():
+            self.tracer.record(name, value)
+        logger.debug(f"trace {self.trace_id}: {timings}")
+
+
+class NullTrace:
+    """Trace used for frames without a trace_id, records nothing"""
+
+    trace_id = None
+
+    def span(self, name: str):
+        """Does not time anything"""
+        return nullcontext()
+
+    def add(self, name: str, start: float) -> None:
+        """Does nothing"""
+
+    def fields(self) -> Dict:
+        """Untraced frames are sent back unchanged"""
+        return {}
+
+    def finish(self) -> None:
+        """Does nothing"""
+
+
+NULL_TRACE = NullTrace()
+
+
+def percentile(ordered: list, pct: float) -> float:
+    """Nearest-rank percentile of an already sorted list"""
+    if not ordered:
+        return 0.0
+    index = max(0, min(len(ordered) - 1, round(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
@@ -1,9 +1,13 @@
+import asyncio
 import json
+import math
+import time
 from functools import wraps
 
 from fastapi import WebSocket, WebSocketDisconnect
 from loguru import logger
 from starlette.websockets import WebSocketState
+from websockets.exceptions import ConnectionClosed
 
 from . import managers
 
@@ -27,6 +31,28 @@ def websocket_connection(method):
     return _impl
 
 
+# raised by the fields of a malformed request, the request is dropped and the session goes on
+MALFORMED_REQUEST = (KeyError, TypeError, ValueError, AttributeError, OverflowError)
+
+
+def non_negative(value, kind: type) -> int | float | None:
+    """A count or number of secs sent by a client converted to kind, None stays None
+
+    :raises ValueError if it isn't a finite, non-negative number
+    """
+    if value is None:
+        return None
+    if isinstance(value, bool):
+        raise ValueError(f"{value!r} is not a number")
+    try:
+        number = kind(value)
+    except (TypeError, OverflowError) as e:
+        raise ValueError(f"{value!r} is not a number") from e
+    if not math.isfinite(number) or number < 0:
+        raise ValueError(f"{value!r} is not a non-negative number")
+    return number
+
+
 class User(object):
     """Class which handles and setups the incoming client connection"""
 
@@ -36,7 +62,8 @@ class User(object):
     connections: managers.ConnectionManager
     logged_in: bool
     session_id: str
-    username: str
+    username: str = None
+    last_active: float  # time.monotonic() of the last frame received
 
     @classmethod
     async def create(
@@ -55,17 +82,52 @@ class User(object):
         self.logged_in = False
         self.db = db
         self.close = False
+        self.last_active = time.monotonic()
         yield self
         self.user_id = None
         self.user_id = await self.wait_for_auth()
         await self.handle_user(self.user_id)
 
+    async def send_to_roommate(self, websocket: WebSocket, data: dict) -> bool:
+        """Sends data to the roommate, a roommate disconnecting meanwhile must not end this session"""
+        try:
+            await websocket.send_json(data)
+            return True
+        except (ConnectionClosed, RuntimeError):
+            logger.debug(
+                f"roommate of {self.username} disconnected before {data['type']}"
+            )
+            return False
+
+    async def send_pending(self) -> None:
+        """Sends the messages that arrived while the user was offline, they stay queued until acked"""
+        if pending := self.db.get_pending(self.user_id):
+            usernames = {}
+            for message in pending:
+                if message["sender"] not in usernames:
+                    sender = self.db.get_user(message["sender"])
+                    usernames[message["sender"]] = sender and sender["username"]
+                message["sender_username"] = usernames[message["sender"]]
+            logger.debug(f"sending {len(pending)} pending messages to {self.username}")
+            await self.websocket.send_json({"type": "msg.pending", "messages": pending})
+
     @websocket_connection
     async def wait_for_auth(self) -> str:
         """Authenticates(login or register) incoming connections from a user"""
+        deadline = time.monotonic() + self.connections.auth_timeout
         while not self.logged_in and not self.close:
             try:
-                request = await self.websocket.receive_json()
+                try:
+                    request = await asyncio.wait_for(
+                        self.websocket.receive_json(), deadline - time.monotonic()
+                    )
+                except asyncio.TimeoutError:
+                    logger.debug(f"Session {self.session_id} did not log in in time")
+                    self.connections.auth_timeouts += 1
+                    self.close = True
+                    await self.websocket.close()
+                    return None
+                self.last_active = time.monotonic()
                 user_data = {}
                 if request["type"] == "user.login":
                     users = self.db.get_user()
@@ -75,6 +137,17 @@ class User(object):
                                 user_data["user_id"] = users[i]["user_id"]
                                 user_data["username"] = users[i]["username"]
                                 user_data["rooms"] = self.db.get_user_rooms(
+                                    user_data["user_id"],
+                                    {
+                                        room_id: int(seq)
+                                        for room_id, seq in request.get(
+                                            "known", {}
+                                        ).items()
+                                    },
+                                )
+                                user_data[
+                                    "online_contacts"
+                                ] = self.connections.online_contacts(
                                     user_data["user_id"]
                                 )
                                 logger.info(f"{request['username']} logged in")
@@ -83,6 +156,11 @@ class User(object):
                                 )
                                 self.logged_in = True
                                 self.username = request["username"]
+                                self.user_id = user_data["user_id"]
+                                await self.connections.login_session(
+                                    self.session_id, self.user_id
+                                )
+                                await self.send_pending()
                                 return user_data["user_id"]
                     else:
                         await self.websocket.send_json(
@@ -116,10 +194,10 @@ class User(object):
                                 "message": "username already exists",
                             }
                         )
-            except KeyError:
-                logger.info("Wrong dict sent by client")
             except json.JSONDecodeError:
                 logger.debug("Wrong json data sent from client")
+            except MALFORMED_REQUEST:
+                logger.info("Wrong dict sent by client")
 
     @websocket_connection
     async def handle_user(self, user_id: str) -> None:
@@ -127,67 +205,201 @@ class User(object):
         while not self.close:
             try:
                 if self.websocket.client_state == WebSocketState.CONNECTED:
-                    request = await self.websocket.receive_json()
-                    if request["type"] == "msg.send":
-                        roommate_websocket = self.connections.is_user_online(
-                            request["other_id"]
-                        )
-                        message_id = self.db.create_message(
-                            user_id,
-                            request["data"],
-                            request["timestamp"],
-                            request["room_id"],
+                    raw_request = await self.websocket.receive_text()
+                    received = time.perf_counter()
+                    self.last_active = time.monotonic()
+                    request = json.loads(raw_request)
+                    trace = self.connections.tracer.start(
+                        request.get("trace_id"), received
+                    )
+                    trace.add("receive", received)
+                    client_message_id = request.get("client_message_id")
+                    if request["type"] == "msg.send" and (
+                        sent := self.db.sent_message(user_id, client_message_id)
+                    ):
+                        # a retry of a message that was already created
+                        await self.websocket.send_json(
+                            {
+                                "type": "msg.sent",
+                                **sent,
+                                "client_message_id": client_message_id,
+                                "room_id": request["room_id"],
+                                "duplicate": True,
+                                **trace.fields(),
+                            }
                         )
+                    elif request["type"] == "msg.send":
+                        if not isinstance(request["data"], str):
+                            raise TypeError("the data of msg.send must be a str")
+                        with trace.span("route"):
+                            roommate_websocket = self.connections.is_user_online(
+                                request["other_id"]
+                            )
+                        with trace.span("db"):
+                            expires_at = self.db.expires_at(
+                                request["room_id"],
+                                non_negative(request.get("ttl") or None, float),
+                            )
+                            message_id = self.db.create_message(
+                                user_id,
+                                request["data"],
+                                request["timestamp"],
+                                request["room_id"],
+                                client_message_id,
+                                expires_at=expires_at,
+                            )
+                            seq = self.db.latest_seq(request["room_id"])
+                        if expires_at is not None:
+                            self.connections.schedule_expiry()
+                        delivered = False
                         if roommate_websocket:
-                            await roommate_websocket.send_json(
+                            with trace.span("send.recv"):
+                                delivered = await self.send_to_roommate(
+                                    roommate_websocket,
+                                    {
+                                        "type": "msg.recv",
+                                        "message_id": message_id,
+                                        "user_id": user_id,
+                                        "sender_username": self.username,
+                                        "data": request["data"],
+                                        "room_id": request["room_id"],
+                                        "timestamp": request["timestamp"],
+                                        "seq": seq,
+                                        "expires_at": expires_at,
+                                        **trace.fields(),
+                                    },
+                                )
+                        if not delivered:
+                            # sent with the next login of the roommate instead
+                            self.db.add_pending(
+                                request["other_id"], request["room_id"], seq
+                            )
+                        with trace.span("send.sent"):
+                            await self.websocket.send_json(
                                 {
-                                    "type": "msg.recv",
+                                    "type": "msg.sent",
                                     "message_id": message_id,
-                                    "user_id": user_id,
-                                    "sender_username": self.username,
-                                    "data": request["data"],
+                                    "client_message_id": client_message_id,
                                     "room_id": request["room_id"],
-                                    "timestamp": request["timestamp"],
+                                    "seq": seq,
+                                    "expires_at": expires_at,
+                                    **trace.fields(),
                                 }
                             )
-                        await self.websocket.send_json(
-                            {
-                                "type": "msg.sent",
-                                "message_id": message_id,
-                                "room_id": request["room_id"],
-                            }
-                        )
                     elif request["type"] == "room.create":
                         other_username = None
-                        if db_data := self.db.get_user(request["other_id"]):
-                            other_username = db_data["username"]
-                        room_id = self.db.create_room(
-                            request["user_id"], request["other_id"]
-                        )
-                        await self.websocket.send_json(
-                            {
-                                "type": "room.create.success",
-                                "room_id": room_id,
-                                "other_username": other_username,
-                            }
-                        )
+                        with trace.span("db"):
+                            if db_data := self.db.get_user(request["other_id"]):
+                                other_username = db_data["username"]
+                            room_id = self.db.create_room(
+                                request["user_id"],
+                                request["other_id"],
+                                non_negative(request.get("ttl") or None, float),
+                            )
+                        with trace.span("send.sent"):
+                            await self.websocket.send_json(
+                                {
+                                    "type": "room.create.success",
+                                    "room_id": room_id,
+                                    "other_username": other_username,
+                                    **trace.fields(),
+                                }
+                            )
                         self.db.save()
                     elif request["type"] == "msg.typing.send":
-                        roommate_websocket = self.connections.is_user_online(
-                            request["other_id"]
-                        )
+                        with trace.span("route"):
+                            roommate_websocket = self.connections.is_user_online(
+                                request["other_id"]
+                            )
                         if roommate_websocket:
-                            await roommate_websocket.send_json(
+                            with trace.span("send.recv"):
+                                await self.send_to_roommate(
+                                    roommate_websocket,
+                                    {
+                                        "type": "msg.typing.recv",
+                                        "user_id": user_id,
+                                        "sender_username": self.username,
+                                        "data": request["data"],
+                                        "state": request.get("state", "typing"),
+                                        "room_id": request["room_id"],
+                                        "timestamp": request["timestamp"],
+                                        **trace.fields(),
+                                    },
+                                )
+                    elif request["type"] == "msg.history":
+                        if self.db.is_room_member(request["room_id"], user_id):
+                            with trace.span("db"):
+                                messages = self.db.get_latest_messages(
+                                    request["room_id"],
+                                    min(int(request.get("n", 20)), 100),
+                                    (
+                                        int(request["before"])
+                                        if request.get("before") is not None
+                                        else None
+                                    ),
+                                )
+                            await self.websocket.send_json(
                                 {
-                                    "type": "msg.typing.recv",
-                                    "user_id": user_id,
-                                    "sender_username": self.username,
-                                    "data": request["data"],
+                                    "type": "msg.history",
                                     "room_id": request["room_id"],
-                                    "timestamp": request["timestamp"],
+                                    "messages": messages,
+                                    **trace.fields(),
                                 }
                             )
-            except KeyError:
-                logger.info(f"Wrong dict sent by {self.username}")
+                    elif request["type"] == "msg.search":
+                        with trace.span("db"):
+                            found = self.db.search_messages(
+                                user_id,
+                                str(request["query"]),
+                                max(0, int(request.get("offset", 0))),
+                                min(int(request.get("limit", 20)), 50),
+                            )
+                        await self.websocket.send_json(
+                            {
+                                "type": "msg.search.results",
+                                "query": request["query"],
+                                **found,
+                                **trace.fields(),
+                            }
+                        )
+                    elif request["type"] == "room.read":
+                        if self.db.is_room_member(request["room_id"], user_id):
+                            seq = self.db.mark_read(
+                                request["room_id"], user_id, int(request["seq"])
+                            )
+                            if seq is not None:
+                                self.connections.queue_read_receipt(
+                                    request["room_id"], user_id, seq
+                                )
+                    elif request["type"] == "msg.ack":
+                        self.db.ack_pending(
+                            user_id,
+                            {
+                                room_id: int(seq)
+                                for room_id, seq in request["seqs"].items()
+                            },
+                        )
+                    elif request["type"] == "room.retention":
+                        if self.db.is_room_member(request["room_id"], user_id):
+                            try:
+                                max_count = non_negative(request.get("max_count"), int)
+                                max_age = non_negative(request.get("max_age"), float)
+                            except ValueError as e:
+                                logger.info(
+                                    f"Invalid retention sent by {self.username}: {e}"
+                                )
+                            else:
+                                self.db.set_room_retention(
+                                    request["room_id"], max_count, max_age
+                                )
+                    elif request["type"] == "room.ttl":
+                        if self.db.is_room_member(request["room_id"], user_id):
+                            self.db.set_room_ttl(
+                                request["room_id"],
+                                non_negative(request.get("ttl") or None, float),
+                            )
+                    trace.finish()
             except json.JSONDecodeError:
                 logger.debug(f"Wrong json data sent by {self.username}")
+            except MALFORMED_REQUEST:
+                logger.info(f"Wrong dict sent by {self.username}")
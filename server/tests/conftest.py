@@ -0,0 +1,54 @@
+"""Fixtures shared by the server tests"""
+
+import pytest
+
+from server.managers import DbManager
+
+
+@pytest.fixture
+def store_dir(tmp_path):
+    """Directory with the empty users.json and rooms.json a new server starts from"""
+    (tmp_path / "users.json").touch()
+    (tmp_path / "rooms.json").touch()
+    return tmp_path
+
+
+@pytest.fixture
+def make_db(store_dir):
+    """Builds DbManagers on store_dir, e.g. to load what an earlier one saved"""
+
+    def make(**kwargs) -> DbManager:
+        kwargs.setdefault("max_count", 20)
+        return DbManager(
+            str(store_dir / "users.json"), str(store_dir / "rooms.json"), **kwargs
+        )
+
+    return make
+
+
+@pytest.fixture
+def db(make_db) -> DbManager:
+    """Empty store with a hot window of 20 messages per room"""
+    return make_db()
+
+
+@pytest.fixture
+def room(db):
+    """(room_id, first user_id, second user_id) of a room of two new users"""
+    first = db.create_user("first", "password")
+    second = db.create_user("second", "password")
+    return db.create_room(first, second), first, second
+
+
+@pytest.fixture
+def send():
+    """Function creating count messages from the first user of a room, texts are message <n>"""
+
+    def send_messages(
+        db: DbManager, room, count: int, start: int = 0, **kwargs
+    ) -> None:
+        room_id, sender, _ = room
+        for number in range(start, start + count):
+            db.create_message(sender, f"message {number}", "1.0", room_id, **kwargs)
+
+    return send_messages
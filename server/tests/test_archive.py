@@ -0,0 +1,162 @@
+import os
+
+import pytest
+
+from server.archive import MessageArchive
+from server.user import non_negative
+
+
+def archived(count: int, first: int = 0) -> list:
+    """Message dicts with seqs first..first+count-1 as RoomMessages.trim returns them"""
+    return [
+        {
+            "message_id": f"id {seq}",
+            "sender": "alice",
+            "message": f"message {seq}",
+            "timestamp": "1.0",
+            "seq": seq,
+        }
+        for seq in range(first, first + count)
+    ]
+
+
+@pytest.fixture
+def archive(tmp_path) -> MessageArchive:
+    """Empty archive in a temporary directory"""
+    return MessageArchive(str(tmp_path / "archive"))
+
+
+def test_segments_are_read_back(archive, tmp_path):
+    """Segments are found on disk by a new archive, latest messages first"""
+    archive.write_segment("room", archived(5))
+    archive.write_segment("room", archived(5, first=5))
+    reopened = MessageArchive(str(tmp_path / "archive"))
+    assert reopened.room_segments("room") == [(0, 4), (5, 9)]
+    assert [message["seq"] for message in reopened.get_messages("room", 8, 4)] == [
+        4,
+        5,
+        6,
+        7,
+    ]
+    assert reopened.get_messages("other", 10, 5) == []
+
+
+def test_archived_seqs_are_not_archived_again(archive):
+    """Only the part of a range that isn't archived yet is written"""
+    archive.write_segment("room", archived(5))
+    archive.write_segment("room", archived(5))
+    archive.write_segment("room", archived(6, first=3))
+    assert archive.room_segments("room") == [(0, 4), (5, 8)]
+
+
+def test_overlapping_segments_are_skipped_on_load(archive, tmp_path):
+    """Segments left behind by archiving a range twice don't duplicate seqs"""
+    archive.write_segment("room", archived(5))
+    # as an archive without the check wrote them
+    archive.segments["room"] = []
+    archive.write_segment("room", archived(3, first=2))
+    reopened = MessageArchive(str(tmp_path / "archive"))
+    assert reopened.room_segments("room") == [(0, 4)]
+
+
+def test_discard_from(archive):
+    """Segments starting at or past a seq are deleted from disk"""
+    for first in (0, 5, 10):
+        archive.write_segment("room", archived(5, first=first))
+    path = archive.segment_path("room", 10, 14)
+    archive.discard_from("room", 5)
+    assert archive.room_segments("room") == [(0, 4)]
+    assert not os.path.exists(path)
+
+
+def test_expire_rewrites_segments(archive, tmp_path):
+    """Expired texts are dropped from the segment file, expiring twice is a no-op"""
+    archive.write_segment("room", archived(5))
+    expired = archive.expire("room", [1, 3, 99])
+    assert [(message["seq"], text) for message, text in expired] == [
+        (1, "message 1"),
+        (3, "message 3"),
+    ]
+    assert archive.expire("room", [1]) == []
+    reopened = MessageArchive(str(tmp_path / "archive"))
+    messages = reopened.get_messages("room", 5, 5)
+    assert [message.get("expired", False) for message in messages] == [
+        False,
+        True,
+        False,
+        True,
+        False,
+    ]
+
+
+def test_retention_archives_in_batches(db, room, send):
+    """A room keeps its hot window, history past it is still readable"""
+    room_id = room[0]
+    send(db, room, 26)
+    messages = db.rooms[room_id]["messages"]
+    assert len(messages) == 20
+    assert db.archive.room_segments(room_id) == [(0, 5)]
+    assert [message["seq"] for message in db.iter_messages(room_id)] == list(range(26))
+    assert [m["message"] for m in db.get_latest_messages(room_id, 3, 3)] == [
+        "message 0",
+        "message 1",
+        "message 2",
+    ]
+
+
+def test_room_retention_overrides_the_default(db, room, send):
+    """A room with its own max_count is trimmed to it right away"""
+    room_id = room[0]
+    send(db, room, 10)
+    db.set_room_retention(room_id, max_count=2)
+    assert len(db.rooms[room_id]["messages"]) == 2
+    assert db.rooms[room_id]["messages"].base == 8
+
+
+def test_restart_without_save_does_not_duplicate_seqs(make_db, db, room, send):
+    """Segments archived after the last save are dropped, the saved hot window has them"""
+    room_id = room[0]
+    send(db, room, 30)
+    db.save()
+    send(db, room, 70, start=30)  # archived, but rooms.json isn't saved again
+    restarted = make_db()
+    assert (
+        restarted.archive.room_segments(room_id)
+        == db.archive.room_segments(room_id)[:1]
+    )
+    send(restarted, room, 100, start=100)
+    history = list(restarted.iter_messages(room_id))
+    assert [message["seq"] for message in history] == list(range(130))
+    assert [message["message"] for message in history[29:31]] == [
+        "message 29",
+        "message 100",
+    ]
+    restarted.save()
+    reloaded = make_db()
+    assert list(reloaded.iter_messages(room_id)) == history
+
+
+@pytest.mark.parametrize(
+    "value, kind, expected",
+    [
+        (None, int, None),
+        (5, int, 5),
+        ("5", int, 5),
+        (0, float, 0.0),
+        ("1.5", float, 1.5),
+    ],
+)
+def test_non_negative(value, kind, expected):
+    """Counts and secs sent by clients are converted"""
+    assert non_negative(value, kind) == expected
+
+
+@pytest.mark.parametrize(
+    "value", [-1, "abc", True, [], {}, float("inf"), float("nan"), 1e400]
+)
+def test_non_negative_rejects(value):
+    """Anything but a finite, non-negative number raises ValueError"""
+    with pytest.raises(ValueError):
+        non_negative(value, float)
+    with pytest.raises(ValueError):
+        non_negative(value, int)
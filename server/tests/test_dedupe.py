@@ -0,0 +1,36 @@
+def test_sent_messages_are_remembered(db, room, send):
+    """A retry gets the id, seq and expiry of the message it created"""
+    room_id, first, _ = room
+    send(db, room, 2)
+    message_id = db.create_message(
+        first, "hello", "1.0", room_id, client_message_id="c", expires_at=99.0
+    )
+    assert db.sent_message(first, "c") == {
+        "message_id": message_id,
+        "seq": 2,
+        "expires_at": 99.0,
+    }
+    assert db.sent_message(room[2], "c") is None
+
+
+def test_only_the_latest_are_remembered(make_db):
+    """At most dedupe_size client ids are kept per user, the oldest are dropped"""
+    db = make_db(dedupe_size=2)
+    first = db.create_user("first", "password")
+    room_id = db.create_room(first, db.create_user("second", "password"))
+    for client_message_id in "xyz":
+        db.create_message(first, "hi", "1.0", room_id, client_message_id)
+    assert db.sent_message(first, "x") is None
+    assert db.sent_message(first, "z")["seq"] == 2
+
+
+def test_sent_messages_survive_a_restart(make_db, db, room, send):
+    """Clients resend unconfirmed messages after a restart, those must not be created twice"""
+    room_id, first, _ = room
+    send(db, room, 3, client_message_id=None)
+    for client_message_id in ("x", "y"):
+        db.create_message(first, "hi", "1.0", room_id, client_message_id)
+    db.save()
+    restarted = make_db()
+    assert list(restarted.sent_messages[first]) == ["x", "y"]
+    assert restarted.sent_message(first, "y") == db.sent_message(first, "y")
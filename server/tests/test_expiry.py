@@ -0,0 +1,114 @@
+import time
+
+from server.expiry import ExpiryQueue
+
+
+def texts(messages) -> list:
+    """Texts of a page of messages"""
+    return [message["message"] for message in messages]
+
+
+def test_due_messages_pop_in_order(tmp_path):
+    """Only the messages that ran out are popped, grouped by room"""
+    queue = ExpiryQueue(str(tmp_path / "expiry.json"))
+    queue.add(30.0, "b", 1)
+    queue.add(10.0, "a", 4)
+    queue.add(20.0, "a", 2)
+    assert queue.next_expiry() == 10.0
+    assert queue.pop_due(25.0) == {"a": [4, 2]}
+    assert queue.next_expiry() == 30.0
+    assert queue.pop_due(25.0) == {}
+
+
+def test_the_queue_is_persisted(tmp_path):
+    """A restarted server still expires the messages queued before"""
+    queue = ExpiryQueue(str(tmp_path / "expiry.json"))
+    queue.add(10.0, "a", 4)
+    queue.save()
+    reloaded = ExpiryQueue(str(tmp_path / "expiry.json"))
+    assert len(reloaded) == 1
+    assert reloaded.pop_due(10.0) == {"a": [4]}
+
+
+def test_a_corrupt_queue_starts_empty(tmp_path):
+    """A queue file cut short by a crash doesn't keep the server from starting"""
+    (tmp_path / "expiry.json").write_text("[[10.0, ")
+    assert len(ExpiryQueue(str(tmp_path / "expiry.json"))) == 0
+
+
+def test_messages_expire_when_due(db, room, send):
+    """expire_due drops the texts, search hits and unread counts of due messages only"""
+    room_id, first, second = room
+    now = time.time()
+    send(db, room, 2, expires_at=now + 10)
+    send(db, room, 1, start=2)
+    expired = db.expire_due(now + 5)
+    assert expired == {}
+    expired = db.expire_due(now + 10)
+    assert [message["seq"] for message in expired[room_id]] == [0, 1]
+    assert texts(db.get_latest_messages(room_id)) == ["message 2"]
+    assert db.get_message(room_id, 0) is None
+    assert db.search_messages(second, "message 1")["total"] == 0
+    assert db.get_user_rooms(second)[0]["unread"] == 1
+    assert db.expire_messages(room_id, [0, 1]) == []
+
+
+def test_room_ttl_applies_to_new_messages(db, room):
+    """A message lives for the shorter of its own ttl and the room's"""
+    room_id, _, _ = room
+    assert db.expires_at(room_id) is None
+    db.set_room_ttl(room_id, 60)
+    assert db.expires_at(room_id, 30) - time.time() <= 30
+    assert 30 < db.expires_at(room_id, 120) - time.time() <= 60
+    db.set_room_ttl(room_id, None)
+    assert db.expires_at(room_id) is None
+
+
+def test_archived_messages_expire(db, room, send):
+    """Messages retention moved into the archive expire there"""
+    room_id, first, second = room
+    send(db, room, 60)
+    assert db.rooms[room_id]["messages"].base > 5
+    expired = db.expire_messages(room_id, [3, 5])
+    assert [message["seq"] for message in expired] == [3, 5]
+    assert db.get_message(room_id, 3) is None
+    assert db.search_messages(second, "message 5")["total"] == 0
+    assert db.get_message(room_id, 4)["message"] == "message 4"
+
+
+def test_history_pages_leave_out_expired_messages(db, room, send):
+    """A page has n messages as long as there are older live ones, in memory or archived"""
+    room_id, _, _ = room
+    send(db, room, 60)
+    # the even ones from the last 15 archived messages on
+    base = db.rooms[room_id]["messages"].base
+    expired = [seq for seq in range(base - 15, 60) if seq % 2 == 0]
+    db.expire_messages(room_id, expired)
+    live = [seq for seq in range(60) if seq not in expired]
+    page = db.get_latest_messages(room_id, 10)
+    assert [message["seq"] for message in page] == live[-10:]
+    page = db.get_latest_messages(room_id, 20, page[0]["seq"])
+    assert [message["seq"] for message in page] == live[-30:-10]
+    assert page[0]["seq"] < base - 15
+
+
+def test_a_page_of_expired_messages_doesnt_end_the_history(db, room, send):
+    """Older live messages behind a run of expired ones are still found"""
+    room_id, _, _ = room
+    send(db, room, 60)
+    db.expire_messages(room_id, list(range(10, 60)))
+    assert texts(db.get_latest_messages(room_id, 5)) == [
+        f"message {number}" for number in range(5, 10)
+    ]
+
+
+def test_reads_dont_count_expired_messages(db, room, send):
+    """The unread count after a read cursor moves leaves out expired messages"""
+    room_id, _, second = room
+    send(db, room, 60)
+    db.expire_messages(room_id, [5, 6, 50, 51])
+    assert db.mark_read(room_id, second, 1) == 1
+    assert db.get_user_rooms(second)[0]["unread"] == 54
+    assert db.mark_read(room_id, second, 1) is None
+    assert db.mark_read(room_id, second, 100) == 59
+    assert db.get_user_rooms(second)[0]["unread"] == 0
@@ -0,0 +1,95 @@
+import json
+import uuid
+
+import pytest
+
+from server.messages import RoomMessages, compact_room_hook, materialize
+
+
+def new_messages(count: int, base: int = 0) -> RoomMessages:
+    """Builds RoomMessages of count messages alternating between two senders"""
+    messages = RoomMessages(base)
+    for number in range(count):
+        messages.append(
+            str(uuid.uuid4()), ("alice", "bob")[number % 2], f"text {number}", number
+        )
+    return messages
+
+
+def test_messages_are_materialized_with_their_seq():
+    """Dicts have the fields rooms.json always had plus the seq"""
+    messages = new_messages(3, base=10)
+    message_id = str(uuid.uuid4())
+    messages.append(message_id, "alice", "hello", "12.5")
+    assert len(messages) == 4
+    assert messages.next_seq == 14
+    assert messages.message(3) == {
+        "message_id": message_id,
+        "sender": "alice",
+        "message": "hello",
+        "timestamp": "12.5",
+        "seq": 13,
+    }
+    assert [message["seq"] for message in messages.to_dicts(1, 3)] == [11, 12]
+
+
+def test_unparsable_timestamps_get_the_server_time():
+    """A client sending garbage as timestamp still gets its message stored"""
+    messages = RoomMessages()
+    messages.append(str(uuid.uuid4()), "alice", "hello", "yesterday")
+    assert messages.timestamps[0] > 0
+
+
+def test_senders_are_shared():
+    """Every message of a sender refers to one string"""
+    messages = RoomMessages()
+    for _ in range(2):
+        messages.append(str(uuid.uuid4()), "".join(["al", "ice"]), "hi", 0)
+    assert messages.senders[0] is messages.senders[1]
+
+
+def test_trim_moves_the_base():
+    """Trimmed messages come back materialized, the seqs of the rest don't change"""
+    messages = new_messages(5)
+    removed = messages.trim(2)
+    assert [message["seq"] for message in removed] == [0, 1]
+    assert messages.base == 2
+    assert messages.next_seq == 5
+    assert messages.message(0)["message"] == "text 2"
+
+
+def test_expired_messages_keep_their_seq():
+    """Expiring drops the text once and leaves a tombstone"""
+    messages = new_messages(3)
+    assert messages.expire(1) == "text 1"
+    assert messages.expire(1) is None
+    tombstone = messages.message(1)
+    assert tombstone["expired"] is True
+    assert tombstone["message"] == ""
+    assert tombstone["seq"] == 1
+
+
+def test_count_older_than():
+    """Only the leading messages before the cutoff are counted"""
+    messages = new_messages(5)
+    assert messages.count_older_than(3) == 3
+    assert messages.count_older_than(0) == 0
+
+
+@pytest.mark.parametrize("first_seq", [0, 40])
+def test_rooms_json_round_trip(first_seq):
+    """Rooms are saved as message dicts and parsed back into RoomMessages"""
+    messages = new_messages(4, base=first_seq)
+    messages.expire(2)
+    room = {"room_id": "room", "messages": messages, "first_seq": first_seq}
+    saved = json.dumps({"room": room}, default=materialize)
+    loaded = json.loads(saved, object_hook=compact_room_hook)["room"]["messages"]
+    assert isinstance(loaded, RoomMessages)
+    assert loaded.to_dicts() == messages.to_dicts()
+
+
+def test_only_rooms_are_converted():
+    """Other objects with messages pass through unchanged"""
+    assert compact_room_hook({"messages": [1]}) == {"messages": [1]}
+    with pytest.raises(TypeError):
+        materialize(object())
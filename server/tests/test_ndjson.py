@@ -0,0 +1,122 @@
+import io
+import json
+
+import pytest
+
+from server.managers import DbManager
+from server.ndjson import export_objects, export_store, import_store
+
+
+@pytest.fixture
+def other_store(tmp_path):
+    """Builds an empty store in a directory of its own"""
+
+    def make() -> DbManager:
+        directory = tmp_path / "other"
+        directory.mkdir(exist_ok=True)
+        (directory / "users.json").touch()
+        (directory / "rooms.json").touch()
+        return DbManager(
+            str(directory / "users.json"), str(directory / "rooms.json"), max_count=20
+        )
+
+    return make
+
+
+def exported(db: DbManager) -> str:
+    """The store as blak-store export writes it"""
+    out = io.StringIO()
+    export_store(db, out)
+    return out.getvalue()
+
+
+def test_round_trip(db, room, send, other_store):
+    """Users, rooms, archived and expired messages, expiry and pending queues come back"""
+    room_id, first, second = room
+    send(db, room, 60)
+    db.expire_messages(room_id, [3, 59])
+    db.expiry.add(123.0, room_id, 58)
+    db.add_pending(second, room_id, 58)
+    db.mark_read(room_id, second, 40)
+    db.set_room_ttl(room_id, 30)
+
+    imported = other_store()
+    summary = import_store(imported, io.StringIO(exported(db)), batch_size=7)
+    assert summary["messages_added"] == 60
+    assert imported.get_user() == db.get_user()
+    assert list(imported.iter_messages(room_id)) == list(db.iter_messages(room_id))
+    for key in ("users", "read", "unread", "ttl"):
+        assert imported.rooms[room_id][key] == db.rooms[room_id][key]
+    assert list(imported.expiry) == [(123.0, room_id, 58)]
+    assert imported.pending == db.pending
+    assert [m["seq"] for m in imported.get_pending(second)] == [58]
+
+
+def test_import_leaves_indexing_to_the_next_load(db, room, send, other_store):
+    """The search index of an import only grows when the store is loaded again"""
+    room_id, first, _ = room
+    send(db, room, 30)
+    imported = other_store()
+    import_store(imported, io.StringIO(exported(db)), batch_size=10)
+    assert imported.search_index.next_seq(room_id) == 0
+    loaded = other_store()
+    assert loaded.search_index.next_seq(room_id) == 30
+    assert loaded.search_messages(first, "message 7")["total"] == 1
+
+
+def test_existing_rooms_take_the_exported_state(db, room, send, other_store):
+    """Messages a room has are skipped, but their expiry and the room state are applied"""
+    room_id, first, second = room
+    send(db, room, 30)
+    target = other_store()
+    import_store(target, io.StringIO(exported(db)), batch_size=100)
+    db.expire_messages(room_id, [2, 25])
+    db.mark_read(room_id, second, 20)
+    db.set_room_retention(room_id, 10, None)
+    send(db, room, 5, start=30)
+
+    summary = import_store(target, io.StringIO(exported(db)), batch_size=100)
+    assert summary["messages_added"] == 5
+    assert list(target.iter_messages(room_id)) == list(db.iter_messages(room_id))
+    for key in ("read", "unread", "retention"):
+        assert target.rooms[room_id][key] == db.rooms[room_id][key]
+    assert target.search_messages(first, "message 25")["total"] == 0
+
+
+def test_a_gap_in_the_seqs_stops_the_import(db, room, send, other_store):
+    """An export that is missing messages isn't stored with shifted seqs"""
+    send(db, room, 5)
+    lines = [
+        line
+        for line in exported(db).splitlines(keepends=True)
+        if json.loads(line).get("seq") != 2
+    ]
+    target = other_store()
+    with pytest.raises(SystemExit, match="expected seq 2, got 3"):
+        import_store(target, io.StringIO("".join(lines)), batch_size=100)
+
+
+def test_bad_lines_stop_the_import(other_store):
+    """Lines that aren't exported objects are reported with their number"""
+    with pytest.raises(SystemExit, match="line 2"):
+        import_store(
+            other_store(), io.StringIO('{"kind": "user", "user_id": "u"}\n[]\n'), 10
+        )
+    with pytest.raises(SystemExit, match="unknown kind"):
+        import_store(other_store(), io.StringIO('{"kind": "thing"}\n'), 10)
+
+
+def test_export_is_a_snapshot(db, room, send):
+    """Changes made while the export is consumed don't end up in it"""
+    room_id, first, second = room
+    send(db, room, 40)
+    objects = export_objects(db)
+    seqs = []
+    for obj in objects:
+        if obj["kind"] == "message":
+            seqs.append(obj["seq"])
+            # archives messages while the export walks over them
+            send(db, room, 1, start=100 + len(seqs))
+            if len(seqs) == 1:
+                db.create_room(first, db.create_user("third", "password"))
+    assert seqs == list(range(40))
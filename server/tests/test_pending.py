@@ -0,0 +1,52 @@
+def queued(db, user_id: str) -> list:
+    """Seqs of the messages queued for a user"""
+    return [message["seq"] for message in db.get_pending(user_id)]
+
+
+def test_messages_stay_queued_until_acked(db, room, send):
+    """An ack drops the messages up to the acked seq of that room only"""
+    room_id, first, second = room
+    send(db, room, 4)
+    for seq in range(4):
+        db.add_pending(second, room_id, seq)
+    db.add_pending(second, room_id, 1)
+    assert queued(db, second) == [0, 1, 2, 3]
+    assert db.get_pending(second)[0]["room_id"] == room_id
+    db.ack_pending(second, {room_id: 1, "other room": 10})
+    assert queued(db, second) == [2, 3]
+    db.ack_pending(second, {room_id: 3})
+    assert second not in db.pending
+
+
+def test_queues_are_bounded(make_db, send):
+    """Only the latest pending_max messages of a user are queued"""
+    db = make_db(pending_max=3)
+    first = db.create_user("first", "password")
+    second = db.create_user("second", "password")
+    room = (db.create_room(first, second), first, second)
+    send(db, room, 5)
+    for seq in range(5):
+        db.add_pending(second, room[0], seq)
+    assert queued(db, second) == [2, 3, 4]
+
+
+def test_expired_messages_are_not_sent(db, room, send):
+    """A queued message that expired meanwhile is left out"""
+    room_id, _, second = room
+    send(db, room, 3)
+    for seq in range(3):
+        db.add_pending(second, room_id, seq)
+    db.expire_messages(room_id, [1])
+    assert queued(db, second) == [0, 2]
+
+
+def test_queues_survive_a_restart(db, make_db, room, send):
+    """Queued messages are saved with the store"""
+    room_id, _, second = room
+    send(db, room, 30)
+    db.add_pending(second, room_id, 2)
+    db.add_pending(second, room_id, 29)
+    db.save()
+    restarted = make_db()
+    assert queued(restarted, second) == [2, 29]
+    assert restarted.get_pending(second)[0]["message"] == "message 2"
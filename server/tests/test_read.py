@@ -0,0 +1,35 @@
+def test_unread_counts_and_read_cursors(db, room, send):
+    """Each member sees its own unread count and the read cursors of the others"""
+    room_id, first, second = room
+    send(db, room, 5)
+    db.create_message(second, "reply", "1.0", room_id)
+    assert db.mark_read(room_id, second, 2) == 2
+    rooms = {user_id: db.get_user_rooms(user_id)[0] for user_id in (first, second)}
+    assert rooms[first]["unread"] == 1
+    assert rooms[second]["unread"] == 2
+    assert rooms[second]["read_seq"] == 2
+    assert rooms[first]["read_by"] == {second: 2}
+    assert rooms[second]["read_by"] == {}
+
+
+def test_read_cursors_only_move_forward(db, room, send):
+    """A cursor older than the current one or past the latest message is ignored or clamped"""
+    room_id, _, second = room
+    send(db, room, 5)
+    assert db.mark_read(room_id, second, 3) == 3
+    assert db.mark_read(room_id, second, 1) is None
+    assert db.mark_read(room_id, second, 100) == 4
+    assert db.get_user_rooms(second)[0]["unread"] == 0
+    send(db, room, 2, start=5)
+    assert db.get_user_rooms(second)[0]["unread"] == 2
+
+
+def test_read_cursors_survive_a_restart(db, make_db, room, send):
+    """Cursors and unread counts are saved with the rooms"""
+    room_id, first, second = room
+    send(db, room, 30)
+    db.mark_read(room_id, second, 9)
+    db.save()
+    restarted = make_db().get_user_rooms(second)[0]
+    assert restarted["read_seq"] == 9
+    assert restarted["unread"] == 20
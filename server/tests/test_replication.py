@@ -0,0 +1,253 @@
+import asyncio
+import importlib
+import json
+import time
+
+import pytest
+from fastapi import HTTPException
+from starlette.requests import Request
+
+from server.managers import DbManager, SeqGap
+from server.ndjson import export_objects
+from server.replication import SNAPSHOT_DONE, ChangeLog, Standby
+
+
+@pytest.fixture
+def standby(tmp_path) -> Standby:
+    """Standby with an empty store of its own, not connected to anything"""
+    directory = tmp_path / "standby"
+    directory.mkdir()
+    (directory / "users.json").touch()
+    (directory / "rooms.json").touch()
+    db = DbManager(
+        str(directory / "users.json"), str(directory / "rooms.json"), max_count=20
+    )
+    return Standby(db, str(tmp_path / "primary.sock"))
+
+
+def feed(standby: Standby, lines) -> None:
+    """Lets the standby follow a primary that sends lines and goes away"""
+
+    async def follow():
+        reader = asyncio.StreamReader()
+        for line in lines:
+            reader.feed_data((json.dumps(line) + "\n").encode())
+        reader.feed_eof()
+        await standby.follow(reader)
+
+    asyncio.run(follow())
+
+
+def snapshot(db: DbManager, position: int = 0) -> list:
+    """What a ChangeLog sends a standby that just connected"""
+    return [*export_objects(db), {**SNAPSHOT_DONE, "position": position}]
+
+
+def logged(db: DbManager) -> list:
+    """Collects the changes db logs from now on, numbered like ChangeLog.publish does"""
+    changes = []
+    db.on_change = lambda change: changes.append(
+        {**change, "position": len(changes) + 1}
+    )
+    return changes
+
+
+def same_store(standby_db: DbManager, db: DbManager, room_id: str) -> None:
+    """Asserts that the standby has the messages and state of the primary"""
+    assert list(standby_db.iter_messages(room_id)) == list(db.iter_messages(room_id))
+    for key in ("users", "read", "unread", "ttl", "retention"):
+        assert standby_db.rooms[room_id].get(key) == db.rooms[room_id].get(key)
+    assert standby_db.pending == db.pending
+
+
+def test_snapshot_then_changes(db, room, send, standby):
+    """The standby applies the snapshot and every change logged after it"""
+    room_id, first, second = room
+    send(db, room, 30)
+    lines = snapshot(db)
+    changes = logged(db)
+    send(db, room, 10, start=30)
+    db.mark_read(room_id, second, 35)
+    db.add_pending(second, room_id, 39)
+    feed(standby, lines + changes)
+    assert standby.synced
+    assert standby.position == len(changes)
+    same_store(standby.db, db, room_id)
+
+
+def test_replayed_changes_are_no_ops(db, room, send, standby):
+    """Changes the snapshot already has, e.g. queued while it was sent, change nothing"""
+    room_id, _, second = room
+    changes = logged(db)
+    send(db, room, 5)
+    db.add_pending(second, room_id, 4)
+    feed(standby, snapshot(db) + changes)
+    same_store(standby.db, db, room_id)
+    assert len(standby.db.pending[second]) == 1
+
+
+def test_a_gap_raises(db, room, send, standby):
+    """A change that doesn't follow on from the last seq isn't stored with a shifted seq"""
+    send(db, room, 3)
+    lines = snapshot(db)
+    changes = logged(db)
+    send(db, room, 2, start=3)
+    with pytest.raises(SeqGap):
+        feed(standby, lines + changes[1:])
+    assert standby.db.latest_seq(room[0]) == 2
+
+
+def test_a_failing_change_is_skipped(db, room, send, standby):
+    """One change that fails to apply doesn't stop the ones after it"""
+    room_id, first, second = room
+    lines = snapshot(db)
+    changes = logged(db)
+    send(db, room, 2)
+    bad = {**changes[0], "message": 123, "position": 0}
+    feed(standby, lines + [bad] + changes)
+    same_store(standby.db, db, room_id)
+
+
+def test_a_new_snapshot_repairs_what_was_missed(db, room, send, standby):
+    """Expirations, room state and pending acks lost with a connection are repaired"""
+    room_id, first, second = room
+    third = db.create_user("third", "password")
+    send(db, room, 60)
+    db.add_pending(second, room_id, 5)
+    db.add_pending(third, room_id, 1)
+    feed(standby, snapshot(db))
+    # changes the standby never got
+    db.expire_messages(room_id, [1, 3, 55, 57])
+    db.mark_read(room_id, second, 40)
+    db.set_room_ttl(room_id, 30)
+    db.set_room_retention(room_id, 10, None)
+    db.ack_pending(third, {room_id: 1})
+    db.add_pending(second, room_id, 6)
+    feed(standby, snapshot(db))
+    same_store(standby.db, db, room_id)
+    assert third not in standby.db.pending
+    assert standby.db.search_messages(second, "message 55")["total"] == 0
+
+
+def test_shipping_over_a_socket(db, room, send, tmp_path, standby):
+    """A standby connecting to a ChangeLog catches up with its position"""
+    room_id, first, second = room
+    send(db, room, 30)
+    change_log = ChangeLog(db, standby.socket_path)
+
+    async def replicate():
+        await change_log.start()
+        following = asyncio.create_task(standby.run())
+        try:
+            deadline = time.monotonic() + 10
+            while not standby.synced:
+                assert time.monotonic() < deadline
+                await asyncio.sleep(0.01)
+            send(db, room, 30, start=30)
+            db.mark_read(room_id, second, 50)
+            while standby.position < change_log.position:
+                assert time.monotonic() < deadline
+                await asyncio.sleep(0.01)
+        finally:
+            following.cancel()
+            await change_log.stop()
+
+    asyncio.run(replicate())
+    same_store(standby.db, db, room_id)
+
+
+def test_following_survives_unexpected_errors(db, tmp_path, standby, monkeypatch):
+    """An error that isn't a connection error makes the standby reconnect, not stop"""
+    change_log = ChangeLog(db, standby.socket_path)
+    follow = standby.follow
+    calls = []
+
+    async def fail_once(reader):
+        calls.append(reader)
+        if len(calls) == 1:
+            raise RuntimeError("bad line")
+        await follow(reader)
+
+    monkeypatch.setattr(standby, "follow", fail_once)
+    monkeypatch.setattr(asyncio, "sleep", fast_sleep(asyncio.sleep))
+
+    async def replicate():
+        await change_log.start()
+        following = asyncio.create_task(standby.run())
+        try:
+            deadline = time.monotonic() + 10
+            while not standby.synced:
+                assert time.monotonic() < deadline
+                assert not following.done()
+                await asyncio.sleep(0.01)
+        finally:
+            following.cancel()
+            await change_log.stop()
+
+    asyncio.run(replicate())
+    assert len(calls) == 2
+
+
+def fast_sleep(sleep):
+    """asyncio.sleep without the waits before reconnecting"""
+
+    async def fast(delay, *args):
+        await sleep(min(delay, 0.01), *args)
+
+    return fast
+
+
+@pytest.fixture
+def standby_app(tmp_path, monkeypatch):
+    """server.app started as a standby shipping to standbys of its own once promoted"""
+    (tmp_path / "server").mkdir()
+    (tmp_path / "server/users.json").touch()
+    (tmp_path / "server/rooms.json").touch()
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv("standby_of", str(tmp_path / "primary.sock"))
+    monkeypatch.setenv("replication_socket", str(tmp_path / "standby.sock"))
+    monkeypatch.setenv("admin_token", "secret")
+    import server.app
+
+    return importlib.reload(server.app)
+
+
+def admin_request(authorization: str = "") -> Request:
+    """Request to an admin endpoint from a remote client"""
+    headers = [(b"authorization", authorization.encode())] if authorization else []
+    return Request(
+        {"type": "http", "headers": headers, "client": ("203.0.113.7", 50000)}
+    )
+
+
+def test_admin_endpoints_want_the_token(standby_app):
+    """Without the admin token remote clients can't use admin endpoints"""
+    standby_app.admin_only(admin_request("Bearer secret"))
+    for authorization in ("", "Bearer wrong", "secret"):
+        with pytest.raises(HTTPException) as refused:
+            standby_app.admin_only(admin_request(authorization))
+        assert refused.value.status_code == 403
+
+
+def test_promote_after_following_failed(standby_app):
+    """A standby whose follow task died can still be promoted"""
+    app = standby_app.app
+
+    async def failed():
+        raise RuntimeError("follow task died")
+
+    async def promote():
+        app.state.following = asyncio.create_task(failed())
+        await asyncio.sleep(0)
+        assert app.state.following.done()
+        try:
+            reply = json.loads((await standby_app.promote()).body)
+            status = json.loads((await standby_app.replication()).body)
+        finally:
+            await standby_app.change_log.stop()
+        return reply, status
+
+    reply, status = asyncio.run(promote())
+    assert reply["promoted"] is True
+    assert app.state.following is None
+    assert status["role"] == "primary"
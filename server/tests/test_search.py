@@ -0,0 +1,122 @@
+import json
+
+import pytest
+
+from server.search import SearchIndex, snippet, tokenize
+
+
+@pytest.fixture
+def index(tmp_path) -> SearchIndex:
+    """Empty index saved in a temporary directory"""
+    return SearchIndex(str(tmp_path / "search_index.json"))
+
+
+def test_tokenize():
+    """Unique lowercase words in the order they appear, long ones are cut"""
+    assert tokenize("Hello, hello WORLD! 42") == ["hello", "world", "42"]
+    assert tokenize("x" * 100) == ["x" * 32]
+
+
+def test_every_word_must_match(index):
+    """Hits contain every word of the query, newest first across rooms"""
+    index.add("a", 0, "red apple", 1.0)
+    index.add("a", 1, "green apple", 2.0)
+    index.add("b", 0, "red apple pie", 3.0)
+    assert index.search("apple", ["a", "b"]) == (3, [("b", 0), ("a", 1), ("a", 0)])
+    assert index.search("red APPLE", ["a", "b"]) == (2, [("b", 0), ("a", 0)])
+    assert index.search("apple", ["a"], offset=1, limit=1) == (2, [("a", 0)])
+    assert index.search("banana", ["a", "b"]) == (0, [])
+    assert index.search("!!", ["a"]) == (0, [])
+
+
+def test_rooms_outside_of_the_query_are_not_searched(index):
+    """A user only finds messages of their own rooms"""
+    index.add("a", 0, "secret", 1.0)
+    assert index.search("secret", ["b"]) == (0, [])
+
+
+def test_remove(index):
+    """Removed messages aren't found anymore"""
+    index.add("a", 0, "red apple", 1.0)
+    index.add("a", 1, "red car", 2.0)
+    index.remove("a", 0, "red apple")
+    index.remove("missing", 0, "red")
+    assert index.search("red", ["a"]) == (1, [("a", 1)])
+    assert index.search("apple", ["a"]) == (0, [])
+
+
+def test_save_and_load(index, tmp_path):
+    """A saved index is loaded as it was, one of another version is dropped"""
+    index.add("a", 0, "red apple", 1.0)
+    index.add("a", 2, "red car", 2.0)  # seq 1 was never indexed
+    index.save()
+    loaded = SearchIndex(index.index_file)
+    assert loaded.next_seq("a") == 3
+    assert loaded.search("red", ["a"]) == (2, [("a", 2), ("a", 0)])
+    with open(index.index_file, "w") as index_file:
+        index_file.write(json.dumps({"version": 1}) + "\n")
+    assert SearchIndex(index.index_file).rooms == {}
+
+
+def test_snippet():
+    """Long texts are cut around the first match"""
+    text = "a" * 100 + " needle " + "b" * 100
+    assert "needle" in snippet(text, "needle")
+    assert snippet(text, "needle").startswith("…")
+    assert snippet("short text", "missing") == "short text"
+
+
+def test_search_messages(db, room, send):
+    """Results carry the message, its room and a snippet"""
+    room_id, first, second = room
+    send(db, room, 3)
+    found = db.search_messages(second, "message 1")
+    assert found["total"] == 1
+    assert found["results"][0]["message"] == "message 1"
+    assert found["results"][0]["room_id"] == room_id
+    stranger = db.create_user("stranger", "password")
+    assert db.search_messages(stranger, "message")["total"] == 0
+
+
+def test_expired_messages_are_not_found(db, room, send):
+    """Expiring a message removes it from the index"""
+    room_id, first, _ = room
+    send(db, room, 3)
+    db.expire_messages(room_id, [1])
+    assert db.search_messages(first, "1")["total"] == 0
+
+
+def test_index_catches_up_on_load(make_db, db, room, send):
+    """Messages saved after the index are indexed when the store is loaded"""
+    room_id, first, _ = room
+    send(db, room, 50)
+    db.save()
+    send(db, room, 10, start=50)
+    db.expire_messages(room_id, [55])
+    db.save()
+    # as if the index had been saved before the last messages
+    stale = SearchIndex(db.search_index.index_file)
+    stale.rooms[room_id].timestamps = stale.rooms[room_id].timestamps[:50]
+    for posting in stale.rooms[room_id].postings.values():
+        while posting and posting[-1] >= 50:
+            posting.pop()
+    stale.save()
+    loaded = make_db()
+    assert loaded.search_index.next_seq(room_id) == 60
+    assert loaded.search_messages(first, "message")["total"] == 59
+    assert loaded.search_messages(first, "57")["total"] == 1
+
+
+def test_non_str_texts_change_nothing(db, room, send):
+    """A message text that isn't a str is refused before anything is stored"""
+    room_id, first, _ = room
+    send(db, room, 1)
+    changes = []
+    db.on_change = changes.append
+    with pytest.raises(TypeError):
+        db.create_message(first, 123, "1.0", room_id, client_message_id="c")
+    assert changes == []
+    assert db.latest_seq(room_id) == 0
+    assert db.sent_message(first, "c") is None
+    send(db, room, 1, start=1)
+    assert [m["seq"] for m in db.iter_messages(room_id)] == [0, 1]
@@ -0,0 +1,118 @@
+import asyncio
+import json
+
+from fastapi import WebSocketDisconnect
+from starlette.websockets import WebSocketState
+
+from server.managers import ConnectionManager
+from server.user import User
+
+
+class ClientWebSocket:
+    """Websocket of a client that sends frames and disconnects, keeping what it received"""
+
+    client_state = WebSocketState.CONNECTED
+
+    def __init__(self, frames):
+        self.frames = list(frames)
+        self.received = []
+
+    async def receive_text(self) -> str:
+        """Next frame of the client, a disconnect once it sent them all"""
+        if not self.frames:
+            raise WebSocketDisconnect()
+        frame = self.frames.pop(0)
+        return frame if isinstance(frame, str) else json.dumps(frame)
+
+    async def send_json(self, data: dict) -> None:
+        """Keeps a frame the server sent"""
+        self.received.append(data)
+
+
+def session(db, user_id: str, frames) -> list:
+    """Runs a logged-in session of user_id sending frames, returns the frames it got"""
+    user = User()
+    user.db = db
+    user.connections = ConnectionManager(db)
+    user.websocket = ClientWebSocket(frames)
+    user.session_id = "session"
+    user.close = False
+    user.logged_in = True
+    user.user_id = user_id
+    user.username = db.get_user(user_id)["username"]
+    asyncio.run(user.handle_user(user_id))
+    return user.websocket.received
+
+
+def msg_send(room, data, **fields) -> dict:
+    """A msg.send frame from the first user of room to the second"""
+    room_id, _, second = room
+    return {
+        "type": "msg.send",
+        "data": data,
+        "room_id": room_id,
+        "other_id": second,
+        "timestamp": "1.0",
+        **fields,
+    }
+
+
+def test_malformed_requests_dont_end_the_session(db, room):
+    """Frames with missing or wrong fields are dropped and the next ones handled"""
+    room_id, first, _ = room
+    received = session(
+        db,
+        first,
+        [
+            "not json",
+            {"no": "type"},
+            {"type": "msg.history", "room_id": room_id, "n": "many"},
+            {"type": "msg.history", "room_id": room_id, "before": [1]},
+            {"type": "room.ttl", "room_id": room_id, "ttl": -1},
+            {"type": "room.ttl", "room_id": room_id, "ttl": "1e999"},
+            {"type": "msg.ack", "seqs": ["room"]},
+            {"type": "room.read", "room_id": room_id, "seq": None},
+            msg_send(room, "hello", ttl="soon"),
+            msg_send(room, "hello"),
+        ],
+    )
+    assert [frame["type"] for frame in received] == ["msg.sent"]
+    assert "ttl" not in db.rooms[room_id]
+    assert [message["message"] for message in db.iter_messages(room_id)] == ["hello"]
+
+
+def test_non_str_messages_change_nothing(db, room):
+    """A msg.send whose data isn't a str leaves no message, pending ack or dedupe entry"""
+    room_id, first, second = room
+    received = session(
+        db,
+        first,
+        [
+            msg_send(room, 123, client_message_id="a"),
+            msg_send(room, {"text": "hi"}, client_message_id="b"),
+            msg_send(room, None, client_message_id="c"),
+        ],
+    )
+    assert received == []
+    assert db.latest_seq(room_id) == -1
+    assert db.get_pending(second) == []
+    assert db.sent_message(first, "a") is None
+    assert db.search_messages(first, "123")["total"] == 0
+
+
+def test_retried_messages_are_created_once(db, room):
+    """A msg.send retried with its client_message_id gets the first msg.sent again"""
+    room_id, first, second = room
+    received = session(
+        db,
+        first,
+        [
+            msg_send(room, "hello", client_message_id="a"),
+            msg_send(room, "hello", client_message_id="a"),
+        ],
+    )
+    assert [frame["seq"] for frame in received] == [0, 0]
+    assert received[1]["duplicate"] is True
+    assert received[0]["message_id"] == received[1]["message_id"]
+    assert db.latest_seq(room_id) == 0
+    assert len(db.get_pending(second)) == 1
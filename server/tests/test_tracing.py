@@ -0,0 +1,51 @@
+from server.tracing import NULL_TRACE, Tracer, percentile
+
+
+def test_untraced_frames_get_the_null_trace():
+    """Frames without a trace_id record nothing and are sent back unchanged"""
+    tracer = Tracer()
+    trace = tracer.start(None, 0.0)
+    assert trace is NULL_TRACE
+    with trace.span("db"):
+        pass
+    trace.finish()
+    assert trace.fields() == {}
+    assert tracer.summary() == {}
+
+
+def test_spans_are_summed_and_recorded():
+    """Spans of the same hop add up, finish records every hop once"""
+    tracer = Tracer()
+    trace = tracer.start("abc", 0.0)
+    with trace.span("db"):
+        pass
+    with trace.span("db"):
+        pass
+    fields = trace.fields()
+    assert fields["trace_id"] == "abc"
+    assert set(fields["timings"]) == {"db", "total"}
+    trace.finish()
+    summary = tracer.summary()
+    assert summary["db"]["count"] == 1
+    assert summary["total"]["count"] == 1
+
+
+def test_samples_are_bounded():
+    """Only the latest max_samples durations of a hop are summarised"""
+    tracer = Tracer(max_samples=3)
+    for duration in range(10):
+        tracer.record("hop", duration)
+    assert tracer.summary()["hop"] == {
+        "count": 3,
+        "p50": 8,
+        "p95": 9,
+        "p99": 9,
+        "max": 9,
+    }
+
+
+def test_percentile():
+    """Nearest-rank percentiles"""
+    assert percentile([], 50) == 0.0
+    assert percentile([1.0], 99) == 1.0
+    assert percentile(list(range(1, 101)), 95) == 95